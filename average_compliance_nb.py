@@ -10,20 +10,23 @@ def _():
     import io
     import pandas as pd
     import numpy as np
-    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
     import seaborn as sns
     import os
+    from figure_cache import figure_cache
 
     def fig_to_image(fig):
-        """Convert a matplotlib figure to a static mo.image for reliable rendering."""
+        """Convert a matplotlib figure (or cached PNG bytes) to a static mo.image for reliable rendering."""
         if fig is None:
             return mo.md("")
+        if isinstance(fig, bytes):
+            return mo.image(fig, width=1100)
         buf = io.BytesIO()
         fig.savefig(buf, format='png', bbox_inches='tight', dpi=150)
         buf.seek(0)
         return mo.image(buf.read(), width=1100)
 
-    return fig_to_image, mo, np, os, pd, plt, sns
+    return Figure, fig_to_image, figure_cache, mo, np, os, pd, sns
 
 
 @app.cell
@@ -544,9 +547,9 @@ def _(mdh_athena, pd):
 
 
 @app.cell
-def _(fig_to_image, get_avg_bp, get_avg_daily_questions, get_avg_daily_symptoms, get_avg_ring_wear, get_avg_weekly_surveys, get_avg_weight, mo, np, pd, plt, sns):
+def _(Figure, fig_to_image, figure_cache, get_avg_bp, get_avg_daily_questions, get_avg_daily_symptoms, get_avg_ring_wear, get_avg_weekly_surveys, get_avg_weight, mo, np, pd, sns):
     def build_average_heatmap(first_week, last_week, title, participant_ids_sql):
-        """Build an averaged compliance heatmap for all participants across GA weeks."""
+        """Build an averaged compliance heatmap for all participants across GA weeks, as PNG bytes."""
         symptoms = get_avg_daily_symptoms(first_week, last_week, participant_ids_sql)
         questions = get_avg_daily_questions(first_week, last_week, participant_ids_sql)
         surveys = get_avg_weekly_surveys(first_week, last_week, participant_ids_sql)
@@ -628,61 +631,66 @@ def _(fig_to_image, get_avg_bp, get_avg_daily_questions, get_avg_daily_symptoms,
             else:
                 annot_pct.loc[row_name] = df.loc[row_name].map(lambda v: f"{v:.1f}%")
 
-        # Plot with two subplots: percentage heatmap + hours heatmap
-        n_pct_rows = len(df)
-        fig, (ax_pct, ax_hours) = plt.subplots(
-            2, 1,
-            figsize=(max(11, num_weeks * 0.9), 6),
-            gridspec_kw={'height_ratios': [n_pct_rows, 1], 'hspace': 0.15},
-            sharex=True
-        )
+        # Served from the figure cache unless the numbers changed
+        def render():
+            # Plot with two subplots: percentage heatmap + hours heatmap
+            n_pct_rows = len(df)
+            fig = Figure(figsize=(max(11, num_weeks * 0.9), 6))
+            ax_pct, ax_hours = fig.subplots(
+                2, 1,
+                gridspec_kw={'height_ratios': [n_pct_rows, 1], 'hspace': 0.15},
+                sharex=True
+            )
 
-        # Main percentage heatmap
-        sns.heatmap(
-            df,
-            vmin=0, vmax=100,
-            cmap="YlGn",
-            linewidths=0.5, linecolor="white",
-            annot=annot_pct.values, fmt='',
-            ax=ax_pct, cbar=False
-        )
-        ax_pct.set_title(title)
-        ax_pct.set_xlabel("")
-
-        # Bold separator before averages
-        try:
-            sep_y = list(df.index).index("Self Report Average")
-            ax_pct.hlines(sep_y, *ax_pct.get_xlim(), colors="black", linewidth=2.8)
-        except ValueError:
-            pass
-
-        # Bold separator before N Participants
-        try:
-            sep_y2 = list(df.index).index("N Participants")
-            ax_pct.hlines(sep_y2, *ax_pct.get_xlim(), colors="black", linewidth=2.8)
-        except ValueError:
-            pass
-
-        # Hours heatmap (ring wear) with Blues colormap
-        sns.heatmap(
-            df_hours,
-            vmin=0, vmax=24,
-            cmap="Blues",
-            linewidths=0.5, linecolor="white",
-            annot=annot_hours.values, fmt='',
-            ax=ax_hours, cbar=False
-        )
-        ax_hours.set_ylabel("")
-        ax_hours.set_yticklabels(ax_hours.get_yticklabels(), rotation=0)
+            # Main percentage heatmap
+            sns.heatmap(
+                df,
+                vmin=0, vmax=100,
+                cmap="YlGn",
+                linewidths=0.5, linecolor="white",
+                annot=annot_pct.values, fmt='',
+                ax=ax_pct, cbar=False
+            )
+            ax_pct.set_title(title)
+            ax_pct.set_xlabel("")
+
+            # Bold separator before averages
+            try:
+                sep_y = list(df.index).index("Self Report Average")
+                ax_pct.hlines(sep_y, *ax_pct.get_xlim(), colors="black", linewidth=2.8)
+            except ValueError:
+                pass
+
+            # Bold separator before N Participants
+            try:
+                sep_y2 = list(df.index).index("N Participants")
+                ax_pct.hlines(sep_y2, *ax_pct.get_xlim(), colors="black", linewidth=2.8)
+            except ValueError:
+                pass
+
+            # Hours heatmap (ring wear) with Blues colormap
+            sns.heatmap(
+                df_hours,
+                vmin=0, vmax=24,
+                cmap="Blues",
+                linewidths=0.5, linecolor="white",
+                annot=annot_hours.values, fmt='',
+                ax=ax_hours, cbar=False
+            )
+            ax_hours.set_ylabel("")
+            ax_hours.set_yticklabels(ax_hours.get_yticklabels(), rotation=0)
+
+            fig.tight_layout()
+            return fig
 
-        plt.tight_layout()
-        return fig
+        key = figure_cache.key("average-heatmap-1", title, list(df.index), weeks, df.values, df_hours.values)
+        return figure_cache.png(key, render)
 
     return (build_average_heatmap,)
 
 
 @app.cell
-def _(fig_to_image, mdh_athena, mo, np, participant_ids_sql, plt):
+def _(Figure, fig_to_image, figure_cache, mdh_athena, mo, np, participant_ids_sql):
     def build_stage_distribution(first_week, last_week, title, participant_ids_sql):
         """Build a ring wear hours distribution histogram for a specific stage (GA week range), including 0h for days with no data."""
         query = f"""
@@ -740,18 +748,22 @@ def _(fig_to_image, mdh_athena, mo, np, participant_ids_sql, plt):
         days_with_data = (hours > 0).sum()
         days_without_data = (hours == 0).sum()
 
-        fig, ax = plt.subplots(figsize=(10, 3))
-        ax.hist(hours, bins=48, range=(0, 24), color='steelblue', edgecolor='white', alpha=0.85)
-        ax.axvline(x=18, color='red', linestyle='--', linewidth=1.5, label='Target: 18h')
-        ax.axvline(x=np.median(hours), color='orange', linestyle='-', linewidth=1.5, label=f'Median: {np.median(hours):.1f}h')
-        ax.axvline(x=np.mean(hours), color='green', linestyle='-.', linewidth=1.5, label=f'Mean: {np.mean(hours):.1f}h')
-        ax.set_xlabel("Daily Wear (hours)")
-        ax.set_ylabel("Days")
-        ax.set_title(f"{title} ({len(hours):,} total days | {days_without_data:,} with 0h)")
-        ax.set_xlim(0, 24)
-        ax.legend(fontsize=8)
-        plt.tight_layout()
-        return fig
+        def render():
+            fig = Figure(figsize=(10, 3))
+            ax = fig.subplots()
+            ax.hist(hours, bins=48, range=(0, 24), color='steelblue', edgecolor='white', alpha=0.85)
+            ax.axvline(x=18, color='red', linestyle='--', linewidth=1.5, label='Target: 18h')
+            ax.axvline(x=np.median(hours), color='orange', linestyle='-', linewidth=1.5, label=f'Median: {np.median(hours):.1f}h')
+            ax.axvline(x=np.mean(hours), color='green', linestyle='-.', linewidth=1.5, label=f'Mean: {np.mean(hours):.1f}h')
+            ax.set_xlabel("Daily Wear (hours)")
+            ax.set_ylabel("Days")
+            ax.set_title(f"{title} ({len(hours):,} total days | {days_without_data:,} with 0h)")
+            ax.set_xlim(0, 24)
+            ax.legend(fontsize=8)
+            fig.tight_layout()
+            return fig
+
+        return figure_cache.png(figure_cache.key("stage-distribution-1", title, hours), render)
 
     return (build_stage_distribution,)
 
@@ -817,13 +829,13 @@ def _(build_stage_distribution, fig_to_image, participant_ids_sql):
 
 
 @app.cell
-def _(fig_to_image, mdh_athena, mo, np, participant_ids_sql, plt):
+def _(Figure, fig_to_image, mdh_athena, mo, np, participant_ids_sql):
     mo.md("## Ring Wear — Daily Hours Distribution (All Participants)")
     return
 
 
 @app.cell
-def _(fig_to_image, mdh_athena, mo, np, participant_ids_sql, plt):
+def _(Figure, fig_to_image, figure_cache, mdh_athena, mo, np, participant_ids_sql):
     # Query all daily wear hours, including 0 for expected days from W9 to today
     ring_hist_query = f"""
     WITH edd AS (
@@ -879,18 +891,22 @@ def _(fig_to_image, mdh_athena, mo, np, participant_ids_sql, plt):
         days_with_data = (hours > 0).sum()
         days_without_data = (hours == 0).sum()
 
-        fig, ax = plt.subplots(figsize=(10, 4))
-        ax.hist(hours, bins=48, range=(0, 24), color='steelblue', edgecolor='white', alpha=0.85)
-        ax.axvline(x=18, color='red', linestyle='--', linewidth=1.5, label='Target: 18h')
-        ax.axvline(x=np.median(hours), color='orange', linestyle='-', linewidth=1.5, label=f'Median: {np.median(hours):.1f}h')
-        ax.axvline(x=np.mean(hours), color='green', linestyle='-.', linewidth=1.5, label=f'Mean: {np.mean(hours):.1f}h')
-        ax.set_xlabel("Daily Wear (hours)")
-        ax.set_ylabel("Number of Days")
-        ax.set_title(f"Ring Wear Hours Distribution — All Stages W9-40 ({len(hours):,} total days | {days_without_data:,} with 0h)")
-        ax.set_xlim(0, 24)
-        ax.legend()
-        plt.tight_layout()
-        _hist_output = fig_to_image(fig)
+        def _render():
+            fig = Figure(figsize=(10, 4))
+            ax = fig.subplots()
+            ax.hist(hours, bins=48, range=(0, 24), color='steelblue', edgecolor='white', alpha=0.85)
+            ax.axvline(x=18, color='red', linestyle='--', linewidth=1.5, label='Target: 18h')
+            ax.axvline(x=np.median(hours), color='orange', linestyle='-', linewidth=1.5, label=f'Median: {np.median(hours):.1f}h')
+            ax.axvline(x=np.mean(hours), color='green', linestyle='-.', linewidth=1.5, label=f'Mean: {np.mean(hours):.1f}h')
+            ax.set_xlabel("Daily Wear (hours)")
+            ax.set_ylabel("Number of Days")
+            ax.set_title(f"Ring Wear Hours Distribution — All Stages W9-40 ({len(hours):,} total days | {days_without_data:,} with 0h)")
+            ax.set_xlim(0, 24)
+            ax.legend()
+            fig.tight_layout()
+            return fig
+
+        _hist_output = fig_to_image(figure_cache.png(figure_cache.key("ring-hours-distribution-1", hours), _render))
     _hist_output
     return
 
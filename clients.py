@@ -0,0 +1,86 @@
+"""
+Process-wide registry of the query clients.
+
+Modules register a factory per client name at import time and bind a lazy
+stand-in; the client itself (which authenticates against MyDataHelps or
+AWS) is only built on its first query, once per process.
+
+Usage:
+    from clients import clients
+    from query_cache import CachedNeedle
+
+    clients.register("mdh", lambda: CachedNeedle(method="mdh"))
+    mdh_athena = clients.lazy("mdh")
+    result = mdh_athena.execQuery(query)   # builds the client here
+"""
+
+import threading
+from typing import TYPE_CHECKING, Callable, Optional
+
+if TYPE_CHECKING:
+    from query_cache import CachedQueryEngine
+
+
+class ClientRegistry:
+    """
+    Process-wide query clients, constructed on first use.
+
+    register() only records a factory, so importing a module that registers
+    its clients costs nothing; the client is built (and authenticates) the
+    first time get() asks for it, exactly once even if several threads ask
+    at the same time. lazy() returns a stand-in that can be bound at import
+    time and resolves the client on its first attribute access.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], "CachedQueryEngine"]):
+        """Set the factory for name, dropping any client already built from an older one."""
+        with self._lock:
+            self._factories[name] = factory
+            self._clients.pop(name, None)
+
+    def get(self, name: str) -> "CachedQueryEngine":
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                if name not in self._factories:
+                    raise KeyError(f"No query client registered as {name!r}")
+                client = self._clients[name] = self._factories[name]()
+            return client
+
+    def lazy(self, name: str) -> "LazyClient":
+        return LazyClient(self, name)
+
+    def reset(self, name: Optional[str] = None):
+        """Forget built clients (all, or one) so the next get() constructs them again."""
+        with self._lock:
+            if name is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(name, None)
+
+
+class LazyClient:
+    """Forwards attribute access to a ClientRegistry entry, building it on first use."""
+
+    __slots__ = ("_registry", "_name")
+
+    def __init__(self, registry: ClientRegistry, name: str):
+        self._registry = registry
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(self._name), attr)
+
+    def __repr__(self):
+        return f"<LazyClient {self._name!r}>"
+
+
+clients = ClientRegistry()
@@ -0,0 +1,268 @@
+"""
+Weekly compliance of a whole cohort, computed in one batch.
+
+build_cohort_compliance() loads profiles, per-day activity and Ultrahuman
+wear for every participant with a few set-based queries (one of each per
+COHORT_QUERY_BATCH participants) instead of one set per participant. It
+then slices each participant's weekly counts in memory with the same rules
+as the participation heatmaps (ParticipantTimeline) and stacks them into
+one participants x metrics x weeks ComplianceMatrix.
+
+The week axis covers gestational weeks W9-W42 followed by postpartum weeks
+PP W1-PP W6 (from the delivery date). A week that hasn't started yet, a
+prenatal week starting on or after delivery, a postpartum week past the
+participant's postpartum period, and every week of a participant without
+an EDD is NaN. The ring row is vendor-neutral: Oura or Ultrahuman wear,
+whichever the participant has.
+
+Usage:
+    from cohort_compliance import build_cohort_compliance
+
+    cohort = build_cohort_compliance(participant_ids)
+    cohort.matrix.counts                # (participants, metrics, weeks)
+    cohort.matrix.weekly_compensation   # (participants, weeks)
+    cohort.total_compensation()         # $ per participant
+    cohort.to_long().to_parquet("cohort.parquet")
+
+    python cohort_compliance.py --out .cache/cohort_compliance.parquet PID...
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from stage_calculation import (
+    ComplianceMatrix,
+    ParticipantProfile,
+    ParticipantTimeline,
+    aws_athena,
+    calculate_postpartum_weeks_from_delivery,
+    load_participant_profiles,
+    mdh_athena,
+    timeline_activity_query,
+    timeline_days,
+    timeline_survey_rows,
+    timeline_ttl,
+    timeline_uh_samples,
+    uh_wear_samples_query,
+)
+
+logger = logging.getLogger(__name__)
+
+PRENATAL_WEEKS = range(9, 43)
+POSTPARTUM_WEEKS = range(1, 7)
+WEEKS = [f"W{w}" for w in PRENATAL_WEEKS] + [f"PP W{w}" for w in POSTPARTUM_WEEKS]
+
+# Heatmap rows, self-report first (see SELF_REPORT_ROWS in stage_calculation)
+RING_WEAR = "Smart ring wear (~19h/day)"
+METRICS = [
+    "Symptom check-in (daily)",
+    "Daily questions (1-5 Q)",
+    "Weekly/bimonthly questionnaire",
+    "Weight(per week)",
+    "BP (per week)",
+    RING_WEAR,
+]
+
+# Participants per set-based query; keeps the IN lists well under Athena's
+# query length limit. Override with COHORT_QUERY_BATCH.
+COHORT_QUERY_BATCH = int(os.getenv("COHORT_QUERY_BATCH", 500))
+
+
+@dataclass
+class CohortCompliance:
+    """
+    Weekly compliance of many participants.
+
+    matrix.counts[i] is participant participants[i]'s metrics x weeks counts
+    (rows METRICS, columns WEEKS); percentages, averages and compensation
+    are on the same axes.
+    """
+
+    participants: List[str]
+    profiles: Dict[str, ParticipantProfile]
+    matrix: ComplianceMatrix
+
+    def participant(self, participantidentifier) -> ComplianceMatrix:
+        """One participant's metrics x weeks slice."""
+        i = self.participants.index(participantidentifier)
+        m = self.matrix
+        return ComplianceMatrix(
+            metrics=m.metrics,
+            weeks=m.weeks,
+            counts=m.counts[i],
+            percentages=m.percentages[i],
+            self_report_average=m.self_report_average[i],
+            biometrics_average=m.biometrics_average[i],
+            weekly_compensation=m.weekly_compensation[i],
+        )
+
+    def total_compensation(self) -> pd.Series:
+        """$ earned per participant over all weeks."""
+        return pd.Series(self.matrix.weekly_compensation.sum(axis=-1), index=self.participants)
+
+    def to_long(self) -> pd.DataFrame:
+        """
+        One row per (participant, metric, week) with the count and percentage;
+        weeks that don't apply to a participant are left out.
+        """
+        m = self.matrix
+        p, r, w = np.nonzero(~np.isnan(m.counts))
+        return pd.DataFrame({
+            "participantidentifier": np.asarray(self.participants, dtype=object)[p],
+            "metric": np.asarray(m.metrics, dtype=object)[r],
+            "week": np.asarray(m.weeks, dtype=object)[w],
+            "count": m.counts[p, r, w],
+            "percentage": m.percentages[p, r, w],
+        })
+
+    def weekly(self) -> pd.DataFrame:
+        """One row per (participant, week) with both averages and the compensation."""
+        m = self.matrix
+        p, w = np.nonzero(~np.isnan(m.self_report_average))
+        return pd.DataFrame({
+            "participantidentifier": np.asarray(self.participants, dtype=object)[p],
+            "week": np.asarray(m.weeks, dtype=object)[w],
+            "self_report_average": m.self_report_average[p, w],
+            "biometrics_average": m.biometrics_average[p, w],
+            "weekly_compensation": m.weekly_compensation[p, w],
+        })
+
+
+def build_cohort_compliance(participantidentifiers, today=None) -> CohortCompliance:
+    """
+    Weekly counts of every participant, metric and week from set-based queries.
+
+    Args:
+        participantidentifiers: the cohort, e.g. a segment's participant ids
+        today: weeks starting after this date are NaN (default: today)
+    """
+    participants = list(dict.fromkeys(participantidentifiers))
+    today = pd.Timestamp(today or datetime.today()).normalize()
+    profiles = load_participant_profiles(participants)
+    timelines = load_cohort_timelines([profiles[pid] for pid in participants])
+
+    counts = np.full((len(participants), len(METRICS), len(WEEKS)), np.nan)
+    for i, pid in enumerate(participants):
+        if pid in timelines:
+            _fill_participant(counts[i], profiles[pid], timelines[pid], today)
+    return CohortCompliance(participants, profiles, ComplianceMatrix.from_counts(METRICS, WEEKS, counts))
+
+
+def load_cohort_timelines(profiles) -> Dict[str, ParticipantTimeline]:
+    """
+    ParticipantTimeline of every profile with an EDD: one MDH query (and, for
+    Ultrahuman participants, one AWS query) per COHORT_QUERY_BATCH profiles.
+
+    With UH_API_CALL set, Ultrahuman wear is left to the API (see
+    _fill_participant), as in load_participant_timeline.
+    """
+    profiles = [p for p in profiles if p.w1 is not None]
+    timelines = {}
+    for start in range(0, len(profiles), COHORT_QUERY_BATCH):
+        batch = profiles[start:start + COHORT_QUERY_BATCH]
+        ids = [p.participantidentifier for p in batch]
+        # Cached forever only once every participant in the batch has finished
+        ttls = [timeline_ttl(p.delivery_date, p.postpartum_days) for p in batch]
+        ttl = None if all(t is None for t in ttls) else min(t for t in ttls if t is not None)
+
+        query = timeline_activity_query(ids, include_oura=any(p.ring_vendor == 'oura' for p in batch))
+        result = mdh_athena.execQuery(query, ttl_seconds=ttl, columns=['participantidentifier', 'day_date', 'metric', 'value'])
+        activity = dict(tuple(result.groupby('participantidentifier'))) if len(result) > 0 else {}
+
+        uh_ids = [p.participantidentifier for p in batch if p.ring_vendor != 'oura']
+        samples = {}
+        if uh_ids and not os.getenv('UH_API_CALL'):
+            result = aws_athena.execQuery(uh_wear_samples_query(uh_ids), ttl_seconds=ttl, columns=['pid', 'day_date', 'samples_in_day'])
+            samples = dict(tuple(result.groupby('pid'))) if len(result) > 0 else {}
+
+        empty_activity = pd.DataFrame(columns=['day_date', 'metric', 'value'])
+        empty_samples = pd.DataFrame(columns=['day_date', 'samples_in_day'])
+        for p in batch:
+            pid = p.participantidentifier
+            uh_samples = None
+            if p.ring_vendor != 'oura' and not os.getenv('UH_API_CALL'):
+                uh_samples = timeline_uh_samples(samples.get(pid, empty_samples))
+            rows = activity.get(pid, empty_activity)
+            timelines[pid] = ParticipantTimeline(pid, p.w1, timeline_days(rows), uh_samples, timeline_survey_rows(rows))
+    return timelines
+
+
+def _fill_participant(counts, profile, timeline, today):
+    """Write one participant's metrics x WEEKS counts into counts (NaN-initialised)."""
+    vendor = 'oura' if profile.ring_vendor == 'oura' else 'uh'
+    delivery = profile.delivery_date
+    pp_days = profile.postpartum_days or 42
+
+    prenatal = slice(0, len(PRENATAL_WEEKS))
+    _put(counts, prenatal, timeline.prenatal_frame(PRENATAL_WEEKS[0], PRENATAL_WEEKS[-1], vendor))
+    starts = [profile.w1 + timedelta(days=(w - 1) * 7) for w in PRENATAL_WEEKS]
+    valid = [start <= today and (delivery is None or start < delivery) for start in starts]
+
+    postpartum = slice(len(PRENATAL_WEEKS), len(WEEKS))
+    if delivery:
+        _put(counts, postpartum, timeline.postpartum_frame(POSTPARTUM_WEEKS[0], POSTPARTUM_WEEKS[-1], delivery, pp_days, vendor))
+        pp_starts = [delivery + timedelta(days=(w - 1) * 7) for w in POSTPARTUM_WEEKS]
+        valid += [start <= today and start <= delivery + timedelta(days=pp_days) for start in pp_starts]
+    else:
+        valid += [False] * len(POSTPARTUM_WEEKS)
+
+    if vendor == 'uh' and os.getenv('UH_API_CALL'):
+        _put_uh_api_wear(counts, profile, valid)
+    counts[:, ~np.asarray(valid)] = np.nan
+
+
+def _put(counts, weeks, frame):
+    for label, values in frame.items():
+        row = METRICS.index(RING_WEAR if label.endswith(RING_WEAR) else label)
+        counts[row, weeks] = values
+
+
+def _put_uh_api_wear(counts, profile, valid):
+    """Ring row from the Ultrahuman API for the weeks that have started."""
+    if not profile.uh_email:
+        return
+    import uh_client
+
+    ranges = {}
+    for j, week in enumerate(PRENATAL_WEEKS):
+        if valid[j]:
+            start = profile.w1 + timedelta(days=(week - 1) * 7)
+            ranges[j] = (start, start + timedelta(days=6))
+    if profile.delivery_date:
+        week_ranges = calculate_postpartum_weeks_from_delivery(
+            profile.participantidentifier, POSTPARTUM_WEEKS[0], POSTPARTUM_WEEKS[-1],
+            profile.delivery_date, profile.postpartum_days or 42,
+        ) or []
+        for week, start, end in week_ranges:
+            j = len(PRENATAL_WEEKS) + week - POSTPARTUM_WEEKS[0]
+            if valid[j]:
+                ranges[j] = (start, end)
+    if ranges:
+        wear = uh_client.get_client().weekly_wear_counts(profile.uh_email, list(ranges.values()))
+        counts[METRICS.index(RING_WEAR), list(ranges)] = wear
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the cohort compliance tensor and write it as long-format parquet.")
+    parser.add_argument("--out", required=True, help="parquet path for the (participant, metric, week) rows")
+    parser.add_argument("--weekly-out", default=None, help="optional parquet path for the (participant, week) averages and compensation")
+    parser.add_argument("participants", nargs="+")
+    args = parser.parse_args(argv)
+
+    cohort = build_cohort_compliance(args.participants)
+    cohort.to_long().to_parquet(args.out, index=False)
+    if args.weekly_out:
+        cohort.weekly().to_parquet(args.weekly_out, index=False)
+    print(cohort.total_compensation().to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Content-addressed cache of rendered figures.
+
+A heatmap is re-encoded only when what it shows has changed: the key hashes
+the plotted arrays, title and a style tag, so an unchanged matrix is served
+from .cache/figures/ without importing or running matplotlib.
+
+Usage:
+    from figure_cache import figure_cache
+
+    png = figure_cache.png(figure_cache.key("stage", title, counts), lambda: render(counts))
+"""
+
+import hashlib
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from query_cache import atomic_write, metrics
+
+
+# Rendered heatmap PNGs, keyed by a hash of what was plotted, so an unchanged
+# matrix is served without importing or running matplotlib.
+FIGURE_CACHE_DIR = Path(".cache/figures")
+FIGURE_DPI = 150
+
+
+class FigureCache:
+    """
+    Content-addressed cache of rendered figures as PNG bytes.
+
+    The key is a hash of everything that determines the picture (the data
+    arrays, title and a style/version tag chosen by the caller) plus the PNG
+    encoding settings, so entries never go stale: different inputs produce
+    a different key. Files are written atomically under
+    .cache/figures/{key[:2]}/{key}.png and shared across processes.
+    """
+
+    def __init__(self, cache_dir: Path = FIGURE_CACHE_DIR, dpi: int = FIGURE_DPI):
+        self.cache_dir = cache_dir
+        self.dpi = dpi
+
+    def key(self, *parts) -> str:
+        """Hash of parts: strings, numbers, None, lists/tuples/dicts of them and NumPy arrays."""
+        digest = hashlib.sha256()
+        digest.update(f"png:{self.dpi}:tight".encode())
+        _hash_parts(digest, parts)
+        return digest.hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.path_for(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, png: bytes):
+        atomic_write(self.path_for(key), lambda tmp: Path(tmp).write_bytes(png))
+
+    def encode(self, fig) -> bytes:
+        """PNG bytes of a matplotlib figure with the cache's encoding settings."""
+        import io
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", bbox_inches="tight", dpi=self.dpi)
+        return buf.getvalue()
+
+    def png(self, key: str, render: Callable) -> bytes:
+        """
+        PNG for key, calling render() (which returns a figure) only on a miss.
+
+        A pyplot figure returned by render() is closed once encoded.
+        """
+        png = self.get(key)
+        if png is not None:
+            metrics.inc("figure_cache_requests_total", outcome="hit")
+            return png
+        metrics.inc("figure_cache_requests_total", outcome="miss")
+        started = time.perf_counter()
+        fig = render()
+        try:
+            png = self.encode(fig)
+        finally:
+            # pyplot keeps its figures registered until closed; a plain
+            # matplotlib.figure.Figure is freed with its last reference
+            if getattr(fig.canvas, "manager", None) is not None:
+                import matplotlib.pyplot as plt
+
+                plt.close(fig)
+        metrics.observe("figure_render_seconds", time.perf_counter() - started)
+        self.put(key, png)
+        return png
+
+    def prune(self, max_bytes: int) -> dict:
+        """Delete the least recently read PNGs until under max_bytes."""
+        files = []
+        for path in self.cache_dir.glob("*/*.png"):
+            st = path.stat()
+            files.append((st.st_atime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        reclaimed = 0
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            total -= size
+            evicted += 1
+            reclaimed += size
+        return {"files": len(files) - evicted, "bytes": total, "evicted": evicted, "reclaimed_bytes": reclaimed}
+
+
+def _hash_parts(digest, value):
+    if isinstance(value, (list, tuple)):
+        digest.update(f"[{len(value)}".encode())
+        for item in value:
+            _hash_parts(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f"{{{len(value)}".encode())
+        for k in sorted(value):
+            _hash_parts(digest, k)
+            _hash_parts(digest, value[k])
+    elif hasattr(value, "__array__"):
+        import numpy as np
+
+        array = np.ascontiguousarray(value)
+        digest.update(f"a{array.dtype.str}{array.shape}".encode())
+        digest.update(array.tobytes() if array.dtype != object else repr(array.tolist()).encode())
+    else:
+        text = repr(value).encode()
+        digest.update(f"s{len(text)}:".encode())
+        digest.update(text)
+
+
+figure_cache = FigureCache()
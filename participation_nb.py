@@ -12,9 +12,11 @@ def _():
     import base64
 
     def fig_to_image(fig):
-        """Convert a matplotlib figure to a static mo.image for reliable rendering."""
+        """Convert a matplotlib figure (or cached PNG bytes) to a static mo.image for reliable rendering."""
         if fig is None:
             return mo.md("")
+        if isinstance(fig, bytes):
+            return mo.image(fig, width=1100)
         buf = io.BytesIO()
         fig.savefig(buf, format='png', bbox_inches='tight', dpi=150)
         buf.seek(0)
@@ -43,6 +45,16 @@ def _(mdh, os):
     return (all_participants_data,)
 
 
+@app.cell
+def _(all_participants_data):
+    from stage_calculation import load_participant_profiles
+    # One allparticipants query for the whole segment; the W1/delivery lookups below are served from it
+    participant_profiles = load_participant_profiles(
+        [p['participantIdentifier'] for p in all_participants_data['participants']]
+    )
+    return (participant_profiles,)
+
+
 @app.cell
 def _():
     # all_participants_table = mo.ui.table(data=all_participants_data['participants'], pagination=True)
@@ -199,28 +211,52 @@ def _(delivery_date, mo, ring_vendor):
 
 
 @app.cell
-def _(participantidentifier):
-    from stage_calculation import show_heatmap_for_stage, participant_first_w1_day, get_participant_delivery_info, get_delivery_week, get_current_gestational_week
+def _(participant_profiles, participantidentifier):
+    from stage_calculation import stage_heatmap_pngs, participant_first_w1_day, get_participant_delivery_info, get_delivery_week, get_current_gestational_week, load_participant_timeline
+    from query_cache import record_cache_status
     first_w1_day = participant_first_w1_day(participantidentifier)
     return (
         first_w1_day,
         get_current_gestational_week,
         get_delivery_week,
         get_participant_delivery_info,
-        show_heatmap_for_stage,
+        load_participant_timeline,
+        record_cache_status,
+        stage_heatmap_pngs,
     )
 
 
+@app.cell
+def _(
+    delivery_date,
+    first_w1_day,
+    load_participant_timeline,
+    participantidentifier,
+    postpartum_days,
+    record_cache_status,
+    ring_vendor,
+):
+    # One fetch of the participant's whole timeline; every stage below slices it in memory
+    with record_cache_status() as timeline_cache_status:
+        participant_timeline = load_participant_timeline(
+            participantidentifier, first_w1_day, ring_vendor, delivery_date, postpartum_days
+        )
+    return participant_timeline, timeline_cache_status
+
+
 @app.cell
 def _(
     first_w1_day,
     participant_email,
+    participant_timeline,
     participantidentifier,
+    record_cache_status,
     ring_vendor,
-    show_heatmap_for_stage,
+    stage_heatmap_pngs,
 ):
-    stage1_fig_1, stage1_fig_2 = show_heatmap_for_stage(participant_email, participantidentifier, 9, 19, "Prenatal Weeks 9-19 — Weekly Compliance Heatmap", first_w1_day, ring_vendor)
-    return stage1_fig_1, stage1_fig_2
+    with record_cache_status() as stage1_cache_status:
+        stage1_fig_1, stage1_fig_2 = stage_heatmap_pngs(participant_email, participantidentifier, 9, 19, "Prenatal Weeks 9-19 — Weekly Compliance Heatmap", first_w1_day, ring_vendor, timeline=participant_timeline)
+    return stage1_cache_status, stage1_fig_1, stage1_fig_2
 
 
 @app.cell
@@ -239,12 +275,15 @@ def _(fig_to_image, stage1_fig_2):
 def _(
     first_w1_day,
     participant_email,
+    participant_timeline,
     participantidentifier,
+    record_cache_status,
     ring_vendor,
-    show_heatmap_for_stage,
+    stage_heatmap_pngs,
 ):
-    stage2_fig_1, stage2_fig_2 = show_heatmap_for_stage(participant_email, participantidentifier, 20, 30, "Prenatal Weeks 20-30 — Weekly Compliance Heatmap", first_w1_day, ring_vendor)
-    return stage2_fig_1, stage2_fig_2
+    with record_cache_status() as stage2_cache_status:
+        stage2_fig_1, stage2_fig_2 = stage_heatmap_pngs(participant_email, participantidentifier, 20, 30, "Prenatal Weeks 20-30 — Weekly Compliance Heatmap", first_w1_day, ring_vendor, timeline=participant_timeline)
+    return stage2_cache_status, stage2_fig_1, stage2_fig_2
 
 
 @app.cell
@@ -263,13 +302,16 @@ def _(fig_to_image, stage2_fig_2):
 def _(
     first_w1_day,
     participant_email,
+    participant_timeline,
     participantidentifier,
+    record_cache_status,
     ring_vendor,
-    show_heatmap_for_stage,
     stage3_last_week,
+    stage_heatmap_pngs,
 ):
-    stage3_fig_1, stage3_fig_2 = show_heatmap_for_stage(participant_email, participantidentifier, 31, stage3_last_week, f"Prenatal Weeks 31-{stage3_last_week} — Weekly Compliance Heatmap", first_w1_day, ring_vendor)
-    return stage3_fig_1, stage3_fig_2
+    with record_cache_status() as stage3_cache_status:
+        stage3_fig_1, stage3_fig_2 = stage_heatmap_pngs(participant_email, participantidentifier, 31, stage3_last_week, f"Prenatal Weeks 31-{stage3_last_week} — Weekly Compliance Heatmap", first_w1_day, ring_vendor, timeline=participant_timeline)
+    return stage3_cache_status, stage3_fig_1, stage3_fig_2
 
 
 @app.cell
@@ -290,32 +332,78 @@ def _(
     first_w1_day,
     has_postpartum,
     participant_email,
+    participant_timeline,
     participantidentifier,
     postpartum_days,
+    record_cache_status,
     ring_vendor,
-    show_heatmap_for_stage,
     stage3_extended_last_week,
+    stage_heatmap_pngs,
 ):
     stage4_fig_1 = None
     stage4_fig_2 = None
     stage4_ext_fig_1 = None
     stage4_ext_fig_2 = None
 
-    if stage3_extended_last_week and stage3_extended_last_week >= 41:
-        stage4_ext_fig_1, stage4_ext_fig_2 = show_heatmap_for_stage(
-            participant_email, participantidentifier, 41, stage3_extended_last_week,
-            f"Prenatal Weeks 41-{stage3_extended_last_week} — Weekly Compliance Heatmap",
-            first_w1_day, ring_vendor
-        )
+    with record_cache_status() as stage4_cache_status:
+        if stage3_extended_last_week and stage3_extended_last_week >= 41:
+            stage4_ext_fig_1, stage4_ext_fig_2 = stage_heatmap_pngs(
+                participant_email, participantidentifier, 41, stage3_extended_last_week,
+                f"Prenatal Weeks 41-{stage3_extended_last_week} — Weekly Compliance Heatmap",
+                first_w1_day, ring_vendor, timeline=participant_timeline
+            )
+
+        if has_postpartum and delivery_date:
+            stage4_fig_1, stage4_fig_2 = stage_heatmap_pngs(
+                participant_email, participantidentifier, 1, 6,
+                "Postpartum Weeks 1-6 — Weekly Compliance Heatmap",
+                first_w1_day, ring_vendor, is_postpartum=True,
+                delivery_date=delivery_date, postpartum_days=postpartum_days,
+                timeline=participant_timeline
+            )
+    return (
+        stage4_cache_status,
+        stage4_ext_fig_1,
+        stage4_ext_fig_2,
+        stage4_fig_1,
+        stage4_fig_2,
+    )
 
-    if has_postpartum and delivery_date:
-        stage4_fig_1, stage4_fig_2 = show_heatmap_for_stage(
-            participant_email, participantidentifier, 1, 6,
-            "Postpartum Weeks 1-6 — Weekly Compliance Heatmap",
-            first_w1_day, ring_vendor, is_postpartum=True,
-            delivery_date=delivery_date, postpartum_days=postpartum_days
-        )
-    return stage4_ext_fig_1, stage4_ext_fig_2, stage4_fig_1, stage4_fig_2
+
+@app.cell
+def _(
+    mo,
+    stage1_cache_status,
+    stage2_cache_status,
+    stage3_cache_status,
+    stage4_cache_status,
+    timeline_cache_status,
+):
+    _statuses = timeline_cache_status + stage1_cache_status + stage2_cache_status + stage3_cache_status + stage4_cache_status
+    _stale = _statuses.count("stale")
+    mo.md(
+        f"*Data freshness: {_stale} of {len(_statuses)} queries served from an expired cache entry; refreshing in the background.*"
+        if _stale
+        else "*Data freshness: all queries served fresh.*"
+    )
+    return
+
+
+@app.cell
+def _(mo, stage4_cache_status):
+    from query_cache import metrics
+
+    # Re-evaluated after the last stage loads (stage4_cache_status)
+    _ = stage4_cache_status
+    _summary = metrics.summary()
+    mo.accordion(
+        {
+            "Query cache diagnostics": mo.ui.table(_summary, selection=None)
+            if not _summary.empty
+            else mo.md("*No queries recorded yet.*")
+        }
+    )
+    return
 
 
 @app.cell
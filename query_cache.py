@@ -1,10 +1,48 @@
 """
 Query cache layer for Athena queries.
 
-Wraps sensorfabric's Needle/athena execQuery with a file-based cache.
+CachedQueryEngine puts a file-based cache in front of a QueryBackend:
+sensorfabric's Needle (CachedNeedle), a direct athena connection
+(CachedAthena), or LocalBackend, which runs the same SQL against parquet
+fixtures through DuckDB for offline benchmarks and load tests.
 Past gestational weeks are cached permanently. Current/recent data
 uses a configurable TTL.
 
+Results are stored as parquet in a sharded layout
+(.cache/queries/{hash[:2]}/{hash}.parquet) and indexed by a single SQLite
+manifest, so validity checks, listing and stats never scan the directory.
+
+Repeat lookups inside one process are served from a bounded in-memory
+LRU tier before the parquet files on disk are touched. Concurrent misses
+for the same query are coalesced into a single Athena execution, both
+across threads and across processes sharing the cache directory.
+
+Writes are crash-safe: files are committed with temp-file + rename under a
+per-key flock before the manifest row is written, and entries that fail
+to load are treated as misses and removed.
+
+Entries can be stored as Arrow IPC files instead of parquet
+(QUERY_CACHE_FORMAT=arrow); those are memory-mapped on read, so processes
+reading the same hot result share the OS page cache instead of each
+decoding a private copy. Pass columns=[...] to load only what the caller
+uses.
+
+Every execQuery is counted in the process-wide `metrics` registry,
+labelled with the calling function, the backend (mdh/aws) and the cache
+outcome, together with its latency and, on a miss, the Athena wall time
+and bytes scanned. Export with metrics.to_prometheus() or
+metrics.snapshot().
+
+Queries rendered for a week range can pass week_range=(first, last): the
+manifest records the range alongside a hash of the query with its bounds
+templated out, so a later request for a sub-range is sliced from the wider
+cached result instead of going back to Athena.
+
+With stale-while-revalidate enabled, an expired result that is still
+within the grace window is returned immediately and refreshed on a
+background worker. Every returned frame carries
+result.attrs["cache_status"] ("fresh" or "stale").
+
 Usage:
     from query_cache import CachedNeedle
 
@@ -13,206 +51,1829 @@ Usage:
 
     # For queries about past data that won't change:
     result = needle.execQuery(query, ttl_seconds=None)  # cache forever
+
+    # Serve W9-19 from a cached W9-40 result of the same query:
+    result = needle.execQuery(query, week_range=(9, 19))
+
+    # Only materialize the columns you need:
+    result = needle.execQuery(query, columns=["week", "days_with_5q"])
+
+    # Same queries, offline, against fixtures/mdh/{table}.parquet:
+    local = CachedQueryEngine(LocalBackend(Path("fixtures/mdh")), cache_dir=Path(".cache/local-queries"))
+
+    # Overlap independent queries from async code (e.g. marimo async cells):
+    a, b = await asyncio.gather(needle.execQuery_async(q1), needle.execQuery_async(q2))
+
+    # Scope TTL/refresh/deadline to a block instead of passing them to every call:
+    with query_policy(ttl_seconds=None, timeout=20):
+        result = needle.execQuery(query)
+
+    # Report whether anything was served from an expired entry:
+    with record_cache_status() as statuses:
+        result = needle.execQuery(query, stale_while_revalidate=True)
+    "stale" in statuses
 """
 
+import asyncio
+import bisect
 import hashlib
+import heapq
+import itertools
 import json
+import logging
 import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from datetime import date, datetime
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, List, Optional, Protocol, Sequence, Tuple
 
 import pandas as pd
-from sensorfabric.needle import Needle
-from sensorfabric.athena import athena
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+if TYPE_CHECKING:
+    # Imported by the backends that use them: loading sensorfabric (boto3,
+    # MyDataHelps auth) is the slowest part of importing this module.
+    from sensorfabric.athena import athena
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process coalescing
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
 
 CACHE_DIR = Path(".cache/queries")
+MANIFEST_NAME = "manifest.sqlite"
+
+# Opt-in stale-while-revalidate, and how long past its TTL an entry may still
+# be served. Override with QUERY_CACHE_STALE_WHILE_REVALIDATE=1 and
+# QUERY_CACHE_STALE_GRACE_SECONDS.
+STALE_WHILE_REVALIDATE = os.getenv("QUERY_CACHE_STALE_WHILE_REVALIDATE", "").lower() in ("1", "true", "yes")
+STALE_GRACE_SECONDS = int(os.getenv("QUERY_CACHE_STALE_GRACE_SECONDS", 6 * 3600))
+
+# Disk budget for .cache/queries and the eviction policy ("lru" or "lfu") used
+# to stay under it. Override with QUERY_CACHE_MAX_BYTES / QUERY_CACHE_EVICTION.
+DEFAULT_DISK_BYTES = 2 * 1024 * 1024 * 1024
+EVICTION_POLICIES = ("lru", "lfu")
+
+# On-disk format for new entries. Override with QUERY_CACHE_FORMAT.
+STORAGE_FORMATS = ("parquet", "arrow")
 
+# How many execQuery_async calls run at once per event loop. Override with
+# QUERY_CACHE_MAX_CONCURRENCY or set_max_concurrency().
+MAX_CONCURRENCY = int(os.getenv("QUERY_CACHE_MAX_CONCURRENCY", 8))
 
-class CachedNeedle:
+# Byte budget for the in-process tier. Override with QUERY_CACHE_MEMORY_BYTES.
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+
+# Default of execQuery's ttl_seconds: use the current QueryPolicy's TTL
+# (None can't be the marker, it already means "cache forever").
+FROM_POLICY = object()
+
+
+class _MemoryEntry:
+    __slots__ = ("df", "size", "cached_at", "ttl_seconds")
+
+    def __init__(self, df: pd.DataFrame, size: int, cached_at: float, ttl_seconds: Optional[int]):
+        self.df = df
+        self.size = size
+        self.cached_at = cached_at
+        self.ttl_seconds = ttl_seconds
+
+    def expired(self, now: float) -> bool:
+        if self.ttl_seconds is None:
+            return False
+        return now - self.cached_at >= self.ttl_seconds
+
+
+class MemoryCache:
     """
-    Wrapper around sensorfabric.Needle that caches query results to disk.
+    Bounded in-process LRU cache of query results.
 
-    Cache files are stored as parquet in .cache/queries/{hash}.parquet
-    with a companion .meta JSON file tracking TTL and timestamp.
+    Sits in front of the parquet cache so repeat lookups skip the disk
+    entirely. Entries are sized with DataFrame.memory_usage(deep=True) and
+    keep the TTL they were cached with; expired entries are dropped on
+    access and are evicted before live ones when the byte budget is hit.
     """
 
-    def __init__(self, method: str = "mdh", cache_dir: Optional[Path] = None):
-        self._needle = Needle(method=method)
-        self._cache_dir = cache_dir or CACHE_DIR
-        self._cache_dir.mkdir(parents=True, exist_ok=True)
+    def __init__(self, max_bytes: int = DEFAULT_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _MemoryEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    def execQuery(
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        """Return a shallow copy of the cached frame, or None on miss/expiry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expired(time.time()):
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            df = entry.df
+        # Shallow copy so callers adding/dropping columns can't alter the entry
+        return df.copy(deep=False)
+
+    def put(
         self,
-        query: str,
-        ttl_seconds: Optional[int] = 1800,
-        force_refresh: bool = False,
-    ) -> pd.DataFrame:
-        """
-        Execute a query with caching.
+        key: str,
+        df: pd.DataFrame,
+        ttl_seconds: Optional[int],
+        cached_at: Optional[float] = None,
+    ):
+        """Store a frame, evicting expired and then least recently used entries."""
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        entry = _MemoryEntry(
+            df.copy(deep=False),
+            size,
+            time.time() if cached_at is None else cached_at,
+            ttl_seconds,
+        )
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes or entry.expired(time.time()):
+                return
+            self._entries[key] = entry
+            self._bytes += size
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _evict(self):
+        if self._bytes <= self.max_bytes:
+            return
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e.expired(now)]:
+            self._remove(key)
+        while self._bytes > self.max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+
+
+# Default memory tier of every engine, so QUERY_CACHE_MEMORY_BYTES bounds the
+# whole process. Keys include the cache directory; engines on different
+# directories never see each other's entries.
+memory_cache = MemoryCache(
+    max_bytes=int(os.getenv("QUERY_CACHE_MEMORY_BYTES", DEFAULT_MEMORY_BYTES))
+)
+
+
+class FileLock:
+    """
+    Advisory lock on a file, honoured across processes.
+
+    Exclusive by default; shared=True lets any number of holders share it
+    while excluding exclusive ones. Uses flock(2), so it works for the
+    docker-compose services that share the .cache bind mount, and two
+    FileLocks on the same path exclude each other within a process too. On
+    platforms without fcntl it is a no-op.
+    """
+
+    def __init__(self, path: Path, shared: bool = False):
+        self._path = path
+        self._shared = shared
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """Take the lock. With blocking=False, return False instead of waiting."""
+        if fcntl is None:
+            return True
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        operation = fcntl.LOCK_SH if self._shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(fd, operation if blocking else operation | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def atomic_write(path: Path, write):
+    """
+    Atomically replace path with the content produced by write(tmp_path).
+
+    The content goes to a temp file in the same directory, is fsynced, and
+    is renamed over path, so readers see either the old file or the whole
+    new one, never a partial write.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp)
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class QueryCancelledError(RuntimeError):
+    """Raised by an execution that was stopped because every caller waiting on it was cancelled."""
+
+
+class QueryDeadlineExceeded(QueryCancelledError):
+    """Raised when a query would run, or wait, past the deadline of the current QueryPolicy."""
+
+
+@dataclass(frozen=True)
+class QueryPolicy:
+    """
+    How the execQuery calls made in the current context are served.
+
+    ttl_seconds, force_refresh and stale_while_revalidate are used whenever
+    execQuery is not given them explicitly. deadline is a time.monotonic()
+    value: past it, cache misses raise QueryDeadlineExceeded instead of
+    waiting on Athena, and an execution is stopped once every caller waiting
+    on it has given up. priority orders this context's stale-while-revalidate
+    refreshes on the shared refresher (higher first).
+    """
+
+    ttl_seconds: Optional[int] = 1800
+    force_refresh: bool = False
+    stale_while_revalidate: Optional[bool] = None
+    deadline: Optional[float] = None
+    priority: int = 0
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+_query_policy: ContextVar[QueryPolicy] = ContextVar("query_cache_policy", default=QueryPolicy())
+
+
+def current_policy() -> QueryPolicy:
+    return _query_policy.get()
+
+
+@contextmanager
+def query_policy(timeout: Optional[float] = None, **overrides):
+    """
+    Apply QueryPolicy overrides to every execQuery inside the block.
+
+    Overrides stack on the enclosing policy; timeout=seconds sets the
+    deadline relative to now. The policy is a context variable, so it
+    follows the caller into execQuery_async, contextvars.copy_context() and
+    asyncio tasks but never leaks into other threads or sessions.
+    """
+    if timeout is not None:
+        overrides["deadline"] = time.monotonic() + timeout
+    token = _query_policy.set(replace(_query_policy.get(), **overrides))
+    try:
+        yield _query_policy.get()
+    finally:
+        _query_policy.reset(token)
+
+
+# Set by execQuery_async around its worker thread: flips when the awaiting
+# task is cancelled. Blocking callers leave it unset and are never abandoned.
+_abandoned: ContextVar[Optional[threading.Event]] = ContextVar("query_cache_abandoned", default=None)
+_active_call: ContextVar[Optional["_Call"]] = ContextVar("query_cache_active_call", default=None)
+
+
+class _Waiter:
+    __slots__ = ("abandoned", "deadline")
+
+    def __init__(self, abandoned: Optional[threading.Event], deadline: Optional[float]):
+        self.abandoned = abandoned
+        self.deadline = deadline
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def gone(self) -> bool:
+        return (self.abandoned is not None and self.abandoned.is_set()) or self.expired()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # One _Waiter per caller, the leader first
+        self.waiters = []
+
+    def orphaned(self) -> bool:
+        """True once every caller waiting on this execution has been cancelled or passed its deadline."""
+        return all(w.gone() for w in self.waiters)
 
-        Args:
-            query: SQL query string
-            ttl_seconds: Cache TTL in seconds. None = cache forever. Default 30 min.
-            force_refresh: Ignore cache and re-query.
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into one execution.
+
+    The first caller for a key runs fn; callers arriving while it is still
+    running block until it finishes and receive the same result (or the
+    same exception). While fn runs, _active_call points at the shared call
+    so a long execution can stop early once all of its callers are gone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key: str, fn):
+        """
+        Run fn once per in-flight key.
 
         Returns:
-            pandas DataFrame with query results
+            (result, shared) where shared is True for callers that waited on
+            another caller's execution.
         """
-        cache_key = self._hash_query(query)
-        cache_file = self._cache_dir / f"{cache_key}.parquet"
-        meta_file = self._cache_dir / f"{cache_key}.meta"
+        waiter = _Waiter(_abandoned.get(), current_policy().deadline)
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            call.waiters.append(waiter)
 
-        if not force_refresh and self._is_cache_valid(cache_file, meta_file, ttl_seconds):
-            return pd.read_parquet(cache_file)
+        if not leader:
+            timeout = None if waiter.deadline is None else max(0.0, waiter.deadline - time.monotonic())
+            if not call.done.wait(timeout):
+                raise QueryDeadlineExceeded(f"Gave up waiting on an in-flight query for {key}")
+            if call.error is not None:
+                if isinstance(call.error, QueryCancelledError) and not waiter.gone():
+                    # Joined just as the other callers gave up; run it ourselves
+                    return self.do(key, fn)
+                raise call.error
+            return call.result, True
 
-        # Execute query
-        result = self._needle.execQuery(query)
+        token = _active_call.set(call)
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            _active_call.reset(token)
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
 
-        # Cache result
-        self._save_cache(result, cache_file, meta_file, ttl_seconds)
 
-        return result
+# Keyed like the memory tier, so concurrent requests for the same result share
+# one backend call whichever engine instance they go through.
+inflight = SingleFlight()
 
-    def _hash_query(self, query: str) -> str:
-        """Generate a stable hash for the query string."""
-        # Normalize whitespace for consistent hashing
-        normalized = " ".join(query.split())
-        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
 
-    def _is_cache_valid(
-        self, cache_file: Path, meta_file: Path, ttl_seconds: Optional[int]
-    ) -> bool:
-        """Check if a cached result exists and is still valid."""
-        if not cache_file.exists() or not meta_file.exists():
-            return False
+_status_log: ContextVar[Optional[list]] = ContextVar("query_cache_status_log", default=None)
+
 
+@contextmanager
+def record_cache_status():
+    """Collect the cache_status of every execQuery made inside the block."""
+    log = []
+    token = _status_log.set(log)
+    try:
+        yield log
+    finally:
+        _status_log.reset(token)
+
+
+def _with_status(df: pd.DataFrame, status: str) -> pd.DataFrame:
+    df.attrs["cache_status"] = status
+    log = _status_log.get()
+    if log is not None:
+        log.append(status)
+    return df
+
+
+class BackgroundRefresher:
+    """
+    Runs stale-while-revalidate refreshes on a small worker pool.
+
+    A key is queued at most once until its refresh finishes, however many
+    stale reads hit it in the meantime. Queued refreshes run highest
+    priority first, then in submission order.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-cache-refresh")
+        self._pending = set()
+        self._queue = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, fn, priority: int = 0):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            heapq.heappush(self._queue, (-priority, next(self._seq), key, fn))
+        # One task per queued refresh; each runs whichever refresh is first in line
+        self._executor.submit(self._run_next)
+
+    def _run_next(self):
+        with self._lock:
+            _, _, key, fn = heapq.heappop(self._queue)
         try:
-            with open(meta_file, "r") as f:
-                meta = json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return False
+            fn()
+        except Exception:
+            logger.exception("Background refresh failed for %s", key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+
+# One pool for the process, so a burst of stale reads queues its refreshes
+# (once per key) instead of starting a thread per read.
+refresher = BackgroundRefresher()
+
+
+# Upper bounds (seconds) of the latency histogram buckets. Memory hits land in
+# the first few, Athena round trips in the last.
+LATENCY_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.25, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Back-off between Athena status polls.
+POLL_INITIAL_SECONDS = 0.1
+POLL_MAX_SECONDS = 2.0
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total = 0
+        out = []
+        for bound, n in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += n
+            out.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return out
+
+
+class MetricsRegistry:
+    """
+    In-process counters and latency histograms for the query cache.
+
+    Series are keyed by metric name plus labels (caller, backend, outcome).
+    Export with to_prometheus() for scraping or snapshot() for JSON; summary()
+    rolls the series up into one row per caller for the notebooks.
+    """
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram(self._buckets)
+            hist.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """JSON-serialisable copy of every series."""
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": hist.count,
+                    "sum": hist.sum,
+                    "buckets": dict(hist.cumulative()),
+                }
+                for (name, labels), hist in sorted(self._histograms.items(), key=lambda item: item[0])
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+    def to_prometheus(self) -> str:
+        """Prometheus text exposition format."""
+        snap = self.snapshot()
+        lines = []
+        typed = set()
+        for series in snap["counters"]:
+            if series["name"] not in typed:
+                lines.append(f"# TYPE {series['name']} counter")
+                typed.add(series["name"])
+            lines.append(f"{series['name']}{_prometheus_labels(series['labels'])} {series['value']}")
+        for series in snap["histograms"]:
+            name = series["name"]
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in series["buckets"].items():
+                lines.append(f"{name}_bucket{_prometheus_labels(dict(series['labels'], le=bound))} {count}")
+            lines.append(f"{name}_sum{_prometheus_labels(series['labels'])} {series['sum']}")
+            lines.append(f"{name}_count{_prometheus_labels(series['labels'])} {series['count']}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> pd.DataFrame:
+        """One row per (caller, backend): requests, hit ratio, latency, Athena time and bytes scanned."""
+        rows = {}
+
+        def row(labels):
+            key = (labels.get("caller"), labels.get("backend"))
+            if key not in rows:
+                rows[key] = {
+                    "caller": key[0],
+                    "backend": key[1],
+                    "requests": 0,
+                    "hits": 0,
+                    "seconds": 0.0,
+                    "athena_queries": 0,
+                    "athena_seconds": 0.0,
+                    "bytes_scanned": 0,
+                }
+            return rows[key]
+
+        snap = self.snapshot()
+        for series in snap["counters"]:
+            labels = series["labels"]
+            if series["name"] == "query_cache_requests_total":
+                row(labels)["requests"] += series["value"]
+                if labels.get("outcome") in ("memory_hit", "disk_hit", "range_hit", "stale_hit"):
+                    row(labels)["hits"] += series["value"]
+            elif series["name"] == "athena_bytes_scanned_total":
+                row(labels)["bytes_scanned"] += series["value"]
+        for series in snap["histograms"]:
+            if series["name"] == "query_cache_request_seconds":
+                row(series["labels"])["seconds"] += series["sum"]
+            elif series["name"] == "athena_query_seconds":
+                row(series["labels"])["athena_queries"] += series["count"]
+                row(series["labels"])["athena_seconds"] += series["sum"]
+
+        frame = pd.DataFrame(list(rows.values()))
+        if frame.empty:
+            return frame
+        frame["hit_ratio"] = frame["hits"] / frame["requests"].where(frame["requests"] > 0)
+        return frame.sort_values("seconds", ascending=False).reset_index(drop=True)
+
+
+def _prometheus_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+# Process-wide series: the engines, backends and stage metric pool all record
+# here, so one to_prometheus() or summary() covers every caller.
+metrics = MetricsRegistry()
+
+
+_caller_override: ContextVar[Optional[str]] = ContextVar("query_cache_caller", default=None)
+
+
+def _caller_name() -> str:
+    """Name of the first function on the stack outside this module (e.g. calculate_daily_wear)."""
+    override = _caller_override.get()
+    if override is not None:
+        return override
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+
+def _record_request(caller: str, backend: str, outcome: str, started: float):
+    metrics.inc("query_cache_requests_total", caller=caller, backend=backend, outcome=outcome)
+    metrics.observe(
+        "query_cache_request_seconds", time.perf_counter() - started, caller=caller, backend=backend, outcome=outcome
+    )
+
+
+# Members of sensorfabric that are not part of its documented API, used by
+# _run_athena and NeedleBackend. Checked against the pinned
+# sensorfabric==3.3.2 (requirements.txt); re-check them when bumping it.
+_ATHENA_INTERNALS = ("client", "startQueryExec", "queryResults")
+
+
+def _require_internals(obj, names: Sequence[str]):
+    missing = [name for name in names if not hasattr(obj, name)]
+    if missing:
+        raise RuntimeError(
+            f"{type(obj).__module__}.{type(obj).__name__} has no {', '.join(missing)}: query_cache relies on "
+            "these undocumented sensorfabric members and was written against sensorfabric==3.3.2"
+        )
+
+
+def _run_athena(db: "athena", query: str, caller: str, backend: str) -> pd.DataFrame:
+    """
+    Execute a query on a sensorfabric athena connector and record its cost.
+
+    Same steps as athena.execQuery, but backs off between status polls
+    instead of spinning, and keeps the execution's Statistics so wall time
+    and DataScannedInBytes can be attributed to the caller. The execution
+    is stopped if every execQuery_async waiting on it is cancelled.
+    """
+    _require_internals(db, _ATHENA_INTERNALS)
+    started = time.perf_counter()
+    call = _active_call.get()
+    execution_id = db.startQueryExec(query)
+    delay = POLL_INITIAL_SECONDS
+    while True:
+        execution = db.client.get_query_execution(QueryExecutionId=execution_id)["QueryExecution"]
+        state = execution["Status"]["State"]
+        if state in ("SUCCEEDED", "FAILED", "CANCELLED"):
+            break
+        if call is not None and call.orphaned():
+            db.client.stop_query_execution(QueryExecutionId=execution_id)
+            metrics.inc("athena_queries_total", caller=caller, backend=backend, state="stopped")
+            if call.waiters[0].expired():
+                raise QueryDeadlineExceeded(f"Athena query {execution_id} stopped: deadline passed")
+            raise QueryCancelledError(f"Athena query {execution_id} stopped: no callers left")
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_SECONDS)
+
+    statistics = execution.get("Statistics", {})
+    metrics.inc("athena_queries_total", caller=caller, backend=backend, state=state.lower())
+    metrics.inc("athena_bytes_scanned_total", statistics.get("DataScannedInBytes", 0), caller=caller, backend=backend)
+    if state != "SUCCEEDED":
+        reason = execution["Status"].get("StateChangeReason", "")
+        raise RuntimeError(f"Athena query {execution_id} {state}: {reason}")
+
+    frame, next_token = _query_page(db, execution_id, None, [])
+    while next_token:
+        page, next_token = _query_page(db, execution_id, next_token, frame.columns)
+        frame = pd.concat([frame, page])
+    metrics.observe("athena_query_seconds", time.perf_counter() - started, caller=caller, backend=backend)
+    return frame
+
+
+def _query_page(db: "athena", execution_id: str, next_token, column_names):
+    # queryResults returns a bare empty frame (no token) when a page has no rows
+    page = db.queryResults(execution_id, nextToken=next_token, columnNames=column_names)
+    if isinstance(page, pd.DataFrame):
+        return page, None
+    return page
+
+
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def set_max_concurrency(limit: int):
+    """Change how many execQuery_async calls may run at once on each event loop."""
+    global MAX_CONCURRENCY
+    MAX_CONCURRENCY = limit
+    _semaphores.clear()
+
+
+def _concurrency_limit() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENCY)
+    return semaphore
+
+
+async def _exec_async(exec_query, *args) -> pd.DataFrame:
+    """
+    Run a blocking execQuery on a worker thread under the concurrency limit.
+
+    The slot is held until the worker thread returns, not until the awaiting
+    task does: a cancelled call marks its query abandoned and re-raises at
+    once, but the thread (e.g. a Needle query, which can't be stopped) keeps
+    counting against MAX_CONCURRENCY until it finishes.
+    """
+    caller = _caller_name()
+    abandoned = threading.Event()
+    limit = _concurrency_limit()
+    await limit.acquire()
+    # The task copies the context when created, so both reach the worker
+    abandoned_token = _abandoned.set(abandoned)
+    caller_token = _caller_override.set(caller)
+    try:
+        worker = asyncio.ensure_future(asyncio.to_thread(exec_query, *args))
+    except BaseException:
+        limit.release()
+        raise
+    finally:
+        _caller_override.reset(caller_token)
+        _abandoned.reset(abandoned_token)
+    worker.add_done_callback(_release_when_done(limit))
+    try:
+        return await asyncio.shield(worker)
+    except asyncio.CancelledError:
+        abandoned.set()
+        raise
+
+
+def _release_when_done(limit: asyncio.Semaphore):
+    def release(worker: asyncio.Future):
+        limit.release()
+        # Retrieve the outcome so an abandoned query's error isn't reported
+        # as "never retrieved"
+        if not worker.cancelled():
+            worker.exception()
+
+    return release
+
+
+def _project(df: pd.DataFrame, columns: Optional[Sequence[str]]) -> pd.DataFrame:
+    """Select columns, leaving column-less (empty) Athena results untouched."""
+    if columns is None or len(df.columns) == 0:
+        return df
+    return df[list(columns)]
+
+
+def _projection_key(memory_key: str, columns: Optional[Sequence[str]]) -> str:
+    if columns is None:
+        return memory_key
+    return f"{memory_key}[{','.join(columns)}]"
+
+
+def _lookup_memory(memory: "MemoryCache", memory_key: str, columns: Optional[Sequence[str]]) -> Optional[pd.DataFrame]:
+    """Serve from the full cached frame if present, else from a cached projection."""
+    cached = memory.get(memory_key)
+    if cached is not None:
+        return _project(cached, columns)
+    if columns is not None:
+        return memory.get(_projection_key(memory_key, columns))
+    return None
+
+
+def _write_arrow(df: pd.DataFrame, path):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _read_arrow(path: Path, columns: Optional[Sequence[str]]) -> pd.DataFrame:
+    # Buffers keep the mapping alive for as long as the table references them
+    table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    if columns is not None and table.num_columns:
+        table = table.select(list(columns))
+    return table.to_pandas()
 
-        # If ttl is None in meta, it's cached forever
-        cached_ttl = meta.get("ttl_seconds")
-        if cached_ttl is None:
-            return True
 
-        # Check expiry
-        cached_at = meta.get("cached_at", 0)
-        elapsed = time.time() - cached_at
-        return elapsed < cached_ttl
+def _read_parquet(path: Path, columns: Optional[Sequence[str]]) -> pd.DataFrame:
+    parquet = pq.ParquetFile(path)
+    if columns is not None and not parquet.schema_arrow.names:
+        columns = None
+    return parquet.read(columns=list(columns) if columns is not None else None, use_pandas_metadata=True).to_pandas()
 
-    def _save_cache(
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """One cached query result as recorded in the manifest."""
+
+    key: str
+    path: str
+    cached_at: float
+    ttl_seconds: Optional[int]
+    rows: int
+    bytes: int
+    sql_template: Optional[str]
+    hits: int = 0
+    last_access: Optional[float] = None
+    range_family: Optional[str] = None
+    range_lo: Optional[int] = None
+    range_hi: Optional[int] = None
+
+    @property
+    def expires_at(self) -> Optional[float]:
+        if self.ttl_seconds is None:
+            return None
+        return self.cached_at + self.ttl_seconds
+
+
+class CacheManifest:
+    """
+    SQLite (WAL mode) index of the entries in a query cache directory.
+
+    One connection is kept per thread; WAL lets readers in every process
+    proceed while a writer commits.
+    """
+
+    _COLUMNS = (
+        "key, path, cached_at, ttl_seconds, rows, bytes, sql_template, hits, last_access,"
+        " range_family, range_lo, range_hi"
+    )
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    cached_at REAL NOT NULL,
+                    ttl_seconds INTEGER,
+                    expires_at REAL,
+                    rows INTEGER NOT NULL DEFAULT 0,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    sql_template TEXT
+                );
+                CREATE INDEX IF NOT EXISTS entries_expires_at ON entries (expires_at);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                );
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(entries)")}
+            if "hits" not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN hits INTEGER NOT NULL DEFAULT 0")
+            if "last_access" not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN last_access REAL")
+            if "range_family" not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN range_family TEXT")
+                conn.execute("ALTER TABLE entries ADD COLUMN range_lo INTEGER")
+                conn.execute("ALTER TABLE entries ADD COLUMN range_hi INTEGER")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_range_family ON entries (range_family)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[ManifestEntry]:
+        row = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def get_valid(self, key: str, now: float) -> Optional[ManifestEntry]:
+        """Return the entry for key if it exists and has not expired."""
+        row = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM entries"
+            " WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now),
+        ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def put(self, entry: ManifestEntry):
+        """Insert or refresh an entry. Hit counts survive a refresh."""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO entries"
+                " (key, path, cached_at, ttl_seconds, rows, bytes, sql_template, expires_at, last_access,"
+                " range_family, range_lo, range_hi)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(key) DO UPDATE SET path = excluded.path, cached_at = excluded.cached_at,"
+                " ttl_seconds = excluded.ttl_seconds, rows = excluded.rows, bytes = excluded.bytes,"
+                " sql_template = excluded.sql_template, expires_at = excluded.expires_at,"
+                " last_access = excluded.last_access, range_family = excluded.range_family,"
+                " range_lo = excluded.range_lo, range_hi = excluded.range_hi",
+                (
+                    entry.key,
+                    entry.path,
+                    entry.cached_at,
+                    entry.ttl_seconds,
+                    entry.rows,
+                    entry.bytes,
+                    entry.sql_template,
+                    entry.expires_at,
+                    entry.cached_at,
+                    entry.range_family,
+                    entry.range_lo,
+                    entry.range_hi,
+                ),
+            )
+
+    def covering(self, family: str, lo: int, hi: int, now: float) -> Optional[ManifestEntry]:
+        """The narrowest valid entry of a range family whose range contains [lo, hi]."""
+        row = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM entries"
+            " WHERE range_family = ? AND range_lo <= ? AND range_hi >= ?"
+            " AND (expires_at IS NULL OR expires_at > ?)"
+            " ORDER BY range_hi - range_lo LIMIT 1",
+            (family, lo, hi, now),
+        ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def touch(self, key: str, now: float, counter: str = "disk_hits"):
+        """Record a read of key for LRU/LFU bookkeeping and bump counter."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE entries SET hits = hits + 1, last_access = ? WHERE key = ?",
+                (now, key),
+            )
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (counter,),
+            )
+
+    def delete(self, key: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def delete_unchanged(self, entry: ManifestEntry) -> bool:
+        """Delete entry's row unless it has been rewritten since entry was read."""
+        with self._connect() as conn:
+            deleted = conn.execute(
+                "DELETE FROM entries WHERE key = ? AND cached_at = ? AND path = ?",
+                (entry.key, entry.cached_at, entry.path),
+            )
+        return deleted.rowcount > 0
+
+    def total_bytes(self) -> int:
+        return self._connect().execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+
+    def eviction_candidates(self, policy: str) -> List[ManifestEntry]:
+        """All entries, in the order they should be evicted under policy."""
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{policy}'. Expected one of {EVICTION_POLICIES}.")
+        order = "COALESCE(last_access, cached_at)"
+        if policy == "lfu":
+            order = f"hits, {order}"
+        rows = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM entries ORDER BY {order}"
+        ).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def increment(self, name: str, amount: int = 1):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount),
+            )
+
+    def counters(self) -> dict:
+        return dict(self._connect().execute("SELECT name, value FROM counters").fetchall())
+
+    def entries(self) -> List[ManifestEntry]:
+        rows = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM entries ORDER BY cached_at"
+        ).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def expired(self, now: float) -> List[ManifestEntry]:
+        rows = self._connect().execute(
+            f"SELECT {self._COLUMNS} FROM entries WHERE expires_at <= ?", (now,)
+        ).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def stats(self, now: float) -> dict:
+        entries, total_bytes, total_rows, expired = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(rows), 0),"
+            " COALESCE(SUM(expires_at <= ?), 0) FROM entries",
+            (now,),
+        ).fetchone()
+        return {
+            "entries": entries,
+            "bytes": total_bytes,
+            "rows": total_rows,
+            "expired": expired,
+        }
+
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def _sql_template(normalized_query: str) -> str:
+    """Strip literals so queries from the same calculate_* function group together."""
+    return _LITERAL_RE.sub("?", normalized_query)
+
+
+# Result column that week_range slices on.
+RANGE_COLUMN = "week"
+
+
+def _range_family(normalized_query: str, lo: int, hi: int) -> str:
+    """
+    Hash of the query with its week bounds replaced by placeholders.
+
+    Two queries share a family when they differ only in those bounds, e.g.
+    calculate_daily_symptoms for one participant over W9-19 and W9-40.
+    Numbers inside string literals (dates, ids) are left alone. A
+    single-week range (lo == hi) templates its first bound as {lo} and the
+    rest as {hi}, so W15-15 falls in the same family as W9-40.
+    """
+    pattern = re.compile(r"'(?:[^']|'')*'|\b(?:%s|%s)\b" % (re.escape(str(lo)), re.escape(str(hi))))
+    seen_lo = False
+
+    def placeholder(match):
+        nonlocal seen_lo
+        value = match.group(0)
+        if value == str(lo) and not (seen_lo and lo == hi):
+            seen_lo = True
+            return "{lo}"
+        return "{hi}" if value == str(hi) else value
+
+    templated = pattern.sub(placeholder, normalized_query)
+    return hashlib.sha256(templated.encode("utf-8")).hexdigest()[:16]
+
+
+def _slice_range(df: pd.DataFrame, lo: int, hi: int, columns: Optional[Sequence[str]]) -> pd.DataFrame:
+    """Rows of a superset result whose week falls in [lo, hi], as if queried directly."""
+    if len(df.columns) == 0:
+        return df
+    weeks = pd.to_numeric(df[RANGE_COLUMN])
+    return _project(df[weeks.between(lo, hi)].reset_index(drop=True), columns)
+
+
+class QueryStore:
+    """
+    Disk tier of the query cache: sharded parquet files plus a manifest.
+
+    One store is shared per cache directory within a process, so
+    CachedNeedle and CachedAthena pointed at the same directory share a
+    manifest connection pool.
+
+    The directory is kept under max_bytes by evicting least recently
+    ("lru") or least frequently ("lfu") read entries after each write.
+    Readers hold a shared lock on the entry's pin file, writers its key
+    lock; eviction skips an entry unless it gets both exclusively without
+    waiting, so an entry being read or written by any process sharing the
+    directory is never evicted.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_dir(cls, cache_dir: Path) -> "QueryStore":
+        key = str(Path(cache_dir).resolve())
+        with cls._instances_lock:
+            store = cls._instances.get(key)
+            if store is None:
+                store = cls._instances[key] = cls(Path(cache_dir))
+        return store
+
+    def __init__(
         self,
+        cache_dir: Path,
+        max_bytes: Optional[int] = None,
+        policy: Optional[str] = None,
+        storage_format: Optional[str] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("QUERY_CACHE_MAX_BYTES", DEFAULT_DISK_BYTES))
+        self.policy = policy or os.getenv("QUERY_CACHE_EVICTION", "lru")
+        if self.policy not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy '{self.policy}'. Expected one of {EVICTION_POLICIES}.")
+        self.storage_format = storage_format or os.getenv("QUERY_CACHE_FORMAT", "parquet")
+        if self.storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unknown storage format '{self.storage_format}'. Expected one of {STORAGE_FORMATS}.")
+        self.manifest = CacheManifest(cache_dir / MANIFEST_NAME)
+        self._migrate_legacy()
+
+    def path_for(self, key: str, storage_format: str = "parquet") -> Path:
+        return self.cache_dir / key[:2] / f"{key}.{storage_format}"
+
+    def memory_key(self, key: str) -> str:
+        """Key for the in-memory tier; independent of the on-disk format."""
+        return str(self.cache_dir / key)
+
+    def lock(self, key: str) -> FileLock:
+        return FileLock(self.cache_dir / "locks" / key[:2] / f"{key}.lock")
+
+    def pin(self, key: str, shared: bool = True) -> FileLock:
+        """Lock held shared by readers of key's file and exclusively by eviction."""
+        return FileLock(self.cache_dir / "locks" / key[:2] / f"{key}.pin", shared)
+
+    def lookup(self, key: str) -> Optional[ManifestEntry]:
+        """Return the manifest entry if a valid cached result exists."""
+        return self.manifest.get_valid(key, time.time())
+
+    def lookup_covering(self, family: str, lo: int, hi: int) -> Optional[ManifestEntry]:
+        """Return a valid entry of the range family whose range contains [lo, hi]."""
+        return self.manifest.covering(family, lo, hi, time.time())
+
+    def lookup_stale(self, key: str, grace_seconds: int) -> Optional[ManifestEntry]:
+        """Return an expired entry that is still within grace_seconds of its expiry."""
+        entry = self.manifest.get(key)
+        if entry is None or entry.expires_at is None:
+            return None
+        return entry if time.time() < entry.expires_at + grace_seconds else None
+
+    def read(
+        self,
+        entry: ManifestEntry,
+        counter: str = "disk_hits",
+        columns: Optional[Sequence[str]] = None,
+    ) -> Optional[pd.DataFrame]:
+        """
+        Load a cached result, pinning it against eviction while it is read.
+
+        Arrow entries are memory-mapped; with columns, only those columns
+        are decoded.
+
+        Returns None (and drops the manifest row) if the file has vanished,
+        e.g. because another process evicted it after the lookup, or if it
+        cannot be decoded, in which case the corrupt file is removed too.
+        """
+        with self.pin(entry.key):
+            try:
+                path = self.cache_dir / entry.path
+                if path.suffix == ".arrow":
+                    df = _read_arrow(path, columns)
+                else:
+                    df = _read_parquet(path, columns)
+            except FileNotFoundError:
+                self.manifest.delete(entry.key)
+                return None
+            except Exception:
+                logger.warning("Dropping unreadable cache entry %s", entry.path, exc_info=True)
+                self._heal(entry)
+                return None
+        self.manifest.touch(entry.key, time.time(), counter)
+        return df
+
+    def write(
+        self,
+        key: str,
         df: pd.DataFrame,
-        cache_file: Path,
-        meta_file: Path,
         ttl_seconds: Optional[int],
+        sql_template: Optional[str] = None,
+        key_range: Optional[Tuple[str, int, int]] = None,
     ):
-        """Save query result and metadata to cache."""
+        """
+        Save a query result and record it in the manifest.
+
+        key_range=(family, lo, hi) lets later queries of the same family for
+        a sub-range be served from this entry.
+
+        Callers must hold lock(key). The file is committed atomically before
+        its manifest row, so a crash never leaves a row pointing at a
+        partial file.
+        """
         try:
-            df.to_parquet(cache_file, index=False)
-            meta = {
-                "cached_at": time.time(),
-                "ttl_seconds": ttl_seconds,
-                "rows": len(df),
-            }
-            with open(meta_file, "w") as f:
-                json.dump(meta, f)
+            cache_file = self.path_for(key, self.storage_format)
+            if self.storage_format == "arrow":
+                atomic_write(cache_file, lambda tmp: _write_arrow(df, tmp))
+            else:
+                atomic_write(cache_file, lambda tmp: df.to_parquet(tmp, index=False))
+            previous = self.manifest.get(key)
+            self.manifest.put(
+                ManifestEntry(
+                    key=key,
+                    path=str(cache_file.relative_to(self.cache_dir)),
+                    cached_at=time.time(),
+                    ttl_seconds=ttl_seconds,
+                    rows=len(df),
+                    bytes=cache_file.stat().st_size,
+                    sql_template=sql_template,
+                    range_family=key_range[0] if key_range else None,
+                    range_lo=key_range[1] if key_range else None,
+                    range_hi=key_range[2] if key_range else None,
+                )
+            )
+            if previous is not None and previous.path != str(cache_file.relative_to(self.cache_dir)):
+                # Storage format changed; drop the file of the old format
+                (self.cache_dir / previous.path).unlink(missing_ok=True)
+            self.manifest.increment("misses")
+            if self.manifest.total_bytes() > self.max_bytes:
+                self.evict()
         except Exception:
             # Don't fail the query if caching fails
-            pass
+            logger.warning("Failed to cache query result %s", key, exc_info=True)
 
+    def remove(self, key: str) -> int:
+        """Delete an entry and its file. Returns the bytes reclaimed."""
+        entry = self.manifest.get(key)
+        if entry is None:
+            return 0
+        self.manifest.delete(key)
+        try:
+            (self.cache_dir / entry.path).unlink()
+        except FileNotFoundError:
+            return 0
+        return entry.bytes
 
-class CachedAthena:
+    def evict(
+        self,
+        max_bytes: Optional[int] = None,
+        policy: Optional[str] = None,
+        expired_grace_seconds: Optional[int] = None,
+    ) -> dict:
+        """
+        Drop expired entries, then evict by policy until under max_bytes.
+
+        Args:
+            max_bytes: Byte budget. None = the store's budget.
+            policy: "lru" or "lfu". None = the store's policy.
+            expired_grace_seconds: Keep expired entries this long past their
+                TTL so stale-while-revalidate can still serve them.
+
+        Returns:
+            dict with the number of evicted entries and reclaimed bytes.
+        """
+        budget = self.max_bytes if max_bytes is None else max_bytes
+        grace = STALE_GRACE_SECONDS if expired_grace_seconds is None else expired_grace_seconds
+        evicted = 0
+        reclaimed = 0
+
+        for entry in self.manifest.expired(time.time() - grace):
+            freed = self._evict_entry(entry)
+            if freed is not None:
+                evicted += 1
+                reclaimed += freed
+
+        total = self.manifest.total_bytes()
+        if total > budget:
+            for entry in self.manifest.eviction_candidates(policy or self.policy):
+                if total <= budget:
+                    break
+                freed = self._evict_entry(entry)
+                if freed is not None:
+                    evicted += 1
+                    reclaimed += freed
+                    total -= entry.bytes
+
+        if evicted:
+            self.manifest.increment("evictions", evicted)
+            self.manifest.increment("reclaimed_bytes", reclaimed)
+        return {"evicted": evicted, "reclaimed_bytes": reclaimed}
+
+    def entries(self) -> List[ManifestEntry]:
+        return self.manifest.entries()
+
+    def stats(self) -> dict:
+        stats = self.manifest.stats(time.time())
+        stats["max_bytes"] = self.max_bytes
+        stats["policy"] = self.policy
+        stats.update(self.manifest.counters())
+        return stats
+
+    def remove_orphans(self, older_than_seconds: int = 3600) -> int:
+        """Delete temp files left behind by writers that crashed. Returns bytes reclaimed."""
+        cutoff = time.time() - older_than_seconds
+        reclaimed = 0
+        for tmp in self.cache_dir.glob("*/.*.tmp"):
+            try:
+                st = tmp.stat()
+                if st.st_mtime < cutoff:
+                    tmp.unlink()
+                    reclaimed += st.st_size
+            except FileNotFoundError:
+                continue
+        return reclaimed
+
+    def _heal(self, entry: ManifestEntry):
+        """Remove a corrupt entry so the next lookup is a clean miss."""
+        lock = self.lock(entry.key)
+        if not lock.acquire(blocking=False):
+            # A writer is replacing it right now
+            return
+        try:
+            current = self.manifest.get(entry.key)
+            if current is not None and current.cached_at == entry.cached_at:
+                self.remove(entry.key)
+                self.manifest.increment("corrupt")
+        finally:
+            lock.release()
+
+    def _evict_entry(self, entry: ManifestEntry) -> Optional[int]:
+        """Remove entry unless it is being read or written. Returns bytes freed, or None if skipped."""
+        lock = self.lock(entry.key)
+        if not lock.acquire(blocking=False):
+            return None
+        pin = self.pin(entry.key, shared=False)
+        try:
+            if not pin.acquire(blocking=False):
+                return None
+            # A writer may have replaced the entry since it was listed
+            if not self.manifest.delete_unchanged(entry):
+                return None
+            try:
+                (self.cache_dir / entry.path).unlink()
+            except FileNotFoundError:
+                return 0
+            return entry.bytes
+        finally:
+            pin.release()
+            lock.release()
+
+    def _migrate_legacy(self):
+        """Move flat {hash}.parquet + {hash}.meta pairs into the manifest and sharded layout."""
+        legacy = list(self.cache_dir.glob("*.meta"))
+        if not legacy:
+            return
+        with FileLock(self.cache_dir / "locks" / "migrate.lock"):
+            for meta_file in legacy:
+                key = meta_file.stem
+                cache_file = self.cache_dir / f"{key}.parquet"
+                try:
+                    with open(meta_file, "r") as f:
+                        meta = json.load(f)
+                    if cache_file.exists():
+                        target = self.path_for(key)
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        os.replace(cache_file, target)
+                        self.manifest.put(
+                            ManifestEntry(
+                                key=key,
+                                path=str(target.relative_to(self.cache_dir)),
+                                cached_at=meta.get("cached_at", 0),
+                                ttl_seconds=meta.get("ttl_seconds"),
+                                rows=meta.get("rows", 0),
+                                bytes=target.stat().st_size,
+                                sql_template=None,
+                            )
+                        )
+                    meta_file.unlink()
+                except (FileNotFoundError, json.JSONDecodeError):
+                    # Already migrated by another process, or an unreadable meta
+                    continue
+
+
+class QueryBackend(Protocol):
     """
-    Wrapper around sensorfabric.athena that caches query results to disk.
+    Executes SQL for a CachedQueryEngine.
 
-    Same interface as CachedNeedle but for direct AWS Athena connections.
+    Results must look like sensorfabric's: a DataFrame whose values are
+    strings (or None), as Athena returns them.
     """
 
+    name: str
+
+    def execute(self, query: str, caller: str) -> pd.DataFrame: ...
+
+
+class NeedleBackend:
+    """sensorfabric.Needle (MyDataHelps or AWS) connection."""
+
+    def __init__(self, method: str = "mdh"):
+        from sensorfabric.needle import Needle
+
+        self.needle = Needle(method=method)
+        # Needle._testAndRequestNew is private too (see _ATHENA_INTERNALS)
+        _require_internals(self.needle, ("_testAndRequestNew", "db"))
+        self.name = method
+
+    def execute(self, query: str, caller: str) -> pd.DataFrame:
+        # Same credential refresh Needle.execQuery does before querying
+        self.needle._testAndRequestNew()
+        return _run_athena(self.needle.db, query, caller, self.name)
+
+
+class AthenaBackend:
+    """Direct sensorfabric.athena connection."""
+
     def __init__(
         self,
         profile_name: Optional[str] = None,
         database: Optional[str] = None,
         s3_location: Optional[str] = None,
         workgroup: Optional[str] = None,
-        cache_dir: Optional[Path] = None,
     ):
-        self._athena = athena(
+        from sensorfabric.athena import athena
+
+        self.athena = athena(
             profile_name=profile_name,
             database=database,
             s3_location=s3_location,
             workgroup=workgroup,
             offlineCache=False,
         )
-        self._cache_dir = cache_dir or CACHE_DIR
-        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self.name = "aws"
+
+    def execute(self, query: str, caller: str) -> pd.DataFrame:
+        return _run_athena(self.athena, query, caller, self.name)
+
+
+# Trino functions used by the notebooks' SQL that DuckDB lacks or spells
+# differently. Only the forms the queries actually use are covered.
+_DUCKDB_MACROS = (
+    "CREATE MACRO json_extract_scalar(j, p) AS json_extract_string(j, p)",
+    "CREATE MACRO date_parse(s, f) AS strptime(s, f)",
+    "CREATE MACRO date_add(unit, n, d) AS d + to_days(CAST(n AS INTEGER))",
+    # Wall-clock time in the string's own offset, which is what Trino's date cast sees
+    "CREATE MACRO from_iso8601_timestamp(s) AS CAST(substr(s, 1, 19) AS TIMESTAMP)",
+    "CREATE MACRO sequence(lo, hi) AS generate_series(lo, hi), (lo, hi, step) AS generate_series(lo, hi, step)",
+)
+
+
+class LocalBackend:
+    """
+    Runs the same SQL against local parquet fixtures through DuckDB.
+
+    Every {table}.parquet file (or {table}/ directory of parquet files) in
+    fixtures_dir becomes a view of that name. Trino-only functions are
+    provided as macros and integer division follows Trino, so the
+    stage_calculation queries run unchanged. Values are returned as
+    Athena-formatted strings. Requires the optional duckdb package.
+    """
+
+    def __init__(self, fixtures_dir: Path, name: str = "local"):
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError("LocalBackend requires duckdb (pip install duckdb)") from e
+
+        self.name = name
+        self._con = duckdb.connect()
+        self._con.execute("SET GLOBAL integer_division = true")
+        for macro in _DUCKDB_MACROS:
+            self._con.execute(macro)
+        for path in sorted(Path(fixtures_dir).iterdir()):
+            if path.suffix == ".parquet":
+                source = str(path)
+            elif path.is_dir():
+                source = str(path / "**" / "*.parquet")
+            else:
+                continue
+            self._con.execute(f"CREATE VIEW \"{path.stem}\" AS SELECT * FROM read_parquet('{source}')")
+
+    def execute(self, query: str, caller: str) -> pd.DataFrame:
+        started = time.perf_counter()
+        # One cursor per call: a DuckDB connection can't be shared across threads
+        cursor = self._con.cursor()
+        try:
+            table = cursor.execute(query).fetch_arrow_table()
+        finally:
+            cursor.close()
+        metrics.inc("athena_queries_total", caller=caller, backend=self.name, state="succeeded")
+        metrics.observe("athena_query_seconds", time.perf_counter() - started, caller=caller, backend=self.name)
+        return pd.DataFrame({name: [_athena_string(v) for v in table.column(name).to_pylist()] for name in table.column_names})
+
+
+def _athena_string(value) -> Optional[str]:
+    """Format a value the way Athena's VarCharValue does."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+class CachedQueryEngine:
+    """
+    Caches the results of a QueryBackend to disk.
+
+    Cache files are stored as parquet (or Arrow IPC) under
+    .cache/queries/{hash[:2]}/ and tracked in the directory's manifest
+    (TTL, timestamp, rows, size). Hits are promoted into the process-wide
+    MemoryCache.
+    """
+
+    def __init__(
+        self,
+        backend: QueryBackend,
+        cache_dir: Optional[Path] = None,
+        memory: Optional[MemoryCache] = None,
+        stale_while_revalidate: Optional[bool] = None,
+        stale_grace_seconds: Optional[int] = None,
+    ):
+        self._backend = backend
+        self._store = QueryStore.for_dir(cache_dir or CACHE_DIR)
+        self._memory = memory if memory is not None else memory_cache
+        self._stale_while_revalidate = STALE_WHILE_REVALIDATE if stale_while_revalidate is None else stale_while_revalidate
+        self._stale_grace_seconds = STALE_GRACE_SECONDS if stale_grace_seconds is None else stale_grace_seconds
+
+    @property
+    def backend(self) -> QueryBackend:
+        return self._backend
 
     def execQuery(
         self,
         query: str,
-        ttl_seconds: Optional[int] = 1800,
-        force_refresh: bool = False,
+        ttl_seconds: Optional[int] = FROM_POLICY,
+        force_refresh: Optional[bool] = None,
+        stale_while_revalidate: Optional[bool] = None,
+        columns: Optional[Sequence[str]] = None,
+        week_range: Optional[Tuple[int, int]] = None,
     ) -> pd.DataFrame:
         """
         Execute a query with caching.
 
         Args:
             query: SQL query string
-            ttl_seconds: Cache TTL in seconds. None = cache forever. Default 30 min.
-            force_refresh: Ignore cache and re-query.
+            ttl_seconds: Cache TTL in seconds. None = cache forever. Defaults
+                to the current QueryPolicy (30 min unless overridden).
+            force_refresh: Ignore cache and re-query. None = current QueryPolicy.
+            stale_while_revalidate: Serve an expired entry within the grace
+                window and refresh it in the background. None = current
+                QueryPolicy, then the instance default.
+            columns: Only return (and, on a disk hit, only decode) these columns.
+            week_range: (first_week, last_week) the query is rendered for. The
+                result must have a "week" column; a cached result of the same
+                query over a wider range is sliced instead of re-querying.
 
         Returns:
-            pandas DataFrame with query results
+            pandas DataFrame with query results; attrs["cache_status"] is
+            "stale" when an expired entry was served, "fresh" otherwise.
+        """
+        caller = _caller_name()
+        started = time.perf_counter()
+        backend = self._backend.name
+        normalized = self._normalize_query(query)
+        cache_key = self._hash_query(normalized)
+        memory_key = self._store.memory_key(cache_key)
+        key_range = (_range_family(normalized, *week_range), *week_range) if week_range is not None else None
+        policy = current_policy()
+        if ttl_seconds is FROM_POLICY:
+            ttl_seconds = policy.ttl_seconds
+        if force_refresh is None:
+            force_refresh = policy.force_refresh
+        if stale_while_revalidate is None:
+            stale_while_revalidate = policy.stale_while_revalidate
+        if stale_while_revalidate is None:
+            stale_while_revalidate = self._stale_while_revalidate
+
+        if not force_refresh:
+            cached = _lookup_memory(self._memory, memory_key, columns)
+            if cached is not None:
+                _record_request(caller, backend, "memory_hit", started)
+                return _with_status(cached, "fresh")
+
+            entry = self._store.lookup(cache_key)
+            result = self._store.read(entry, columns=columns) if entry is not None else None
+            if result is not None:
+                self._memory.put(_projection_key(memory_key, columns), result, entry.ttl_seconds, entry.cached_at)
+                _record_request(caller, backend, "disk_hit", started)
+                return _with_status(result, "fresh")
+
+            if key_range is not None:
+                result = self._read_covering(key_range, memory_key, columns)
+                if result is not None:
+                    _record_request(caller, backend, "range_hit", started)
+                    return _with_status(result, "fresh")
+
+            if stale_while_revalidate:
+                entry = self._store.lookup_stale(cache_key, self._stale_grace_seconds)
+                result = self._store.read(entry, "stale_hits", columns) if entry is not None else None
+                if result is not None:
+                    refresher.submit(
+                        memory_key,
+                        lambda: inflight.do(
+                            memory_key,
+                            lambda: self._fetch(query, normalized, cache_key, ttl_seconds, True, caller, key_range),
+                        ),
+                        policy.priority,
+                    )
+                    _record_request(caller, backend, "stale_hit", started)
+                    return _with_status(result, "stale")
+
+        if policy.expired():
+            _record_request(caller, backend, "deadline", started)
+            raise QueryDeadlineExceeded(f"Deadline passed before {caller} could query {backend}")
+        result, shared = inflight.do(
+            memory_key,
+            lambda: self._fetch(query, normalized, cache_key, ttl_seconds, force_refresh, caller, key_range),
+        )
+        if columns is None and shared:
+            result = result.copy(deep=False)
+        _record_request(caller, backend, "coalesced" if shared else "miss", started)
+        return _with_status(_project(result, columns), "fresh")
+
+    async def execQuery_async(
+        self,
+        query: str,
+        ttl_seconds: Optional[int] = FROM_POLICY,
+        force_refresh: Optional[bool] = None,
+        stale_while_revalidate: Optional[bool] = None,
+        columns: Optional[Sequence[str]] = None,
+        week_range: Optional[Tuple[int, int]] = None,
+    ) -> pd.DataFrame:
+        """
+        Awaitable execQuery, so independent queries can overlap.
+
+        Same arguments, cache and result as execQuery. At most
+        MAX_CONCURRENCY calls run at once per event loop; cancelling the
+        awaiting task stops the Athena execution unless another caller is
+        still waiting on it.
         """
-        cache_key = self._hash_query(query)
-        cache_file = self._cache_dir / f"{cache_key}.parquet"
-        meta_file = self._cache_dir / f"{cache_key}.meta"
+        return await _exec_async(
+            self.execQuery, query, ttl_seconds, force_refresh, stale_while_revalidate, columns, week_range
+        )
+
+    def _read_covering(self, key_range, memory_key, columns) -> Optional[pd.DataFrame]:
+        """Slice a cached wider-range result of the same family, if there is one."""
+        family, lo, hi = key_range
+        entry = self._store.lookup_covering(family, lo, hi)
+        if entry is None:
+            return None
+        read_columns = None if columns is None else list(dict.fromkeys([*columns, RANGE_COLUMN]))
+        superset = self._store.read(entry, "range_hits", read_columns)
+        if superset is None:
+            return None
+        result = _slice_range(superset, lo, hi, columns)
+        self._memory.put(_projection_key(memory_key, columns), result, entry.ttl_seconds, entry.cached_at)
+        return result
 
-        if not force_refresh and self._is_cache_valid(cache_file, meta_file, ttl_seconds):
-            return pd.read_parquet(cache_file)
+    def _fetch(self, query, normalized, cache_key, ttl_seconds, force_refresh, caller="unknown", key_range=None):
+        """Run the query under the per-key file lock, unless another process filled the cache meanwhile."""
+        memory_key = self._store.memory_key(cache_key)
+        with self._store.lock(cache_key):
+            if not force_refresh:
+                entry = self._store.lookup(cache_key)
+                result = self._store.read(entry) if entry is not None else None
+                if result is not None:
+                    self._memory.put(memory_key, result, entry.ttl_seconds, entry.cached_at)
+                    return result
 
-        # Execute query
-        result = self._athena.execQuery(query)
+            # Execute query
+            result = self._backend.execute(query, caller)
 
-        # Cache result
-        self._save_cache(result, cache_file, meta_file, ttl_seconds)
+            # Cache result
+            self._store.write(cache_key, result, ttl_seconds, _sql_template(normalized), key_range)
+            self._memory.put(memory_key, result, ttl_seconds)
 
         return result
 
-    def _hash_query(self, query: str) -> str:
-        normalized = " ".join(query.split())
+    def _normalize_query(self, query: str) -> str:
+        # Normalize whitespace for consistent hashing
+        return " ".join(query.split())
+
+    def _hash_query(self, normalized: str) -> str:
+        """Generate a stable hash for the normalized query string."""
         return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
 
-    def _is_cache_valid(
-        self, cache_file: Path, meta_file: Path, ttl_seconds: Optional[int]
-    ) -> bool:
-        if not cache_file.exists() or not meta_file.exists():
-            return False
-        try:
-            with open(meta_file, "r") as f:
-                meta = json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return False
-        cached_ttl = meta.get("ttl_seconds")
-        if cached_ttl is None:
-            return True
-        cached_at = meta.get("cached_at", 0)
-        elapsed = time.time() - cached_at
-        return elapsed < cached_ttl
 
-    def _save_cache(self, df, cache_file, meta_file, ttl_seconds):
-        try:
-            df.to_parquet(cache_file, index=False)
-            meta = {
-                "cached_at": time.time(),
-                "ttl_seconds": ttl_seconds,
-                "rows": len(df),
-            }
-            with open(meta_file, "w") as f:
-                json.dump(meta, f)
-        except Exception:
-            pass
+class CachedNeedle(CachedQueryEngine):
+    """
+    Wrapper around sensorfabric.Needle that caches query results to disk.
+    """
+
+    def __init__(
+        self,
+        method: str = "mdh",
+        cache_dir: Optional[Path] = None,
+        memory: Optional[MemoryCache] = None,
+        stale_while_revalidate: Optional[bool] = None,
+        stale_grace_seconds: Optional[int] = None,
+    ):
+        super().__init__(NeedleBackend(method), cache_dir, memory, stale_while_revalidate, stale_grace_seconds)
+
+
+class CachedAthena(CachedQueryEngine):
+    """
+    Wrapper around sensorfabric.athena that caches query results to disk.
+
+    Same interface as CachedNeedle but for direct AWS Athena connections.
+    """
+
+    def __init__(
+        self,
+        profile_name: Optional[str] = None,
+        database: Optional[str] = None,
+        s3_location: Optional[str] = None,
+        workgroup: Optional[str] = None,
+        cache_dir: Optional[Path] = None,
+        memory: Optional[MemoryCache] = None,
+        stale_while_revalidate: Optional[bool] = None,
+        stale_grace_seconds: Optional[int] = None,
+    ):
+        super().__init__(
+            AthenaBackend(profile_name, database, s3_location, workgroup),
+            cache_dir,
+            memory,
+            stale_while_revalidate,
+            stale_grace_seconds,
+        )
+
+
+def cache_stats(cache_dir: Optional[Path] = None) -> dict:
+    """Size, hit ratio and eviction counters for a query cache directory."""
+    stats = QueryStore.for_dir(cache_dir or CACHE_DIR).stats()
+    disk_hits = stats.get("disk_hits", 0) + stats.get("range_hits", 0) + stats.get("stale_hits", 0)
+    lookups = disk_hits + stats.get("misses", 0)
+    stats["disk_hit_ratio"] = disk_hits / lookups if lookups else None
+    memory_lookups = memory_cache.hits + memory_cache.misses
+    stats["memory"] = {
+        "entries": len(memory_cache),
+        "bytes": memory_cache.size_bytes,
+        "hits": memory_cache.hits,
+        "misses": memory_cache.misses,
+        "hit_ratio": memory_cache.hits / memory_lookups if memory_lookups else None,
+    }
+    return stats
+
+
+def vacuum(
+    cache_dir: Optional[Path] = None,
+    max_bytes: Optional[int] = None,
+    policy: Optional[str] = None,
+    uh_max_bytes: Optional[int] = None,
+    figures_max_bytes: Optional[int] = None,
+) -> dict:
+    """
+    Reclaim disk space: drop expired query results, enforce the byte budget,
+    clear temp files from crashed writers, and optionally cap the
+    Ultrahuman response files and the rendered figure cache.
+
+    Returns:
+        dict with the query cache, Ultrahuman and figure eviction reports.
+    """
+    store = QueryStore.for_dir(cache_dir or CACHE_DIR)
+    report = {"queries": store.evict(max_bytes, policy)}
+    report["queries"]["orphaned_bytes"] = store.remove_orphans()
+    if uh_max_bytes is not None:
+        from uh_client import prune_uh_cache
+
+        report["ultrahuman"] = prune_uh_cache(uh_max_bytes)
+    if figures_max_bytes is not None:
+        from figure_cache import figure_cache
+
+        report["figures"] = figure_cache.prune(figures_max_bytes)
+    return report
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or vacuum the query cache.")
+    parser.add_argument("--cache-dir", type=Path, default=CACHE_DIR)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="Print cache size and hit ratios.")
+    vac = sub.add_parser("vacuum", help="Drop expired entries and enforce the byte budget.")
+    vac.add_argument("--max-bytes", type=int, default=None)
+    vac.add_argument("--policy", choices=EVICTION_POLICIES, default=None)
+    vac.add_argument("--uh-max-bytes", type=int, default=None)
+    vac.add_argument("--figures-max-bytes", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == "stats":
+        result = cache_stats(args.cache_dir)
+    else:
+        result = vacuum(args.cache_dir, args.max_bytes, args.policy, args.uh_max_bytes, args.figures_max_bytes)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
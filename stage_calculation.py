@@ -1,30 +1,42 @@
 # calculate device wearing for specific participant.
-import marimo as mo
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import requests
 import os
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from sensorfabric.mdh import MDH
-from urllib.parse import urlencode
-import hashlib
-import json
+from typing import List, Optional
 from pathlib import Path
-from query_cache import CachedNeedle, CachedAthena
+from query_cache import CachedNeedle, CachedAthena, CachedQueryEngine, LocalBackend, metrics, query_policy
+from clients import clients
+from figure_cache import figure_cache
 
+logger = logging.getLogger(__name__)
 
-mdh = MDH()
 
-mdh_athena = CachedNeedle(method="mdh")
+# Set QUERY_LOCAL_FIXTURES to a directory holding mdh/ and aws/ parquet tables
+# to run every query offline through DuckDB (benchmarks, load tests).
+LOCAL_FIXTURES = os.getenv("QUERY_LOCAL_FIXTURES")
 
-aws_athena = aws = CachedAthena(
-    profile_name=os.getenv("AWS_PROFILE_NAME"),
-    database=os.getenv('AWS_BIOBAYB_DB_NAME'),
-    s3_location=os.getenv('AWS_BIOBAYB_S3_LOCATION'),
-    workgroup=os.getenv('AWS_BIOBAYB_WORKGROUP'),
-)
+# Clients are built (and authenticate) on their first query, not on import.
+if LOCAL_FIXTURES:
+    clients.register("mdh", lambda: CachedQueryEngine(LocalBackend(Path(LOCAL_FIXTURES) / "mdh"), cache_dir=Path(".cache/local-queries")))
+    clients.register("aws", lambda: CachedQueryEngine(LocalBackend(Path(LOCAL_FIXTURES) / "aws"), cache_dir=Path(".cache/local-queries")))
+else:
+    clients.register("mdh", lambda: CachedNeedle(method="mdh"))
+    clients.register("aws", lambda: CachedAthena(
+        profile_name=os.getenv("AWS_PROFILE_NAME"),
+        database=os.getenv('AWS_BIOBAYB_DB_NAME'),
+        s3_location=os.getenv('AWS_BIOBAYB_S3_LOCATION'),
+        workgroup=os.getenv('AWS_BIOBAYB_WORKGROUP'),
+    ))
+
+mdh_athena = clients.lazy("mdh")
+aws_athena = aws = clients.lazy("aws")
 
 
 def get_ttl_for_weeks(first_w1_day, last_week):
@@ -50,25 +62,19 @@ def get_ttl_for_weeks(first_w1_day, last_week):
     return 1800  # Current or future — 30 min TTL
 
 
-# Module-level TTL used by query functions. Set by show_heatmap_for_stage before calling checks.
-_current_ttl = 1800
+# Fetch all prenatal metrics of a stage with one calculate_stage_metrics query
+# instead of one query per metric. Set FUSED_STAGE_QUERY=0 to disable.
+FUSED_STAGE_QUERY = os.getenv("FUSED_STAGE_QUERY", "1").lower() not in ("0", "false", "no")
 
+# Width of the thread pool show_heatmap_for_stage uses to run a stage's
+# metric queries concurrently. 1 runs them one after another.
+STAGE_METRIC_WORKERS = int(os.getenv("STAGE_METRIC_WORKERS", 6))
 
-def calculate_daily_wear_from_oura(participantidentifier, first_week, last_week):
+def calculate_daily_wear_from_oura(participantidentifier, first_week, last_week, w1=None):
+    w1 = w1 or participant_first_w1_day(participantidentifier)
     query = f"""
-    WITH edd AS (
-    SELECT
-        participantidentifier,
-        DATE_PARSE(JSON_EXTRACT_SCALAR(CAST(customfields AS JSON), '$.edd_final'), '%Y-%m-%d') AS edd_final
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    ),
-    w1 AS (
-    SELECT
-        participantidentifier,
-        CAST(edd_final AS date) - INTERVAL '280' DAY AS w1_date
-    FROM edd
-    WHERE edd_final IS NOT NULL
+    WITH w1 AS (
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
     ),
     oura_days AS (
     SELECT
@@ -124,7 +130,7 @@ def calculate_daily_wear_from_oura(participantidentifier, first_week, last_week)
     AND ws.week = w.week
     ORDER BY w.week
     """
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = mdh_athena.execQuery(query, columns=['wear_days_ge_75'], week_range=(first_week, last_week))
     return [int(i) for i in result['wear_days_ge_75'].tolist()]
 
 def calculate_daily_wear_from_uh(participantidentifier, first_w1_day, first_week, last_week):
@@ -191,81 +197,28 @@ def calculate_daily_wear_from_uh(participantidentifier, first_w1_day, first_week
     AND ws.week = w.week
     ORDER BY w.week
     """
-    result = aws_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = aws_athena.execQuery(query, columns=['wear_days_ge_75'], week_range=(first_week, last_week))
     return [int(i) for i in result['wear_days_ge_75'].tolist()]
 
 # Device wear percentage detection
 def calculate_daily_wear(email, date):
-    if date > datetime.today():
-        return 0.0 # skip requests for future data.
-    if 'UHKEY' not in os.environ:
-        print('Could not find UH authorization key.')
-        return None
-    auth_key = os.environ['UHKEY']
-    endpoint = 'https://partner.ultrahuman.com/api/v1/metrics'
-    headers = {'Authorization': auth_key}
-    params = {
-        'email': email,
-        'date': date.strftime('%Y-%m-%d'),
-    }
-    try:
-        data = None
-        cached_response_file = f".cache/{get_hash_of_params(params, endpoint)}"
-        if os.path.exists(cached_response_file):
-            with open(cached_response_file, 'r', encoding="utf-8") as file:
-                data = json.load(file)
-        else:
-            response = requests.get(endpoint, params=params, headers=headers)
-            if response.status_code == 200:
-                data = response.json()
-                Path('.cache').mkdir(parents=True, exist_ok=True)
-                if date < datetime.today(): # cache only past data.
-                    with open(cached_response_file, "w", encoding="utf-8") as file:
-                        json.dump(data, file, ensure_ascii=False)
-            else:
-                print(f"API error: {response.status_code} for {email} on {date}")
-                return 0.0
-        map = {d['type']: d for d in data['data']['metric_data']}
-        if 'temp' not in map:
-            return 0.0
-        subset = map['temp']['object']
-        values = [v['value'] for v in subset['values']]
-        expected_values_length = 288  # 100%
-        return (len(values) / expected_values_length) * 100
-    except Exception as e:
-        print(f"Error fetching wear data for {email} on {date}: {e}")
-        return 0.0
+    """Percentage of the day's Ultrahuman samples present (see uh_client.UltrahumanClient.daily_wear)."""
+    import uh_client
+    return uh_client.get_client().daily_wear(email, date)
 
 def get_hash_of_params(params, endpoint):
-    q = urlencode(sorted(params.items()))
-    raw = f"{endpoint}?{q}"
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    import uh_client
+    return uh_client.cache_key(params, endpoint)
 
 def get_weekly_wear_count(email, week_start, week_end):
-    count = 0
-    current_date = week_start
-    while current_date <= week_end:
-        percentage = calculate_daily_wear(email, current_date)
-        if percentage is not None and percentage >= 75:
-            count += 1
-        current_date += timedelta(days=1)
-    return count
-
-def calculate_daily_symptoms(participantidentifier, first_week, last_week):
+    import uh_client
+    return uh_client.get_client().weekly_wear_counts(email, [(week_start, week_end)])[0]
+
+def calculate_daily_symptoms(participantidentifier, first_week, last_week, w1=None):
+    w1 = w1 or participant_first_w1_day(participantidentifier)
     query = f"""
-    WITH edd AS (
-    SELECT
-        participantidentifier,
-        date_parse(json_extract_scalar(cast(customfields AS JSON), '$.edd_final'), '%Y-%m-%d') AS edd_final
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    ),
-    w1 AS (
-    SELECT
-        participantidentifier,
-        CAST(edd_final AS date) - INTERVAL '280' DAY AS w1_date
-    FROM edd
-    WHERE edd_final IS NOT NULL
+    WITH w1 AS (
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
     ),
     calendar_days AS (
     SELECT
@@ -304,10 +257,11 @@ def calculate_daily_symptoms(participantidentifier, first_week, last_week):
     GROUP BY 1, 2
     ORDER BY week;
     """
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = mdh_athena.execQuery(query, columns=['days_with_checkin'], week_range=(first_week, last_week))
     return [int(i) for i in result['days_with_checkin'].tolist()]
 
-def calculate_daily_questions(participantidentifier, first_week, last_week):
+def calculate_daily_questions(participantidentifier, first_week, last_week, w1=None):
+    w1 = w1 or participant_first_w1_day(participantidentifier)
     query = f"""    
     WITH ema_results AS (
         SELECT surveyresultkey, surveyname
@@ -326,19 +280,8 @@ def calculate_daily_questions(participantidentifier, first_week, last_week):
         ON er.surveyresultkey = sqr.surveyresultkey
     WHERE sqr.participantidentifier = '{participantidentifier}'
     ),
-    edd AS (
-    SELECT
-        participantidentifier,
-        DATE_PARSE(JSON_EXTRACT_SCALAR(CAST(customfields AS JSON), '$.edd_final'), '%Y-%m-%d') AS edd_final
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    ),
     w1 AS (
-    SELECT
-        participantidentifier,
-        CAST(edd_final AS date) - INTERVAL '280' DAY AS w1_date
-    FROM edd
-    WHERE edd_final IS NOT NULL
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
     ),
     day_counts AS (
     SELECT
@@ -384,11 +327,12 @@ def calculate_daily_questions(participantidentifier, first_week, last_week):
     AND wc.week = w.week
     ORDER BY w.week;
     """
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = mdh_athena.execQuery(query, columns=['days_with_5q'], week_range=(first_week, last_week))
     return [int(i) for i in result['days_with_5q'].tolist()]
 
 
-def calculate_weekly_bimontly_surveys(participantidentifier, first_week, last_week):
+def calculate_weekly_bimontly_surveys(participantidentifier, first_week, last_week, w1=None):
+    w1 = w1 or participant_first_w1_day(participantidentifier)
     query = f"""
     WITH sr AS (
     SELECT surveyresultkey, surveyname
@@ -417,19 +361,8 @@ def calculate_weekly_bimontly_surveys(participantidentifier, first_week, last_we
     WHERE sqr.participantidentifier = '{participantidentifier}'
     GROUP BY sqr.participantidentifier, sr.surveyname, sqr.surveyresultkey
     ),
-    edd AS (
-    SELECT
-        participantidentifier,
-        DATE_PARSE(JSON_EXTRACT_SCALAR(CAST(customfields AS JSON), '$.edd_final'), '%Y-%m-%d') AS edd_final
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    ),
     w1 AS (
-    SELECT
-        participantidentifier,
-        CAST(edd_final AS date) - INTERVAL '280' DAY AS w1_date
-    FROM edd
-    WHERE edd_final IS NOT NULL
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
     ),
     -- Map each submission to gestational week
     submissions_with_weeks AS (
@@ -483,11 +416,12 @@ def calculate_weekly_bimontly_surveys(participantidentifier, first_week, last_we
     AND wf.week = w.week
     ORDER BY w.week;
     """
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = mdh_athena.execQuery(query, columns=['weekly_completed_count'], week_range=(first_week, last_week))
     return [int(i) for i in result['weekly_completed_count'].tolist()]
 
 
-def calculate_weight_measurements(participantidentifier, first_week, last_week):
+def calculate_weight_measurements(participantidentifier, first_week, last_week, w1=None):
+    w1 = w1 or participant_first_w1_day(participantidentifier)
     query = f"""
     WITH bp_src AS (
     SELECT
@@ -530,19 +464,8 @@ def calculate_weight_measurements(participantidentifier, first_week, last_week):
     GROUP BY 1, 2
     ),
 
-    edd AS (
-    SELECT
-        participantidentifier,
-        DATE_PARSE(JSON_EXTRACT_SCALAR(CAST(customfields AS JSON), '$.edd_final'), '%Y-%m-%d') AS edd_final
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    ),
     w1 AS (
-    SELECT
-        participantidentifier,
-        CAST(edd_final AS date) - INTERVAL '280' DAY AS w1_date
-    FROM edd
-    WHERE edd_final IS NOT NULL
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
     ),
 
     bp_with_weeks AS (
@@ -613,10 +536,11 @@ def calculate_weight_measurements(participantidentifier, first_week, last_week):
     AND gw.week = w.week
     ORDER BY w.week;
     """
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = mdh_athena.execQuery(query, columns=['meets_2x'], week_range=(first_week, last_week))
     return [int(i) for i in result['meets_2x'].tolist()]
 
-def calculate_bp_measurements(participantidentifier, first_week, last_week):
+def calculate_bp_measurements(participantidentifier, first_week, last_week, w1=None):
+    w1 = w1 or participant_first_w1_day(participantidentifier)
     query = f"""
     WITH bp_src AS (
     SELECT
@@ -659,19 +583,8 @@ def calculate_bp_measurements(participantidentifier, first_week, last_week):
     GROUP BY 1, 2
     ),
 
-    edd AS (
-    SELECT
-        participantidentifier,
-        DATE_PARSE(JSON_EXTRACT_SCALAR(CAST(customfields AS JSON), '$.edd_final'), '%Y-%m-%d') AS edd_final
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    ),
     w1 AS (
-    SELECT
-        participantidentifier,
-        CAST(edd_final AS date) - INTERVAL '280' DAY AS w1_date
-    FROM edd
-    WHERE edd_final IS NOT NULL
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
     ),
 
     bp_with_weeks AS (
@@ -742,73 +655,833 @@ def calculate_bp_measurements(participantidentifier, first_week, last_week):
     AND gb.week = w.week
     ORDER BY w.week;
     """
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
+    result = mdh_athena.execQuery(query, columns=['meets_2x'], week_range=(first_week, last_week))
     return [int(i) for i in result['meets_2x'].tolist()]
 
 
-def show_heatmap_for_stage(participant_email, participantidentifier, first_week, last_week, title, w1, ring_vendor='uh', is_postpartum=False, delivery_date=None, postpartum_days=None):
-    global _current_ttl
-    # Set TTL: past weeks cached forever, current week uses 30 min TTL
-    _current_ttl = get_ttl_for_weeks(w1, last_week)
+def calculate_stage_metrics(participantidentifier, first_week, last_week, include_oura=False, w1=None):
+    """
+    All prenatal per-week metrics of a stage from one Athena query.
+
+    Returns the same arrays as calculate_daily_symptoms,
+    calculate_daily_questions, calculate_weekly_bimontly_surveys,
+    calculate_weight_measurements, calculate_bp_measurements and (with
+    include_oura) calculate_daily_wear_from_oura, keyed by their heatmap row
+    labels, but builds the W1/weeks spine only once.
+    """
+    w1 = w1 or participant_first_w1_day(participantidentifier)
+    oura_cte = f""",
+    oura_days AS (
+    SELECT
+        participantidentifier,
+        CAST("timestamp" AS date) AS day_date,
+        GREATEST(0.0, LEAST(1.0, 1.0 - CAST(COALESCE(nonweartime, 0) AS DOUBLE) / 86400.0)) AS wear_fraction
+    FROM ouradailyactivity
+    WHERE participantidentifier = '{participantidentifier}'
+    ),
+    oura_weekly AS (
+    SELECT
+        o.participantidentifier,
+        1 + CAST(date_diff('day', w.w1_date, o.day_date) / 7 AS integer) AS week,
+        SUM(CASE WHEN o.wear_fraction >= 0.75 THEN 1 ELSE 0 END) AS wear_days_ge_75
+    FROM oura_days o
+    JOIN w1 w
+        ON w.participantidentifier = o.participantidentifier
+    GROUP BY 1, 2
+    )""" if include_oura else ""
+    oura_column = ",\n    COALESCE(ow.wear_days_ge_75, 0) AS oura_wear" if include_oura else ""
+    oura_join = """
+    LEFT JOIN oura_weekly ow
+    ON ow.participantidentifier = w.participantidentifier
+    AND ow.week = w.week""" if include_oura else ""
+
+    query = f"""
+    WITH w1 AS (
+    SELECT '{participantidentifier}' AS participantidentifier, DATE '{w1.date()}' AS w1_date
+    ),
+    weeks AS (
+    SELECT
+        w1.participantidentifier,
+        CAST(week AS integer) AS week
+    FROM w1
+    CROSS JOIN UNNEST(sequence({first_week}, {last_week})) AS t(week)
+    ),
+
+    -- Symptom check-ins: days with a projectdevicedata row, inside the stage window
+    checkin_days AS (
+    SELECT participantidentifier, CAST(inserteddate AS date) AS day_date
+    FROM projectdevicedata
+    WHERE participantidentifier = '{participantidentifier}'
+    GROUP BY 1, 2
+    ),
+    symptoms_weekly AS (
+    SELECT
+        c.participantidentifier,
+        1 + CAST(date_diff('day', w.w1_date, c.day_date) / 7 AS integer) AS week,
+        COUNT(*) AS days_with_checkin
+    FROM checkin_days c
+    JOIN w1 w
+        ON w.participantidentifier = c.participantidentifier
+    WHERE c.day_date BETWEEN date_add('day', 7 * ({first_week} - 1), w.w1_date)
+        AND date_add('day', 7 * {last_week} - 1, w.w1_date)
+    GROUP BY 1, 2
+    ),
+
+    -- Daily questions: days with at least 6 distinct EMA answers
+    ema_day_counts AS (
+    SELECT
+        sqr.participantidentifier,
+        CAST(sqr.startdate - INTERVAL '7' HOUR AS date) AS day_date,
+        COUNT(DISTINCT sqr.resultidentifier) AS questions_answered
+    FROM surveyquestionresults sqr
+    JOIN surveyresults sr
+        ON sr.surveyresultkey = sqr.surveyresultkey
+    WHERE sqr.participantidentifier = '{participantidentifier}'
+        AND sr.surveyname IN ('EMA PM', 'EMA AM')
+    GROUP BY 1, 2
+    ),
+    questions_weekly AS (
+    SELECT
+        d.participantidentifier,
+        1 + CAST(date_diff('day', w.w1_date, d.day_date) / 7 AS integer) AS week,
+        SUM(CASE WHEN d.questions_answered >= 6 THEN 1 ELSE 0 END) AS days_with_5q
+    FROM ema_day_counts d
+    JOIN w1 w
+        ON w.participantidentifier = d.participantidentifier
+    GROUP BY 1, 2
+    ),
+
+    -- Weekly/bimonthly questionnaires
+    survey_submissions AS (
+    SELECT
+        sqr.participantidentifier,
+        sr.surveyname,
+        CAST(MIN(sqr.startdate - INTERVAL '7' HOUR) AS date) AS day_date
+    FROM surveyquestionresults sqr
+    JOIN surveyresults sr
+        ON sr.surveyresultkey = sqr.surveyresultkey
+    WHERE sqr.participantidentifier = '{participantidentifier}'
+        AND sr.surveyname IN (
+        'mMOS (Weekly)',
+        'PROMIS Sleep (Weekly)',
+        'BRCS (Weekly)',
+        'Pregnancy Experience Scale',
+        'Maternal Antenatal Attachment Scale',
+        'Edinburgh Postnatal Depression Scale (EPDS)',
+        'Perinatal Anxiety Screening Scale (PASS)'
+        )
+    GROUP BY sqr.participantidentifier, sr.surveyname, sqr.surveyresultkey
+    ),
+    survey_weeks AS (
+    SELECT
+        s.participantidentifier,
+        s.surveyname,
+        1 + CAST(date_diff('day', w.w1_date, s.day_date) / 7 AS integer) AS week
+    FROM survey_submissions s
+    JOIN w1 w
+        ON w.participantidentifier = s.participantidentifier
+    ),
+    surveys_weekly AS (
+    SELECT
+        participantidentifier,
+        week,
+        MAX(CASE WHEN surveyname = 'mMOS (Weekly)'              THEN 1 ELSE 0 END)
+        + MAX(CASE WHEN surveyname = 'PROMIS Sleep (Weekly)'      THEN 1 ELSE 0 END)
+        + MAX(CASE WHEN surveyname = 'BRCS (Weekly)'              THEN 1 ELSE 0 END)
+        + MAX(CASE WHEN surveyname = 'Pregnancy Experience Scale' THEN 1 ELSE 0 END)
+        + MAX(CASE WHEN surveyname = 'Maternal Antenatal Attachment Scale'        AND week = 20 THEN 1 ELSE 0 END)
+        + MAX(CASE WHEN surveyname = 'Edinburgh Postnatal Depression Scale (EPDS)' AND week = 28 THEN 1 ELSE 0 END)
+        + MAX(CASE WHEN surveyname = 'Perinatal Anxiety Screening Scale (PASS)'    AND week = 32 THEN 1 ELSE 0 END)
+        AS weekly_completed_count
+    FROM survey_weeks
+    GROUP BY 1, 2
+    ),
+
+    -- Weight and BP: distinct measurement days per source
+    measurement_days AS (
+    SELECT participantidentifier, 'omron_bp' AS source, CAST(COALESCE(datetimelocal, datetime, inserteddate) AS date) AS day_date
+    FROM omronbloodpressure
+    WHERE participantidentifier = '{participantidentifier}'
+    UNION
+    SELECT participantidentifier,
+        CASE WHEN type = 'Weight' THEN 'healthkit_weight' ELSE 'healthkit_bp' END,
+        CAST(COALESCE(startdate - INTERVAL '7' HOUR) AS date)
+    FROM healthkitv2samples
+    WHERE participantidentifier = '{participantidentifier}'
+        AND type IN ('Weight', 'BloodPressureSystolic', 'BloodPressureDiastolic')
+    UNION
+    SELECT participantidentifier,
+        CASE WHEN type = 'Weight' THEN 'googlefit_weight' ELSE 'googlefit_bp' END,
+        CAST(COALESCE(windowstart - INTERVAL '7' HOUR) AS date)
+    FROM googlefitsamples
+    WHERE participantidentifier = '{participantidentifier}'
+        AND type IN ('Weight', 'blood_pressure_diastolic', 'blood_pressure_systolic')
+    ),
+    measurements_weekly AS (
+    SELECT
+        m.participantidentifier,
+        1 + CAST(date_diff('day', w.w1_date, m.day_date) / 7 AS integer) AS week,
+        NULLIF(COUNT_IF(m.source = 'omron_bp'), 0) AS omron_bp_days,
+        NULLIF(COUNT_IF(m.source = 'healthkit_weight'), 0) AS healthkit_weight_days,
+        NULLIF(COUNT_IF(m.source = 'healthkit_bp'), 0) AS healthkit_bp_days,
+        NULLIF(COUNT_IF(m.source = 'googlefit_weight'), 0) AS googlefit_weight_days,
+        NULLIF(COUNT_IF(m.source = 'googlefit_bp'), 0) AS googlefit_bp_days
+    FROM measurement_days m
+    JOIN w1 w
+        ON w.participantidentifier = m.participantidentifier
+    GROUP BY 1, 2
+    ){oura_cte}
+    SELECT
+    w.participantidentifier,
+    w.week,
+    COALESCE(sy.days_with_checkin, 0) AS symptoms,
+    COALESCE(q.days_with_5q, 0) AS questions,
+    COALESCE(sv.weekly_completed_count, 0) AS surveys,
+    COALESCE(mw.healthkit_weight_days, mw.googlefit_weight_days, 0) AS weight,
+    GREATEST(COALESCE(mw.healthkit_bp_days, 0), COALESCE(mw.omron_bp_days, 0), COALESCE(mw.googlefit_bp_days, 0)) AS bp{oura_column}
+    FROM weeks w
+    LEFT JOIN symptoms_weekly sy
+    ON sy.participantidentifier = w.participantidentifier
+    AND sy.week = w.week
+    LEFT JOIN questions_weekly q
+    ON q.participantidentifier = w.participantidentifier
+    AND q.week = w.week
+    LEFT JOIN surveys_weekly sv
+    ON sv.participantidentifier = w.participantidentifier
+    AND sv.week = w.week
+    LEFT JOIN measurements_weekly mw
+    ON mw.participantidentifier = w.participantidentifier
+    AND mw.week = w.week{oura_join}
+    ORDER BY w.week;
+    """
+    result = mdh_athena.execQuery(query, week_range=(first_week, last_week))
+    frame = {label: [int(i) for i in result[column].tolist()] for label, column in _STAGE_METRIC_COLUMNS.items()}
+    if include_oura:
+        frame["Oura - Smart ring wear (~19h/day)"] = [int(i) for i in result["oura_wear"].tolist()]
+    return frame
+
+
+# Heatmap row label -> column of the calculate_stage_metrics query, in row order
+_STAGE_METRIC_COLUMNS = {
+    "Symptom check-in (daily)": "symptoms",
+    "Daily questions (1-5 Q)": "questions",
+    "Weekly/bimonthly questionnaire": "surveys",
+    "Weight(per week)": "weight",
+    "BP (per week)": "bp",
+}
+
+
+# Weekly and exception surveys counted by the questionnaire row
+WEEKLY_SURVEYS = (
+    'mMOS (Weekly)',
+    'PROMIS Sleep (Weekly)',
+    'BRCS (Weekly)',
+    'Pregnancy Experience Scale',
+)
+EXCEPTION_SURVEYS = {
+    'Maternal Antenatal Attachment Scale': 20,
+    'Edinburgh Postnatal Depression Scale (EPDS)': 28,
+    'Perinatal Anxiety Screening Scale (PASS)': 32,
+}
+
+# Ultrahuman wear day: at least 75% of the 288 five-minute samples
+UH_WEAR_SAMPLES = 0.75 * 288
+
+
+class ParticipantTimeline:
+    """
+    Per-day activity of one participant over the whole study, fetched once.
+
+    `days` has one row per calendar day with any activity and one column per
+    signal (check-ins, EMA answers, one column per questionnaire, weight/BP
+    days per source, Oura wear). Every stage matrix, prenatal or postpartum,
+    is sliced from it in memory with the same rules as the calculate_*
+    functions.
+    """
+
+    def __init__(self, participantidentifier, w1, days, uh_samples=None, survey_rows=None):
+        self.participantidentifier = participantidentifier
+        self.w1 = w1
+        self.days = days
+        self.uh_samples = uh_samples
+        self.survey_rows = survey_rows
+
+    def prenatal_frame(self, first_week, last_week, ring_vendor='uh'):
+        """Heatmap rows for gestational weeks first_week..last_week."""
+        weeks = range(first_week, last_week + 1)
+        diff = np.asarray((self.days.index - pd.Timestamp(self.w1.date())).days)
+        ga_week = pd.Series(1 + np.trunc(diff / 7).astype(int), index=self.days.index)
+
+        def weekly(flags):
+            return flags.groupby(ga_week).sum().reindex(weeks, fill_value=0)
+
+        in_window = pd.Series((diff >= 7 * (first_week - 1)) & (diff <= 7 * last_week - 1), index=self.days.index)
+        surveys = sum((weekly(self._column(name) > 0) > 0).astype(int) for name in WEEKLY_SURVEYS)
+        for name, only_week in EXCEPTION_SURVEYS.items():
+            surveys += ((weekly(self._column(name) > 0) > 0) & (surveys.index == only_week)).astype(int)
+        healthkit_weight = weekly(self._column('healthkit_weight') > 0)
 
-    if is_postpartum and delivery_date:
-        # Use delivery-based calculations for postpartum
-        pp_days = postpartum_days if postpartum_days else 42  # default 6 weeks
-        weeks = [f"PP W{w}" for w in range(first_week, last_week + 1)]
-        
         frame = {
-            "Symptom check-in (daily)": calculate_daily_symptoms_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
-            "Daily questions (1-5 Q)": calculate_daily_questions_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
-            "Weekly/bimonthly questionnaire": calculate_weekly_bimontly_surveys_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
-            "Weight(per week)": calculate_weight_measurements_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
-            "BP (per week)": calculate_bp_measurements_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days)
+            "Symptom check-in (daily)": weekly((self._column('checkin') > 0) & in_window),
+            "Daily questions (1-5 Q)": weekly(self._column('questions') >= 6),
+            "Weekly/bimonthly questionnaire": surveys,
+            "Weight(per week)": healthkit_weight.where(healthkit_weight > 0, weekly(self._column('googlefit_weight') > 0)),
+            "BP (per week)": pd.concat(
+                [weekly(self._column(c) > 0) for c in ('healthkit_bp', 'omron_bp', 'googlefit_bp')], axis=1
+            ).max(axis=1),
         }
-
         if ring_vendor == 'oura':
-            frame["Oura - Smart ring wear (~19h/day)"] = calculate_daily_wear_from_oura_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days)
-        else:
-            if os.getenv('UH_API_CALL'):
-                week_ranges = calculate_postpartum_weeks_from_delivery(participantidentifier, first_week, last_week, delivery_date, pp_days)
-                wear_counts = []
-                for week_num, week_start, week_end in week_ranges:
-                    count = get_weekly_wear_count(participant_email, week_start, week_end)
-                    wear_counts.append(count)
-                while len(wear_counts) < (last_week - first_week + 1):
-                    wear_counts.append(0)
-                frame["Smart ring wear (~19h/day)"] = wear_counts
-            else:
-                frame["UH - Smart ring wear (~19h/day)"] = calculate_daily_wear_from_uh_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days)
-        
-        title = title.replace("Postpartum", f"Postpartum (from delivery {delivery_date.strftime('%Y-%m-%d')})")
-    else:
-        # Prenatal gestational week-based calculations
-        weeks = [f"W{w}" for w in range(first_week, last_week + 1)]
+            frame["Oura - Smart ring wear (~19h/day)"] = weekly(self._column('oura_wear'))
+        elif self.uh_samples is not None:
+            uh_diff = np.asarray((self.uh_samples.index - pd.Timestamp(self.w1.date())).days)
+            uh_week = 1 + np.trunc(uh_diff / 7).astype(int)
+            frame["UH - Smart ring wear (~19h/day)"] = (
+                (self.uh_samples >= UH_WEAR_SAMPLES).groupby(uh_week).sum().reindex(weeks, fill_value=0)
+            )
+        return {label: [int(i) for i in values] for label, values in frame.items()}
+
+    def postpartum_frame(self, first_week, last_week, delivery_date, postpartum_days, ring_vendor='uh'):
+        """Heatmap rows for postpartum weeks counted from delivery_date."""
+        def weekly(flags, cap=None):
+            return postpartum_week_counts(flags.index[flags], first_week, last_week, delivery_date, postpartum_days, cap)
 
         frame = {
-            "Symptom check-in (daily)": calculate_daily_symptoms(participantidentifier, first_week, last_week),
-            "Daily questions (1-5 Q)": calculate_daily_questions(participantidentifier, first_week, last_week),
-            "Weekly/bimonthly questionnaire": calculate_weekly_bimontly_surveys(participantidentifier, first_week, last_week),
-            "Weight(per week)": calculate_weight_measurements(participantidentifier, first_week, last_week),
-            "BP (per week)": calculate_bp_measurements(participantidentifier, first_week, last_week)
+            "Symptom check-in (daily)": weekly(self._column('checkin') > 0),
+            "Daily questions (1-5 Q)": weekly(self._column('questions') >= 6),
+            "Weekly/bimonthly questionnaire": postpartum_week_counts(
+                self._postpartum_submission_days(delivery_date), first_week, last_week, delivery_date, postpartum_days, cap=1
+            ),
+            "Weight(per week)": weekly((self._column('healthkit_weight') > 0) | (self._column('googlefit_weight') > 0)),
+            "BP (per week)": weekly(
+                (self._column('omron_bp') > 0) | (self._column('googlefit_bp') > 0) | (self._column('healthkit_bp') > 0)
+            ),
         }
+        if ring_vendor == 'oura':
+            frame["Oura - Smart ring wear (~19h/day)"] = weekly(self._column('oura_wear') > 0)
+        elif self.uh_samples is not None:
+            frame["UH - Smart ring wear (~19h/day)"] = weekly(self.uh_samples >= UH_WEAR_SAMPLES)
+        return frame
+
+    def _postpartum_submission_days(self, delivery_date):
+        """
+        Day of each questionnaire submission counted from its first answer on
+        or after delivery_date, as calculate_weekly_bimontly_surveys_postpartum
+        does by dropping earlier answers before taking the MIN.
+        """
+        if self.survey_rows is None:
+            surveys = sum((self._column(name) > 0).astype(int) for name in (*WEEKLY_SURVEYS, *EXCEPTION_SURVEYS))
+            return self.days.index[surveys > 0]
+        delivery = pd.Timestamp(delivery_date.date())
+        day = self.survey_rows.index
+        gap = pd.to_timedelta(self.survey_rows.values, unit='D')
+        # First answer day at/after delivery: no earlier answer day, or the
+        # previous one falls before delivery
+        first = (day >= delivery) & ((self.survey_rows.values == 0) | (day - gap < delivery))
+        return day[first]
+
+    def _column(self, name):
+        if name in self.days.columns:
+            return self.days[name]
+        return pd.Series(0, index=self.days.index)
+
+
+def timeline_activity_query(participantidentifiers, include_oura=False):
+    """
+    SQL for the per-day activity behind ParticipantTimeline, for any number
+    of participants: one row per (participantidentifier, day_date, metric).
+    """
+    ids_sql = ", ".join(f"'{pid}'" for pid in participantidentifiers)
+    oura = f"""
+    UNION ALL
+    SELECT
+        participantidentifier,
+        CAST("timestamp" AS date) AS day_date,
+        'oura_wear' AS metric,
+        COUNT_IF(GREATEST(0.0, LEAST(1.0, 1.0 - CAST(COALESCE(nonweartime, 0) AS DOUBLE) / 86400.0)) >= 0.75) AS value
+    FROM ouradailyactivity
+    WHERE participantidentifier IN ({ids_sql})
+    GROUP BY 1, 2""" if include_oura else ""
 
+    survey_names = ", ".join(f"'{name}'" for name in (*WEEKLY_SURVEYS, *EXCEPTION_SURVEYS))
+    return f"""
+    WITH submission_days AS (
+    SELECT DISTINCT
+        sqr.participantidentifier,
+        sr.surveyname,
+        sqr.surveyresultkey,
+        CAST(sqr.startdate - INTERVAL '7' HOUR AS date) AS day_date
+    FROM surveyquestionresults sqr
+    JOIN surveyresults sr
+        ON sr.surveyresultkey = sqr.surveyresultkey
+    WHERE sqr.participantidentifier IN ({ids_sql})
+        AND sr.surveyname IN ({survey_names})
+    ),
+    submissions AS (
+    SELECT participantidentifier, surveyname, MIN(day_date) AS day_date
+    FROM submission_days
+    GROUP BY participantidentifier, surveyname, surveyresultkey
+    )
+    SELECT
+        participantidentifier,
+        CAST(inserteddate AS date) AS day_date,
+        'checkin' AS metric,
+        COUNT(*) AS value
+    FROM projectdevicedata
+    WHERE participantidentifier IN ({ids_sql})
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT
+        sqr.participantidentifier,
+        CAST(sqr.startdate - INTERVAL '7' HOUR AS date),
+        'questions',
+        COUNT(DISTINCT sqr.resultidentifier)
+    FROM surveyquestionresults sqr
+    JOIN surveyresults sr
+        ON sr.surveyresultkey = sqr.surveyresultkey
+    WHERE sqr.participantidentifier IN ({ids_sql})
+        AND sr.surveyname IN ('EMA PM', 'EMA AM')
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT participantidentifier, day_date, surveyname, COUNT(*)
+    FROM submissions
+    GROUP BY 1, 2, 3
+    UNION ALL
+    -- Every day a questionnaire submission has answers on, with the days since
+    -- its previous such day (0 on its first): lets postpartum_frame date a
+    -- submission by its first answer on or after delivery
+    SELECT
+        participantidentifier,
+        day_date,
+        'survey_row_day',
+        COALESCE(date_diff('day', LAG(day_date) OVER (PARTITION BY surveyresultkey ORDER BY day_date), day_date), 0)
+    FROM submission_days
+    UNION ALL
+    SELECT
+        participantidentifier,
+        CAST(COALESCE(datetimelocal, datetime, inserteddate) AS date),
+        'omron_bp',
+        COUNT(*)
+    FROM omronbloodpressure
+    WHERE participantidentifier IN ({ids_sql})
+    GROUP BY 1, 2
+    UNION ALL
+    SELECT
+        participantidentifier,
+        CAST(COALESCE(startdate - INTERVAL '7' HOUR) AS date),
+        CASE WHEN type = 'Weight' THEN 'healthkit_weight' ELSE 'healthkit_bp' END,
+        COUNT(*)
+    FROM healthkitv2samples
+    WHERE participantidentifier IN ({ids_sql})
+        AND type IN ('Weight', 'BloodPressureSystolic', 'BloodPressureDiastolic')
+    GROUP BY 1, 2, 3
+    UNION ALL
+    SELECT
+        participantidentifier,
+        CAST(COALESCE(windowstart - INTERVAL '7' HOUR) AS date),
+        CASE WHEN type = 'Weight' THEN 'googlefit_weight' ELSE 'googlefit_bp' END,
+        COUNT(*)
+    FROM googlefitsamples
+    WHERE participantidentifier IN ({ids_sql})
+        AND type IN ('Weight', 'blood_pressure_diastolic', 'blood_pressure_systolic')
+    GROUP BY 1, 2, 3{oura}
+    """
+
+
+def uh_wear_samples_query(participantidentifiers):
+    """SQL for Ultrahuman samples per (pid, day_date) from the AWS temp table."""
+    ids_sql = ", ".join(f"'{pid}'" for pid in participantidentifiers)
+    return f"""
+    SELECT
+        pid,
+        CAST(from_iso8601_timestamp(object_day_start_timestamp_iso8601_tz) AS date) AS day_date,
+        COUNT(DISTINCT object_values_timestamp) AS samples_in_day
+    FROM temp
+    WHERE pid IN ({ids_sql})
+        AND object_day_start_timestamp_iso8601_tz IS NOT NULL
+    GROUP BY 1, 2
+    """
+
+
+def timeline_days(result):
+    """Pivot timeline_activity_query rows of one participant to day_date x metric."""
+    result = result[result['metric'] != 'survey_row_day'] if len(result) > 0 else result
+    if len(result) == 0:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='day_date'))
+    return (
+        result.assign(day_date=pd.to_datetime(result['day_date']), value=result['value'].astype(int))
+        .pivot_table(index='day_date', columns='metric', values='value', aggfunc='sum', fill_value=0)
+    )
+
+
+def timeline_survey_rows(result):
+    """
+    timeline_activity_query's survey_row_day rows of one participant: days
+    since the submission's previous answer day (0 on its first), by day.
+    """
+    rows = result[result['metric'] == 'survey_row_day'] if len(result) > 0 else result
+    return pd.Series(
+        rows['value'].astype(int).values if len(rows) > 0 else [],
+        index=pd.DatetimeIndex(pd.to_datetime(rows['day_date']) if len(rows) > 0 else []),
+        dtype=int,
+    )
+
+
+def timeline_uh_samples(result):
+    """uh_wear_samples_query rows of one participant as a samples-per-day Series."""
+    return pd.Series(
+        result['samples_in_day'].astype(float).values if len(result) > 0 else [],
+        index=pd.DatetimeIndex(pd.to_datetime(result['day_date']) if len(result) > 0 else []),
+        dtype=float,
+    )
+
+
+def timeline_ttl(delivery_date=None, postpartum_days=None):
+    """Cache forever once the postpartum period has ended, 30 min before."""
+    if delivery_date:
+        study_end = delivery_date + timedelta(days=postpartum_days or 42)
+        if study_end.date() < datetime.today().date():
+            return None
+    return 1800
+
+
+def load_participant_timeline(participantidentifier, w1, ring_vendor='uh', delivery_date=None, postpartum_days=None):
+    """
+    Fetch a participant's per-day activity for the whole study: one MDH query,
+    plus one AWS query for Ultrahuman wear unless the ring is Oura or
+    UH_API_CALL is set. Cached forever once the postpartum period has ended.
+    """
+    ttl = timeline_ttl(delivery_date, postpartum_days)
+    query = timeline_activity_query([participantidentifier], include_oura=ring_vendor == 'oura')
+    result = mdh_athena.execQuery(query, ttl_seconds=ttl, columns=['day_date', 'metric', 'value'])
+    days = timeline_days(result)
+    survey_rows = timeline_survey_rows(result)
+
+    uh_samples = None
+    if ring_vendor != 'oura' and not os.getenv('UH_API_CALL'):
+        result = aws_athena.execQuery(uh_wear_samples_query([participantidentifier]), ttl_seconds=ttl, columns=['day_date', 'samples_in_day'])
+        uh_samples = timeline_uh_samples(result)
+
+    return ParticipantTimeline(participantidentifier, w1, days, uh_samples, survey_rows)
+
+
+def evaluate_metrics(jobs, max_workers=None):
+    """
+    Run a stage's metric calculations, concurrently when max_workers > 1.
+
+    Args:
+        jobs: dict of heatmap row label -> zero-argument callable
+        max_workers: pool width, STAGE_METRIC_WORKERS by default
+
+    Returns:
+        dict with the same labels in the same order. A job that raised maps to
+        None (the error is logged) so one failing query doesn't abort the stage.
+        Each job's duration is recorded as stage_metric_seconds{metric, outcome}.
+    """
+    max_workers = STAGE_METRIC_WORKERS if max_workers is None else max_workers
+
+    def timed(label, fn):
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception:
+            logger.exception("Metric %r failed", label)
+            result, outcome = None, "error"
+        else:
+            outcome = "ok"
+        metrics.observe("stage_metric_seconds", time.perf_counter() - started, metric=label, outcome=outcome)
+        return result
+
+    if max_workers <= 1 or len(jobs) <= 1:
+        return {label: timed(label, fn) for label, fn in jobs.items()}
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs)), thread_name_prefix="stage-metric") as pool:
+        # Each job runs in a copy of the caller's context, so record_cache_status() and
+        # query_policy() apply to its queries
+        futures = {
+            label: pool.submit(contextvars.copy_context().run, timed, label, fn)
+            for label, fn in jobs.items()
+        }
+        return {label: future.result() for label, future in futures.items()}
+
+
+def _missing(first_week, last_week):
+    return [np.nan] * (last_week - first_week + 1)
+
+
+def _prenatal_frame(participantidentifier, first_week, last_week, w1, ring_vendor):
+    """Heatmap rows for a prenatal stage, queried from Athena."""
+    jobs = {}
+    if FUSED_STAGE_QUERY:
+        jobs["calculate_stage_metrics"] = lambda: calculate_stage_metrics(participantidentifier, first_week, last_week, include_oura=ring_vendor == 'oura', w1=w1)
+    else:
+        jobs.update({
+            "Symptom check-in (daily)": lambda: calculate_daily_symptoms(participantidentifier, first_week, last_week, w1),
+            "Daily questions (1-5 Q)": lambda: calculate_daily_questions(participantidentifier, first_week, last_week, w1),
+            "Weekly/bimonthly questionnaire": lambda: calculate_weekly_bimontly_surveys(participantidentifier, first_week, last_week, w1),
+            "Weight(per week)": lambda: calculate_weight_measurements(participantidentifier, first_week, last_week, w1),
+            "BP (per week)": lambda: calculate_bp_measurements(participantidentifier, first_week, last_week, w1),
+        })
         if ring_vendor == 'oura':
-            frame["Oura - Smart ring wear (~19h/day)"] = calculate_daily_wear_from_oura(participantidentifier, first_week, last_week)
+            jobs["Oura - Smart ring wear (~19h/day)"] = lambda: calculate_daily_wear_from_oura(participantidentifier, first_week, last_week, w1)
+
+    if ring_vendor != 'oura' and not os.getenv('UH_API_CALL'):
+        jobs["UH - Smart ring wear (~19h/day)"] = lambda: calculate_daily_wear_from_uh(participantidentifier, w1, first_week, last_week)
+
+    results = evaluate_metrics(jobs)
+    if FUSED_STAGE_QUERY:
+        frame = results.pop("calculate_stage_metrics")
+        if frame is None:
+            labels = list(_STAGE_METRIC_COLUMNS) + (["Oura - Smart ring wear (~19h/day)"] if ring_vendor == 'oura' else [])
+            frame = dict.fromkeys(labels)
+        frame.update(results)
+    else:
+        frame = results
+    return {label: _missing(first_week, last_week) if rows is None else rows for label, rows in frame.items()}
+
+
+def _postpartum_frame(participantidentifier, first_week, last_week, delivery_date, pp_days, ring_vendor):
+    """Heatmap rows for a postpartum stage, queried from Athena."""
+    jobs = {
+        "Symptom check-in (daily)": lambda: calculate_daily_symptoms_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
+        "Daily questions (1-5 Q)": lambda: calculate_daily_questions_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
+        "Weekly/bimonthly questionnaire": lambda: calculate_weekly_bimontly_surveys_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
+        "Weight(per week)": lambda: calculate_weight_measurements_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
+        "BP (per week)": lambda: calculate_bp_measurements_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days),
+    }
+
+    if ring_vendor == 'oura':
+        jobs["Oura - Smart ring wear (~19h/day)"] = lambda: calculate_daily_wear_from_oura_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days)
+    elif not os.getenv('UH_API_CALL'):
+        jobs["UH - Smart ring wear (~19h/day)"] = lambda: calculate_daily_wear_from_uh_postpartum(participantidentifier, first_week, last_week, delivery_date, pp_days)
+
+    results = evaluate_metrics(jobs)
+    return {label: _missing(first_week, last_week) if rows is None else rows for label, rows in results.items()}
+
+
+# Weekly target per heatmap row: a week at or above it scores 100%
+METRIC_TARGETS = {
+    "Symptom check-in (daily)": 7,
+    "Daily questions (1-5 Q)": 7,
+    "Weekly/bimonthly questionnaire": 1,
+    "Weight(per week)": 2,
+    "BP (per week)": 2,
+    "UH - Smart ring wear (~19h/day)": 7,
+    "Oura - Smart ring wear (~19h/day)": 7,
+    # Vendor-neutral row of the cohort tensor (cohort_compliance)
+    "Smart ring wear (~19h/day)": 7,
+}
+# The first rows are self-report, the rest biometrics. Each average is the
+# truncated sum of its rows' percentages over three metrics.
+SELF_REPORT_ROWS = 3
+AVERAGE_DIVISOR = 3
+COMPENSATION_THRESHOLD = 70
+SELF_REPORT_PAYOUT = 3
+BIOMETRICS_PAYOUT = 4
+
+# Part of every cached heatmap PNG's key: bump when the plotting code changes
+# so figures rendered by the old code aren't served.
+STAGE_HEATMAP_STYLE = "stage-heatmap-1"
+
+
+@dataclass
+class ComplianceMatrix:
+    """
+    Metrics x weeks compliance as NumPy arrays.
+
+    counts has shape (metrics, weeks), or (participants, metrics, weeks) for a
+    cohort; NaN marks a week the metric wasn't collected. Percentages,
+    averages and compensation are computed for every leading index at once.
+    """
+
+    metrics: List[str]
+    weeks: List[str]
+    counts: np.ndarray
+    percentages: np.ndarray
+    self_report_average: np.ndarray
+    biometrics_average: np.ndarray
+    weekly_compensation: np.ndarray
+
+    @classmethod
+    def from_counts(cls, metrics, weeks, counts):
+        counts = np.asarray(counts, dtype=float)
+        targets = np.array([METRIC_TARGETS.get(m, np.nan) for m in metrics], dtype=float)[:, None]
+        # Rows without a target are shown as they are
+        percentages = np.where(np.isnan(targets), counts, np.minimum(counts / targets, 1) * 100)
+
+        self_report_average = np.trunc(np.nansum(percentages[..., :SELF_REPORT_ROWS, :], axis=-2)) / AVERAGE_DIVISOR
+        biometrics_average = np.trunc(np.nansum(percentages[..., SELF_REPORT_ROWS:, :], axis=-2)) / AVERAGE_DIVISOR
+        # A week with no value at all (e.g. not reached yet) has no average and earns nothing
+        unobserved = np.isnan(counts).all(axis=-2)
+        self_report_average[unobserved] = np.nan
+        biometrics_average[unobserved] = np.nan
+        weekly_compensation = (
+            (self_report_average >= COMPENSATION_THRESHOLD) * SELF_REPORT_PAYOUT
+            + (biometrics_average >= COMPENSATION_THRESHOLD) * BIOMETRICS_PAYOUT
+        )
+        return cls(
+            metrics=list(metrics),
+            weeks=list(weeks),
+            counts=counts,
+            percentages=percentages,
+            self_report_average=self_report_average,
+            biometrics_average=biometrics_average,
+            weekly_compensation=weekly_compensation,
+        )
+
+    @classmethod
+    def from_frame(cls, frame, weeks):
+        """From heatmap rows (label -> weekly counts)."""
+        return cls.from_counts(list(frame), weeks, np.array(list(frame.values()), dtype=float).reshape(len(frame), len(weeks)))
+
+    def annotations(self):
+        """
+        Cell labels for the percentage heatmap: the percentage rows and both
+        averages as "85.7%" ("" when missing), then compensation as "$7".
+        """
+        values = np.concatenate(
+            [self.percentages, self.self_report_average[..., None, :], self.biometrics_average[..., None, :]],
+            axis=-2,
+        )
+        labels = np.where(np.isnan(values), "", np.char.mod("%.1f%%", values))
+        compensation = np.char.mod("$%d", self.weekly_compensation)
+        return np.concatenate([labels, compensation[..., None, :]], axis=-2).astype(object)
+
+
+@dataclass
+class StageCompliance:
+    """
+    Numbers behind one stage's heatmaps, without any plotting.
+
+    counts and percentages have one row per metric (heatmap row label) and
+    one column per week label ("W9"... or "PP W1"...).
+    """
+
+    title: str
+    matrix: ComplianceMatrix
+
+    @property
+    def weeks(self):
+        return self.matrix.weeks
+
+    @property
+    def counts(self):
+        return pd.DataFrame(self.matrix.counts, index=self.matrix.metrics, columns=self.weeks)
+
+    @property
+    def percentages(self):
+        return pd.DataFrame(self.matrix.percentages, index=self.matrix.metrics, columns=self.weeks)
+
+    @property
+    def self_report_average(self):
+        return pd.Series(self.matrix.self_report_average, index=self.weeks)
+
+    @property
+    def biometrics_average(self):
+        return pd.Series(self.matrix.biometrics_average, index=self.weeks)
+
+    @property
+    def weekly_compensation(self):
+        return pd.Series(self.matrix.weekly_compensation, index=self.weeks)
+
+    @property
+    def total_compensation(self):
+        return int(self.matrix.weekly_compensation.sum())
+
+
+def stage_compliance_from_frame(frame, weeks, title):
+    """Build a StageCompliance from heatmap rows (label -> weekly counts)."""
+    return StageCompliance(title=title, matrix=ComplianceMatrix.from_frame(frame, weeks))
+
+
+def compute_stage_compliance(participant_email, participantidentifier, first_week, last_week, title, w1, ring_vendor='uh', is_postpartum=False, delivery_date=None, postpartum_days=None, timeline=None):
+    """
+    Weekly counts, percentages, averages and compensation for one stage.
+
+    Takes the same arguments as show_heatmap_for_stage but draws nothing,
+    for batch jobs and APIs. With a ParticipantTimeline (see
+    load_participant_timeline) the rows are sliced from it in memory instead
+    of querying Athena for this stage.
+    """
+    # Past weeks are cached forever, the current week for 30 min. Scoped to
+    # this call's context, so concurrent sessions don't share it.
+    with query_policy(ttl_seconds=get_ttl_for_weeks(w1, last_week)):
+        if is_postpartum and delivery_date:
+            # Use delivery-based calculations for postpartum
+            pp_days = postpartum_days if postpartum_days else 42  # default 6 weeks
+            weeks = [f"PP W{w}" for w in range(first_week, last_week + 1)]
+
+            if timeline is not None:
+                frame = timeline.postpartum_frame(first_week, last_week, delivery_date, pp_days, ring_vendor)
+            else:
+                frame = _postpartum_frame(participantidentifier, first_week, last_week, delivery_date, pp_days, ring_vendor)
+
+            if ring_vendor != 'oura' and os.getenv('UH_API_CALL'):
+                week_ranges = calculate_postpartum_weeks_from_delivery(participantidentifier, first_week, last_week, delivery_date, pp_days) or []
+                import uh_client
+                # All days of the stage in one concurrent batch
+                wear_counts = uh_client.get_client().weekly_wear_counts(participant_email, [(start, end) for _, start, end in week_ranges])
+                while len(wear_counts) < (last_week - first_week + 1):
+                    wear_counts.append(0)
+                frame["UH - Smart ring wear (~19h/day)"] = wear_counts
+
+            title = title.replace("Postpartum", f"Postpartum (from delivery {delivery_date.strftime('%Y-%m-%d')})")
         else:
-            if os.getenv('UH_API_CALL'):
-                for i, week_num in enumerate(range(first_week, last_week + 1)):
-                    week_start = w1 + timedelta(days=(week_num - 1) * 7)
-                    week_end = week_start + timedelta(days=6)
-                    frame["Smart ring wear (~19h/day)"][i] = get_weekly_wear_count(participant_email, week_start, week_end)
+            # Prenatal gestational week-based calculations
+            weeks = [f"W{w}" for w in range(first_week, last_week + 1)]
+
+            if timeline is not None:
+                frame = timeline.prenatal_frame(first_week, last_week, ring_vendor)
             else:
-                frame["UH - Smart ring wear (~19h/day)"] = calculate_daily_wear_from_uh(participantidentifier, w1, first_week, last_week)
+                frame = _prenatal_frame(participantidentifier, first_week, last_week, w1, ring_vendor)
+
+            if ring_vendor != 'oura' and os.getenv('UH_API_CALL'):
+                week_ranges = []
+                for week_num in range(first_week, last_week + 1):
+                    week_start = w1 + timedelta(days=(week_num - 1) * 7)
+                    week_ranges.append((week_start, week_start + timedelta(days=6)))
+                import uh_client
+                frame["UH - Smart ring wear (~19h/day)"] = uh_client.get_client().weekly_wear_counts(participant_email, week_ranges)
 
-    df = pd.DataFrame(frame, index=weeks).T
+    return stage_compliance_from_frame(frame, weeks, title)
 
-    # Plot heatmap
-    fig = plt.figure(figsize=(11, 4))
+
+def render_stage_compliance(result):
+    """
+    Draw a StageCompliance as the count heatmap and the percentage heatmap.
+
+    Returns:
+        (count figure, percentage figure)
+    """
+    return _render_count_heatmap(result), _render_percentage_heatmap(result, result.title + " in Percentage (%)")
+
+
+def render_stage_compliance_png(result):
+    """
+    PNG bytes of both heatmaps, from the figure cache when the same numbers
+    were rendered before (by any process sharing .cache/figures).
+
+    Returns:
+        (count PNG, percentage PNG)
+    """
+    matrix = result.matrix
+    inputs = (result.title, matrix.metrics, matrix.weeks, matrix.counts, STAGE_HEATMAP_STYLE)
+    percentage_title = result.title + " in Percentage (%)"
+    return (
+        figure_cache.png(figure_cache.key("stage-counts", *inputs), lambda: _render_count_heatmap(result)),
+        figure_cache.png(figure_cache.key("stage-percentages", *inputs), lambda: _render_percentage_heatmap(result, percentage_title)),
+    )
+
+
+def _render_count_heatmap(result):
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
+    # A plain Figure, not pyplot's: nothing global keeps it alive once the
+    # caller drops it, so a long-running notebook server doesn't accumulate them
+    fig = Figure(figsize=(11, 4))
     ax = sns.heatmap(
-        df,
+        result.counts,
+        ax=fig.add_subplot(),
         vmin=0,
         vmax=7,
         cmap="YlGn",
@@ -818,174 +1491,181 @@ def show_heatmap_for_stage(participant_email, participantidentifier, first_week,
         annot=True,
         fmt="g",
     )
-    ax.set_title(title)
-    plt.tight_layout()
+    ax.set_title(result.title)
+    fig.tight_layout()
 
-    percentage_fig = show_percentage_heatmap_for_stage(frame, first_week, last_week, title + " in Percentage (%)")
+    return fig
 
-    return fig, percentage_fig
 
-def show_percentage_heatmap_for_stage(frame, first_week, last_week, title):
-    weeks = [f"W{w}" for w in range(first_week, last_week + 1)]
-    for key, value in frame.items():
-        if key == "Symptom check-in (daily)":
-            frame[key] = [(i/7 * 100) for i in value]
-        if key == "Daily questions (1-5 Q)":
-            frame[key] = [i/7 * 100 for i in value]
-        if key == "Weekly/bimonthly questionnaire":
-            percentages = []
-            for i in value:
-                if i >= 1:
-                    percentages.append(100)
-                else:
-                    percentages.append(0)
-            frame[key] = percentages
-        if key == "UH - Smart ring wear (~19h/day)":
-            frame[key] = [i/7 * 100 for i in value]
-        if key == "Oura - Smart ring wear (~19h/day)":
-            frame[key] = [i/7 * 100 for i in value]
-        if key == "Weight(per week)":
-            percentages = []
-            for i in value:
-                if i >= 2:
-                    percentages.append(100)
-                    continue
-                percentages.append(i / 2 * 100)
-            frame[key] = percentages
-        if key == "BP (per week)":
-            percentages = []
-            for i in value:
-                if i >= 2:
-                    percentages.append(100)
-                    continue
-                percentages.append(i / 2 * 100)
-            frame[key] = percentages
-
-    df = pd.DataFrame(frame, index=weeks).T
-    self_report_average = df.iloc[:3].sum(axis=0).astype(int) / 3
-    biometrics_average = df.iloc[3:].sum(axis=0).astype(int) / 3
-    df.loc["Self Report Average"] = self_report_average
-    df.loc["Biometrics Average"] = biometrics_average
-
-
-    weekly_comp = (
-        (self_report_average >= 70).astype(int) * 3
-        + (biometrics_average >= 70).astype(int) * 4
-    )
-    df.loc["Weekly Compensation ($)"] = weekly_comp
+def _render_percentage_heatmap(result, title):
+    import seaborn as sns
+    from matplotlib.figure import Figure
 
-    # Prepare per-cell annotations: % for all rows except compensation (use $)
-    annot_labels = df.copy()
-    for row in df.index:
-        if row == "Weekly Compensation ($)":
-            annot_labels.loc[row] = annot_labels.loc[row].map(lambda v: f"${int(round(v))}")
-        else:
-            annot_labels.loc[row] = annot_labels.loc[row].map(lambda v: f"{float(v):.1f}%")
+    matrix = result.matrix
+    df = pd.DataFrame(
+        np.vstack([matrix.percentages, matrix.self_report_average, matrix.biometrics_average, matrix.weekly_compensation]),
+        index=matrix.metrics + ["Self Report Average", "Biometrics Average", "Weekly Compensation ($)"],
+        columns=matrix.weeks,
+    )
 
     # Plot heatmap
-    fig = plt.figure(figsize=(11, 5))
+    fig = Figure(figsize=(11, 5))
     ax = sns.heatmap(
         df,
+        ax=fig.add_subplot(),
         vmin=0,
         vmax=100,
         cmap="YlGn",
         linewidths=0.5,
         linecolor="white",
-        annot=annot_labels.values,
+        annot=matrix.annotations(),
         fmt='',
     )
     ax.set_title(title)
 
     # Bold line before "Self Report Average"
-    try:
-        sep_y = df.index.get_loc("Self Report Average")
-        ax.hlines(sep_y, *ax.get_xlim(), colors="black", linewidth=2.8)
-    except KeyError:
-        pass
-
+    sep_y = df.index.get_loc("Self Report Average")
+    ax.hlines(sep_y, *ax.get_xlim(), colors="black", linewidth=2.8)
 
-    stage_total = int(weekly_comp.sum())
     fig.subplots_adjust(top=10)
     fig.subplots_adjust(bottom=9)  # make room for the caption
     fig.text(
         0.5, 0.0005,
-        f"Total compensation for this stage: ${stage_total}",
+        f"Total compensation for this stage: ${result.total_compensation}",
         ha="center", va="bottom", fontsize=10, fontweight="bold"
     )
 
-    plt.tight_layout()
+    fig.tight_layout()
 
     return fig
 
-def participant_first_w1_day(participantidentifier):
-    first_date_final_edd_query = f"""
-    WITH
-    edd AS (
-        SELECT
-        participantidentifier,
-        date_parse(
-            json_extract_scalar(cast(customfields AS JSON), '$.edd_final'),
-            '%Y-%m-%d'
-        ) edd_final
-        FROM
-        allparticipants
-        WHERE participantidentifier = '{participantidentifier}'
+
+def show_heatmap_for_stage(participant_email, participantidentifier, first_week, last_week, title, w1, ring_vendor='uh', is_postpartum=False, delivery_date=None, postpartum_days=None, timeline=None):
+    """
+    Draw the count and percentage heatmaps for one stage.
+
+    compute_stage_compliance followed by render_stage_compliance.
+    """
+    result = compute_stage_compliance(
+        participant_email, participantidentifier, first_week, last_week, title, w1, ring_vendor,
+        is_postpartum, delivery_date, postpartum_days, timeline,
     )
-    SELECT
-    participantidentifier,
-    edd_final - interval '280' day w1,
-    edd_final
-    FROM
-    edd
-    WHERE
-    edd_final IS NOT NULL
+    return render_stage_compliance(result)
+
+
+def stage_heatmap_pngs(participant_email, participantidentifier, first_week, last_week, title, w1, ring_vendor='uh', is_postpartum=False, delivery_date=None, postpartum_days=None, timeline=None):
+    """
+    show_heatmap_for_stage as PNG bytes, served from the figure cache when
+    the stage's counts haven't changed since they were last drawn.
     """
+    result = compute_stage_compliance(
+        participant_email, participantidentifier, first_week, last_week, title, w1, ring_vendor,
+        is_postpartum, delivery_date, postpartum_days, timeline,
+    )
+    return render_stage_compliance_png(result)
 
-    result = mdh_athena.execQuery(first_date_final_edd_query, ttl_seconds=None)
-    if len(result) == 0:
+def show_percentage_heatmap_for_stage(frame, first_week, last_week, title):
+    weeks = [f"W{w}" for w in range(first_week, last_week + 1)]
+    return _render_percentage_heatmap(stage_compliance_from_frame(frame, weeks, title), title)
+
+@dataclass(frozen=True)
+class ParticipantProfile:
+    """A participant's allparticipants customfields, with dates parsed."""
+
+    participantidentifier: str
+    edd_final: Optional[datetime] = None
+    delivery_date: Optional[datetime] = None
+    postpartum_days: Optional[int] = None
+    ring_vendor: Optional[str] = None
+    uh_email: Optional[str] = None
+
+    @property
+    def w1(self):
+        """Start of gestational week 1 (edd_final - 280 days), or None without an EDD."""
+        if self.edd_final is None:
+            return None
+        return self.edd_final - timedelta(days=280)
+
+
+# participantidentifier -> (loaded_at, ParticipantProfile), filled by load_participant_profiles
+_profiles = {}
+_profiles_lock = threading.Lock()
+PROFILE_TTL_SECONDS = 1800
+
+
+def _parse_day(value):
+    if value is None or str(value) in ('None', 'NaT', 'nan', ''):
+        return None
+    try:
+        return datetime.strptime(str(value), '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def load_participant_profiles(participantidentifiers):
+    """
+    Fetch the profiles of many participants (e.g. a whole segment) with one
+    allparticipants query and keep them in memory for PROFILE_TTL_SECONDS.
+
+    Participants without an allparticipants row get an empty profile.
+
+    Returns:
+        dict of participantidentifier -> ParticipantProfile
+    """
+    now = time.monotonic()
+    with _profiles_lock:
+        missing = sorted({
+            pid for pid in participantidentifiers
+            if pid not in _profiles or now - _profiles[pid][0] > PROFILE_TTL_SECONDS
+        })
+
+    if missing:
+        ids_sql = ", ".join(f"'{pid}'" for pid in missing)
+        query = f"""
+        SELECT
+            participantidentifier,
+            json_extract_scalar(cast(customfields AS JSON), '$.edd_final') AS edd_final,
+            json_extract_scalar(cast(customfields AS JSON), '$.delivery_date') AS delivery_date,
+            json_extract_scalar(cast(customfields AS JSON), '$.postpartum_days') AS postpartum_days,
+            json_extract_scalar(cast(customfields AS JSON), '$.ring_vendor') AS ring_vendor,
+            json_extract_scalar(cast(customfields AS JSON), '$.uh_email') AS uh_email
+        FROM allparticipants
+        WHERE participantidentifier IN ({ids_sql})
+        """
+        result = mdh_athena.execQuery(query, ttl_seconds=PROFILE_TTL_SECONDS)
+        loaded = {pid: ParticipantProfile(pid) for pid in missing}
+        for row in result.to_dict('records') if len(result) > 0 else []:
+            postpartum_days = pd.to_numeric(row['postpartum_days'], errors='coerce')
+            loaded[row['participantidentifier']] = ParticipantProfile(
+                participantidentifier=row['participantidentifier'],
+                edd_final=_parse_day(row['edd_final']),
+                delivery_date=_parse_day(row['delivery_date']),
+                postpartum_days=None if pd.isna(postpartum_days) else int(postpartum_days),
+                ring_vendor=row['ring_vendor'] or None,
+                uh_email=row['uh_email'] or None,
+            )
+        with _profiles_lock:
+            _profiles.update((pid, (now, profile)) for pid, profile in loaded.items())
+
+    with _profiles_lock:
+        return {pid: _profiles[pid][1] for pid in participantidentifiers}
+
+
+def get_participant_profile(participantidentifier):
+    """Profile of one participant, served from load_participant_profiles' cache."""
+    return load_participant_profiles([participantidentifier])[participantidentifier]
+
+
+def participant_first_w1_day(participantidentifier):
+    w1 = get_participant_profile(participantidentifier).w1
+    if w1 is None:
         raise ValueError(f"No edd_final found for participant '{participantidentifier}'. Cannot calculate W1 date.")
-    first_w1_day = result['w1'].iloc[0]
-    format_string = '%Y-%m-%d %H:%M:%S.%f'
-    return datetime.strptime(first_w1_day, format_string)
+    return w1
 
 def get_participant_delivery_info(participantidentifier):
     """Get delivery date and postpartum days from participant custom fields"""
-    query = f"""
-    SELECT
-        participantidentifier,
-        date_parse(
-            json_extract_scalar(cast(customfields AS JSON), '$.edd_final'),
-            '%Y-%m-%d'
-        ) AS edd_final,
-        date_parse(
-            json_extract_scalar(cast(customfields AS JSON), '$.delivery_date'),
-            '%Y-%m-%d'
-        ) AS delivery_date,
-        CAST(json_extract_scalar(cast(customfields AS JSON), '$.postpartum_days') AS integer) AS postpartum_days
-    FROM allparticipants
-    WHERE participantidentifier = '{participantidentifier}'
-    """
-    
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    if len(result) == 0:
-        return None, None, None
-    
-    row = result.iloc[0]
-    edd_final = row['edd_final']
-    delivery_date = row['delivery_date'] 
-    postpartum_days = float(row['postpartum_days']) if row['postpartum_days'] is not None and str(row['postpartum_days']) != 'nan' else None
-    
-    # Convert to datetime objects if not None/NaT
-    if edd_final is not None and str(edd_final) not in ('None', 'NaT', 'nan', ''):
-        edd_final = datetime.strptime(str(edd_final), '%Y-%m-%d %H:%M:%S.%f')
-    else:
-        edd_final = None
-    if delivery_date is not None and str(delivery_date) not in ('None', 'NaT', 'nan', ''):
-        delivery_date = datetime.strptime(str(delivery_date), '%Y-%m-%d %H:%M:%S.%f')
-    else:
-        delivery_date = None
-        
-    return edd_final, delivery_date, postpartum_days
+    profile = get_participant_profile(participantidentifier)
+    return profile.edd_final, profile.delivery_date, profile.postpartum_days
 
 def get_delivery_week(first_w1_day, delivery_date):
     """Calculate the gestational week number when delivery occurred."""
@@ -1018,6 +1698,33 @@ def calculate_postpartum_weeks_from_delivery(participantidentifier, first_week,
     
     return week_ranges
 
+def postpartum_week_counts(days, first_week, last_week, delivery_date, postpartum_days, cap=None):
+    """
+    Count distinct days per postpartum week in one pass of array work.
+
+    Week 1 starts on delivery_date; days after delivery_date + postpartum_days
+    are dropped, the same truncation as calculate_postpartum_weeks_from_delivery.
+
+    Args:
+        days: array-like of dates (date strings, Timestamps or datetime64)
+        first_week, last_week: postpartum week numbers of the stage
+        cap: optional per-week maximum (e.g. 1 for the questionnaire row)
+
+    Returns:
+        list of last_week - first_week + 1 ints; all zeros without a
+        delivery date or postpartum_days.
+    """
+    n_weeks = last_week - first_week + 1
+    if not delivery_date or not postpartum_days:
+        return [0] * n_weeks
+    days = np.unique(np.asarray(pd.to_datetime(days), dtype="datetime64[D]"))
+    offset = (days - np.datetime64(delivery_date.date(), "D")).astype(np.int64)
+    offset = offset[(offset >= 7 * (first_week - 1)) & (offset < 7 * last_week) & (offset <= postpartum_days)]
+    counts = np.bincount(offset // 7 - (first_week - 1), minlength=n_weeks)
+    if cap is not None:
+        counts = np.minimum(counts, cap)
+    return counts.tolist()
+
 def calculate_daily_symptoms_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate daily symptoms for postpartum period based on delivery date"""
     week_ranges = calculate_postpartum_weeks_from_delivery(participantidentifier, first_week, last_week, delivery_date, postpartum_days)
@@ -1038,27 +1745,8 @@ def calculate_daily_symptoms_postpartum(participantidentifier, first_week, last_
     GROUP BY 1, 2
     """
     
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    checkin_dates = set()
-    if len(result) > 0:
-        checkin_dates = set(pd.to_datetime(result['day_date']).dt.date)
-    
-    # Count checkins for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in checkin_dates:
-                count += 1
-            current_date += timedelta(days=1)
-        weekly_counts.append(count)
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = mdh_athena.execQuery(query, columns=['day_date'])
+    return postpartum_week_counts(result['day_date'] if len(result) > 0 else [], first_week, last_week, delivery_date, postpartum_days)
 
 def calculate_daily_questions_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate daily questions for postpartum period based on delivery date"""
@@ -1105,27 +1793,8 @@ def calculate_daily_questions_postpartum(participantidentifier, first_week, last
     ORDER BY day_date
     """
     
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    question_dates = set()
-    if len(result) > 0:
-        question_dates = set(pd.to_datetime(result['day_date']).dt.date)
-    
-    # Count question days for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in question_dates:
-                count += 1
-            current_date += timedelta(days=1)
-        weekly_counts.append(count)
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = mdh_athena.execQuery(query, columns=['day_date'])
+    return postpartum_week_counts(result['day_date'] if len(result) > 0 else [], first_week, last_week, delivery_date, postpartum_days)
 
 def calculate_weekly_bimontly_surveys_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate weekly/bimonthly surveys for postpartum period based on delivery date"""
@@ -1173,33 +1842,9 @@ def calculate_weekly_bimontly_surveys_postpartum(participantidentifier, first_we
     ORDER BY day_date
     """
     
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    
-    # Group surveys by date
-    surveys_by_date = {}
-    if len(result) > 0:
-        for _, row in result.iterrows():
-            date = pd.to_datetime(row['day_date']).date()
-            if date not in surveys_by_date:
-                surveys_by_date[date] = set()
-            surveys_by_date[date].add(row['surveyname'])
-    
-    # Count surveys for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in surveys_by_date:
-                count += len(surveys_by_date[current_date])
-            current_date += timedelta(days=1)
-        weekly_counts.append(min(count, 1))  # Cap at 1 per week
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = mdh_athena.execQuery(query, columns=['day_date', 'surveyname'])
+    # Any submission in the week counts, capped at 1 per week
+    return postpartum_week_counts(result['day_date'] if len(result) > 0 else [], first_week, last_week, delivery_date, postpartum_days, cap=1)
 
 def calculate_weight_measurements_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate weight measurements for postpartum period based on delivery date"""
@@ -1252,27 +1897,8 @@ def calculate_weight_measurements_postpartum(participantidentifier, first_week,
     ORDER BY day_date
     """
     
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    weight_dates = set()
-    if len(result) > 0:
-        weight_dates = set(pd.to_datetime(result['day_date']).dt.date)
-    
-    # Count weight measurements for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in weight_dates:
-                count += 1
-            current_date += timedelta(days=1)
-        weekly_counts.append(count)
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = mdh_athena.execQuery(query, columns=['day_date'])
+    return postpartum_week_counts(result['day_date'] if len(result) > 0 else [], first_week, last_week, delivery_date, postpartum_days)
 
 def calculate_bp_measurements_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate BP measurements for postpartum period based on delivery date"""
@@ -1341,27 +1967,8 @@ def calculate_bp_measurements_postpartum(participantidentifier, first_week, last
     ORDER BY day_date
     """
     
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    bp_dates = set()
-    if len(result) > 0:
-        bp_dates = set(pd.to_datetime(result['day_date']).dt.date)
-    
-    # Count BP measurements for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in bp_dates:
-                count += 1
-            current_date += timedelta(days=1)
-        weekly_counts.append(count)
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = mdh_athena.execQuery(query, columns=['day_date'])
+    return postpartum_week_counts(result['day_date'] if len(result) > 0 else [], first_week, last_week, delivery_date, postpartum_days)
 
 def calculate_daily_wear_from_oura_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate Oura ring wear for postpartum period based on delivery date"""
@@ -1383,29 +1990,9 @@ def calculate_daily_wear_from_oura_postpartum(participantidentifier, first_week,
         AND DATE '{postpartum_end_date.date()}'
     """
     
-    result = mdh_athena.execQuery(query, ttl_seconds=_current_ttl)
-    wear_days = set()
-    if len(result) > 0:
-        for _, row in result.iterrows():
-            if float(row['wear_fraction']) >= 0.75:
-                wear_days.add(pd.to_datetime(row['day_date']).date())
-    
-    # Count wear days for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in wear_days:
-                count += 1
-            current_date += timedelta(days=1)
-        weekly_counts.append(count)
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = mdh_athena.execQuery(query, columns=['day_date', 'wear_fraction'])
+    wear_days = result['day_date'][result['wear_fraction'].astype(float) >= 0.75] if len(result) > 0 else []
+    return postpartum_week_counts(wear_days, first_week, last_week, delivery_date, postpartum_days)
 
 def calculate_daily_wear_from_uh_postpartum(participantidentifier, first_week, last_week, delivery_date, postpartum_days):
     """Calculate UH ring wear for postpartum period based on delivery date"""
@@ -1428,26 +2015,6 @@ def calculate_daily_wear_from_uh_postpartum(participantidentifier, first_week, l
     GROUP BY 1, 2
     """
     
-    result = aws_athena.execQuery(query, ttl_seconds=_current_ttl)
-    wear_days = set()
-    if len(result) > 0:
-        for _, row in result.iterrows():
-            if float(row['samples_in_day']) >= 0.75 * 288:  # 75% of 288 samples per day
-                wear_days.add(pd.to_datetime(row['day_date']).date())
-    
-    # Count wear days for each week
-    weekly_counts = []
-    for week_num, week_start, week_end in week_ranges:
-        count = 0
-        current_date = week_start.date()
-        while current_date <= week_end.date():
-            if current_date in wear_days:
-                count += 1
-            current_date += timedelta(days=1)
-        weekly_counts.append(count)
-    
-    # Pad with zeros for any missing weeks
-    while len(weekly_counts) < (last_week - first_week + 1):
-        weekly_counts.append(0)
-    
-    return weekly_counts
+    result = aws_athena.execQuery(query, columns=['day_date', 'samples_in_day'])
+    wear_days = result['day_date'][result['samples_in_day'].astype(float) >= UH_WEAR_SAMPLES] if len(result) > 0 else []
+    return postpartum_week_counts(wear_days, first_week, last_week, delivery_date, postpartum_days)
@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# The modules are flat files at the repo root, not an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Default query clients run on empty DuckDB fixtures (tests install their
+# own, see local_athena) and keep their .cache/ out of the checkout
+_scratch = Path(tempfile.mkdtemp(prefix="stage-calculation-tests-"))
+for _name in ("mdh", "aws"):
+    (_scratch / "fixtures" / _name).mkdir(parents=True)
+os.environ["QUERY_LOCAL_FIXTURES"] = str(_scratch / "fixtures")
+os.chdir(_scratch)
+
+
+@pytest.fixture
+def local_athena(tmp_path, monkeypatch):
+    """
+    install(mdh={table: frame}, aws={table: frame}) writes each frame as
+    parquet and points the MDH and AWS clients of stage_calculation and
+    cohort_compliance at them through DuckDB, with a cache of their own.
+    """
+    import cohort_compliance
+    import stage_calculation
+    from query_cache import CachedQueryEngine, LocalBackend, MemoryCache
+
+    def install(mdh, aws=None):
+        engines = {}
+        for name, tables in (("mdh", mdh), ("aws", aws or {})):
+            directory = tmp_path / "fixtures" / name
+            directory.mkdir(parents=True)
+            for table, frame in tables.items():
+                frame.to_parquet(directory / f"{table}.parquet", index=False)
+            engines[name] = CachedQueryEngine(LocalBackend(directory), cache_dir=tmp_path / "cache" / name, memory=MemoryCache())
+        monkeypatch.setattr(stage_calculation, "mdh_athena", engines["mdh"])
+        monkeypatch.setattr(stage_calculation, "aws_athena", engines["aws"])
+        monkeypatch.setattr(stage_calculation, "aws", engines["aws"])
+        monkeypatch.setattr(cohort_compliance, "mdh_athena", engines["mdh"])
+        monkeypatch.setattr(cohort_compliance, "aws_athena", engines["aws"])
+        # Profiles cached by an earlier test came from other fixtures
+        monkeypatch.setattr(stage_calculation, "_profiles", {})
+        return engines
+
+    return install
@@ -0,0 +1,51 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+
+# Importing stage_calculation used to take ~1.9s (plotting stack plus client
+# authentication); it now takes ~0.5s, mostly pandas.
+IMPORT_BUDGET_SECONDS = 1.5
+
+HEAVY_MODULES = ("matplotlib", "seaborn", "marimo", "sensorfabric.needle", "sensorfabric.athena")
+
+CREDENTIAL_PREFIXES = ("AWS_", "MDH_", "UH")
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import stage_calculation
+elapsed = time.perf_counter() - start
+from clients import clients
+heavy = sorted(m for m in sys.modules if m.split('.')[0] in ('matplotlib', 'seaborn', 'marimo')
+               or m.startswith(('sensorfabric.needle', 'sensorfabric.athena')))
+print(json.dumps({"elapsed": elapsed, "heavy": heavy, "clients": sorted(clients._clients)}))
+"""
+
+
+def _import_stage_calculation(tmp_path):
+    env = {k: v for k, v in os.environ.items()
+           if not k.startswith(CREDENTIAL_PREFIXES) and k != "QUERY_LOCAL_FIXTURES"}
+    env["PYTHONPATH"] = str(REPO)
+    # Run from an empty directory so no .env or .cache/ from the checkout is picked up
+    out = subprocess.run([sys.executable, "-c", CHILD], env=env, cwd=tmp_path,
+                         capture_output=True, text=True, check=True, timeout=60)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_import_loads_no_plotting_notebook_or_query_modules(tmp_path):
+    result = _import_stage_calculation(tmp_path)
+    assert result["heavy"] == [], f"import stage_calculation pulled in {result['heavy']}"
+
+
+def test_import_builds_no_clients(tmp_path):
+    assert _import_stage_calculation(tmp_path)["clients"] == []
+
+
+def test_import_is_within_budget(tmp_path):
+    # Best of a few runs so a cold disk cache doesn't fail the check
+    elapsed = min(_import_stage_calculation(tmp_path)["elapsed"] for _ in range(3))
+    assert elapsed < IMPORT_BUDGET_SECONDS, f"import stage_calculation took {elapsed:.2f}s"
@@ -0,0 +1,78 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import stage_calculation
+
+PID = "p1"
+W1 = datetime(2024, 1, 1)
+DELIVERY = datetime(2024, 9, 25)
+
+
+def _timestamps(*values):
+    return pd.Series(pd.to_datetime(list(values)), dtype="datetime64[us]")
+
+
+def _questionnaires(*submissions):
+    """surveyresults/surveyquestionresults rows for (surveyname, answer timestamps...) submissions."""
+    results, answers = [], []
+    for i, (name, *answered) in enumerate(submissions):
+        key = f"k{i}"
+        results.append((key, name))
+        answers += [(PID, key, t, f"q{j}") for j, t in enumerate(answered)]
+    answers = pd.DataFrame(answers, columns=["participantidentifier", "surveyresultkey", "startdate", "resultidentifier"])
+    answers["startdate"] = _timestamps(*answers["startdate"])
+    return {
+        "surveyresults": pd.DataFrame(results, columns=["surveyresultkey", "surveyname"]),
+        "surveyquestionresults": answers,
+    }
+
+
+def _mdh_tables(**tables):
+    empty = {
+        "projectdevicedata": pd.DataFrame({"participantidentifier": [], "inserteddate": _timestamps()}),
+        "omronbloodpressure": pd.DataFrame({
+            "participantidentifier": [], "datetimelocal": _timestamps(), "datetime": _timestamps(), "inserteddate": _timestamps(),
+        }),
+        "healthkitv2samples": pd.DataFrame({"participantidentifier": [], "startdate": _timestamps(), "type": []}),
+        "googlefitsamples": pd.DataFrame({"participantidentifier": [], "windowstart": _timestamps(), "type": []}),
+        "ouradailyactivity": pd.DataFrame({"participantidentifier": [], "timestamp": _timestamps(), "nonweartime": []}),
+    }
+    for frame in empty.values():
+        frame["participantidentifier"] = frame["participantidentifier"].astype(str)
+    return {**empty, **tables}
+
+
+@pytest.fixture
+def straddling_submission(local_athena):
+    local_athena(_mdh_tables(**_questionnaires(
+        # Answered the day before and the day after delivery
+        ("Edinburgh Postnatal Depression Scale (EPDS)", "2024-09-24 12:00", "2024-09-26 12:00"),
+        # Before delivery only: no postpartum week
+        ("mMOS (Weekly)", "2024-09-20 12:00"),
+        # PP W2 (Oct 2-8)
+        ("mMOS (Weekly)", "2024-10-03 12:00", "2024-10-04 12:00"),
+        # PP W3 (Oct 9-15), dated by its first answer
+        ("Perinatal Anxiety Screening Scale (PASS)", "2024-10-10 12:00", "2024-10-20 12:00"),
+        # Started on the delivery day, finished in PP W5: counts in PP W1 only
+        ("BRCS (Weekly)", "2024-09-25 12:00", "2024-10-24 12:00"),
+    )))
+
+
+@pytest.mark.parametrize("first_week, last_week, postpartum_days", [(1, 6, 42), (1, 6, 10), (2, 4, 42), (1, 9, 60)])
+def test_postpartum_questionnaires_match_the_per_metric_query(straddling_submission, first_week, last_week, postpartum_days):
+    timeline = stage_calculation.load_participant_timeline(PID, W1, 'oura', DELIVERY, postpartum_days)
+
+    frame = timeline.postpartum_frame(first_week, last_week, DELIVERY, postpartum_days, 'oura')
+
+    expected = stage_calculation.calculate_weekly_bimontly_surveys_postpartum(PID, first_week, last_week, DELIVERY, postpartum_days)
+    assert list(frame["Weekly/bimonthly questionnaire"]) == expected
+
+
+def test_submission_straddling_delivery_counts_in_the_first_postpartum_week(straddling_submission):
+    timeline = stage_calculation.load_participant_timeline(PID, W1, 'oura', DELIVERY, 42)
+
+    frame = timeline.postpartum_frame(1, 6, DELIVERY, 42, 'oura')
+
+    assert list(frame["Weekly/bimonthly questionnaire"]) == [1, 1, 1, 0, 0, 0]
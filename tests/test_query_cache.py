@@ -0,0 +1,386 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import query_cache
+from query_cache import (
+    CachedQueryEngine,
+    LocalBackend,
+    MemoryCache,
+    QueryStore,
+    _abandoned,
+    _active_call,
+    _exec_async,
+    _run_athena,
+    set_max_concurrency,
+)
+
+WEEKS_QUERY = "SELECT week, days FROM weekly WHERE week BETWEEN {} AND {} ORDER BY week"
+QUERY = WEEKS_QUERY.format(9, 40)
+
+
+class CountingBackend:
+    """LocalBackend that counts executions and, with a gate, blocks each one until released."""
+
+    name = "local"
+
+    def __init__(self, fixtures_dir, gate=False):
+        self._local = LocalBackend(fixtures_dir)
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.call = None
+        if not gate:
+            self.release.set()
+        self._lock = threading.Lock()
+
+    def execute(self, query, caller):
+        with self._lock:
+            self.calls += 1
+        # The shared single-flight call this execution serves
+        self.call = _active_call.get()
+        self.started.set()
+        assert self.release.wait(10), "backend never released"
+        return self._local.execute(query, caller)
+
+
+def _write_weekly(fixtures_dir, days_offset=0):
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+    weeks = list(range(1, 43))
+    pd.DataFrame({"week": weeks, "days": [(w + days_offset) % 8 for w in weeks]}).to_parquet(fixtures_dir / "weekly.parquet")
+
+
+@pytest.fixture
+def fixtures_dir(tmp_path):
+    _write_weekly(tmp_path / "fixtures")
+    return tmp_path / "fixtures"
+
+
+def _engine(backend, tmp_path, **kwargs):
+    return CachedQueryEngine(backend, cache_dir=tmp_path / "cache", memory=MemoryCache(), **kwargs)
+
+
+@pytest.fixture
+def max_concurrency():
+    previous = query_cache.MAX_CONCURRENCY
+    set_max_concurrency(2)
+    yield 2
+    set_max_concurrency(previous)
+
+
+class BlockingQueries:
+    """exec_query stand-in that blocks until released and records how many run at once."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.running = 0
+        self.peak = 0
+        self.abandoned = []
+        self._lock = threading.Lock()
+
+    def __call__(self, i):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            self.release.wait(10)
+            self.abandoned.append((i, _abandoned.get().is_set()))
+            return pd.DataFrame({"i": [i]})
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+async def _until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_cancelled_calls_keep_their_slot_until_the_worker_finishes(max_concurrency):
+    queries = BlockingQueries()
+
+    async def run():
+        tasks = [asyncio.ensure_future(_exec_async(queries, i)) for i in range(6)]
+        await _until(lambda: queries.running == max_concurrency)
+
+        # Cancel every task while the first workers are still blocked
+        for task in tasks[:4]:
+            task.cancel()
+        for task in tasks[:4]:
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        # The blocked workers still hold both slots: nothing else may start
+        await asyncio.sleep(0.2)
+        assert queries.running == max_concurrency
+
+        queries.release.set()
+        return await asyncio.gather(*tasks[4:])
+
+    results = asyncio.run(run())
+
+    assert queries.peak == max_concurrency
+    assert [r["i"].iloc[0] for r in results] == [4, 5]
+    # The cancelled calls that had started saw their abandon flag
+    assert sorted(queries.abandoned) == [(0, True), (1, True), (4, False), (5, False)]
+
+
+def test_errors_reach_the_caller_and_free_the_slot(max_concurrency):
+    def failing(i):
+        raise RuntimeError(f"query {i} failed")
+
+    async def run():
+        for i in range(max_concurrency + 1):
+            with pytest.raises(RuntimeError, match=f"query {i} failed"):
+                await _exec_async(failing, i)
+        return query_cache._concurrency_limit()._value
+
+    assert asyncio.run(run()) == max_concurrency
+
+
+def _in_threads(n, fn):
+    results = [None] * n
+
+    def run(i):
+        results[i] = fn()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_identical_concurrent_queries_run_once(fixtures_dir, tmp_path):
+    backend = CountingBackend(fixtures_dir, gate=True)
+    engine = _engine(backend, tmp_path)
+
+    threads, results = _in_threads(8, lambda: engine.execQuery(QUERY))
+    assert backend.started.wait(5)
+    # Every caller has joined the one execution before it finishes
+    _wait_for(lambda: len(backend.call.waiters) == 8)
+    backend.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert backend.calls == 1
+    expected = LocalBackend(fixtures_dir).execute(QUERY, "test")
+    for result in results:
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_abandoned_waiter_leaves_the_shared_query_running(fixtures_dir, tmp_path):
+    backend = CountingBackend(fixtures_dir, gate=True)
+    engine = _engine(backend, tmp_path)
+
+    threads, results = _in_threads(1, lambda: engine.execQuery(QUERY))
+    assert backend.started.wait(5)
+
+    async def join_then_cancel():
+        task = asyncio.ensure_future(engine.execQuery_async(QUERY))
+        await _until(lambda: len(backend.call.waiters) == 2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The blocking caller still wants the result
+        assert not backend.call.orphaned()
+        backend.release.set()
+
+    asyncio.run(join_then_cancel())
+    threads[0].join(10)
+
+    assert backend.calls == 1
+    pd.testing.assert_frame_equal(results[0], LocalBackend(fixtures_dir).execute(QUERY, "test"))
+
+
+def test_query_is_orphaned_once_every_waiter_abandons(fixtures_dir, tmp_path):
+    backend = CountingBackend(fixtures_dir, gate=True)
+    engine = _engine(backend, tmp_path)
+
+    async def cancel_all():
+        tasks = [asyncio.ensure_future(engine.execQuery_async(QUERY)) for _ in range(2)]
+        await _until(lambda: backend.call is not None and len(backend.call.waiters) == 2)
+        tasks[0].cancel()
+        await asyncio.sleep(0.05)
+        assert not backend.call.orphaned()
+        tasks[1].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # What the Athena poll loop checks before stopping the execution
+        assert backend.call.orphaned()
+        backend.release.set()
+
+    asyncio.run(cancel_all())
+    assert backend.calls == 1
+
+
+def test_stale_entry_is_served_then_refreshed_in_the_background(fixtures_dir, tmp_path):
+    backend = CountingBackend(fixtures_dir, gate=True)
+    engine = _engine(backend, tmp_path)
+    backend.release.set()
+    old = engine.execQuery(QUERY, ttl_seconds=0)
+    _write_weekly(fixtures_dir, days_offset=1)
+    new = LocalBackend(fixtures_dir).execute(QUERY, "test")
+    assert not old.equals(new)
+
+    # The refresh blocks in the backend; the stale read must not wait for it
+    backend.release.clear()
+    stale = engine.execQuery(QUERY, ttl_seconds=3600, stale_while_revalidate=True)
+    assert stale.attrs["cache_status"] == "stale"
+    pd.testing.assert_frame_equal(stale, old)
+    _wait_for(lambda: backend.calls == 2)
+
+    backend.release.set()
+    _wait_for(lambda: not query_cache.refresher._pending)
+    fresh = engine.execQuery(QUERY, ttl_seconds=3600, stale_while_revalidate=True)
+
+    assert fresh.attrs["cache_status"] == "fresh"
+    pd.testing.assert_frame_equal(fresh, new)
+    assert backend.calls == 2
+
+
+def _store_with(tmp_path, policy, keys):
+    store = QueryStore(tmp_path / "store", policy=policy)
+    for i, key in enumerate(keys):
+        store.write(key, pd.DataFrame({"week": [i]}), ttl_seconds=None)
+    return store
+
+
+def _evict_one(store):
+    """Evict down to one entry's bytes below the current total."""
+    return store.evict(max_bytes=store.manifest.total_bytes() - 1)
+
+
+def _keys(store):
+    return {entry.key for entry in store.entries()}
+
+
+@pytest.mark.parametrize("policy, reads, evicted", [
+    # Least recently read first: a was read last
+    ("lru", ["a"], "b"),
+    # Least often read first: a was never read
+    ("lfu", ["b", "b", "c"], "a"),
+])
+def test_eviction_follows_the_policy(tmp_path, policy, reads, evicted):
+    store = _store_with(tmp_path, policy, ["a", "b", "c"])
+    for key in reads:
+        store.read(store.lookup(key))
+
+    assert _evict_one(store)["evicted"] == 1
+
+    assert _keys(store) == {"a", "b", "c"} - {evicted}
+    assert not store.path_for(evicted).exists()
+
+
+@pytest.mark.parametrize("policy", ["lru", "lfu"])
+def test_eviction_skips_pinned_entries(tmp_path, policy):
+    store = _store_with(tmp_path, policy, ["a", "b", "c"])
+
+    # "a" is first in line under both policies
+    with store.pin("a"):
+        _evict_one(store)
+        assert _keys(store) == {"a", "c"}
+        store.evict(max_bytes=0)
+        assert _keys(store) == {"a"}
+
+    pd.testing.assert_frame_equal(store.read(store.lookup("a")), pd.DataFrame({"week": [0]}))
+
+
+PIN_HOLDER = """
+import sys
+from pathlib import Path
+sys.path.insert(0, sys.argv[1])
+from query_cache import QueryStore
+
+with QueryStore(Path(sys.argv[2])).pin("a"):
+    print("pinned", flush=True)
+    sys.stdin.readline()
+"""
+
+
+def test_eviction_skips_entries_pinned_by_another_process(tmp_path):
+    store = _store_with(tmp_path, "lru", ["a", "b"])
+    repo = Path(__file__).resolve().parent.parent
+    holder = subprocess.Popen(
+        [sys.executable, "-c", PIN_HOLDER, str(repo), str(store.cache_dir)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        assert holder.stdout.readline().strip() == "pinned"
+        store.evict(max_bytes=0)
+        assert _keys(store) == {"a"}
+    finally:
+        holder.communicate("done\n", timeout=10)
+
+    store.evict(max_bytes=0)
+    assert _keys(store) == set()
+
+
+def test_eviction_leaves_an_entry_rewritten_since_it_was_listed(tmp_path):
+    store = _store_with(tmp_path, "lru", ["a"])
+    listed = store.lookup("a")
+    time.sleep(0.01)
+    store.write("a", pd.DataFrame({"week": [1]}), ttl_seconds=None)
+
+    assert store._evict_entry(listed) is None
+
+    pd.testing.assert_frame_equal(store.read(store.lookup("a")), pd.DataFrame({"week": [1]}))
+
+
+@pytest.mark.parametrize("damage", [
+    lambda data: data[: len(data) // 2],
+    lambda data: b"\0" * len(data),
+], ids=["truncated", "zeroed"])
+def test_damaged_entry_is_healed_instead_of_raising(fixtures_dir, tmp_path, damage):
+    backend = CountingBackend(fixtures_dir)
+    expected = _engine(backend, tmp_path).execQuery(QUERY)
+    store = QueryStore.for_dir(tmp_path / "cache")
+    path = store.cache_dir / store.entries()[0].path
+    path.write_bytes(damage(path.read_bytes()))
+
+    # A fresh memory tier, so the lookup goes to the damaged file
+    result = _engine(backend, tmp_path).execQuery(QUERY)
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert backend.calls == 2
+    assert store.manifest.counters()["corrupt"] == 1
+    # The re-queried result replaced the damaged file
+    pd.testing.assert_frame_equal(_engine(backend, tmp_path).execQuery(QUERY), expected)
+    assert backend.calls == 2
+
+
+@pytest.mark.parametrize("lo, hi", [(9, 19), (30, 40), (15, 15)])
+@pytest.mark.parametrize("columns", [None, ["days"]])
+def test_narrower_week_range_is_sliced_from_a_cached_wider_range(fixtures_dir, tmp_path, lo, hi, columns):
+    backend = CountingBackend(fixtures_dir)
+    _engine(backend, tmp_path).execQuery(QUERY, week_range=(9, 40))
+
+    result = _engine(backend, tmp_path).execQuery(WEEKS_QUERY.format(lo, hi), columns=columns, week_range=(lo, hi))
+
+    assert backend.calls == 1
+    expected = LocalBackend(fixtures_dir).execute(WEEKS_QUERY.format(lo, hi), "test")
+    pd.testing.assert_frame_equal(result, expected if columns is None else expected[columns])
+    assert QueryStore.for_dir(tmp_path / "cache").manifest.counters()["range_hits"] == 1
+
+
+def test_athena_connector_without_the_pinned_internals_fails_clearly():
+    class Connector:
+        client = None
+
+        def queryResults(self, executionId, nextToken=None, columnNames=[]):
+            raise AssertionError("not reached")
+
+    with pytest.raises(RuntimeError, match=r"has no startQueryExec: .*sensorfabric==3\.3\.2"):
+        _run_athena(Connector(), "SELECT 1", "test", "aws")
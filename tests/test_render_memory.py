@@ -0,0 +1,71 @@
+import gc
+import resource
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.figure import Figure
+
+from stage_calculation import stage_compliance_from_frame, render_stage_compliance
+
+# Renders per run, as in a long notebook or app session
+RENDERS = 300
+WARMUP = 20
+# Before the heatmaps moved off pyplot, 300 renders kept 600+ figures and
+# grew RSS by ~2 GiB; now the growth is allocator noise.
+RSS_BUDGET_MIB = 100
+
+LABELS = [
+    "Symptom check-in (daily)",
+    "Daily questions (1-5 Q)",
+    "Weekly/bimonthly questionnaire",
+    "Weight(per week)",
+    "BP (per week)",
+    "Oura - Smart ring wear (~19h/day)",
+]
+# A postpartum stage (PP W1-PP W6), the smallest heatmap the app draws
+WEEKS = [f"PP W{w}" for w in range(1, 7)]
+
+
+def _rss_mib():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2**20
+
+
+def _render_histogram(hours):
+    """Same figure as the ring wear distribution in average_compliance_nb."""
+    fig = Figure(figsize=(10, 3))
+    ax = fig.subplots()
+    ax.hist(hours, bins=48, range=(0, 24), color='steelblue', edgecolor='white', alpha=0.85)
+    ax.axvline(x=18, color='red', linestyle='--', linewidth=1.5, label='Target: 18h')
+    ax.axvline(x=np.median(hours), color='orange', linestyle='-', linewidth=1.5)
+    ax.set_xlabel("Daily Wear (hours)")
+    ax.legend()
+    fig.tight_layout()
+    return fig
+
+
+def _render_once(i, rng):
+    frame = {label: [int(x) for x in rng.integers(0, 8, len(WEEKS))] for label in LABELS}
+    result = stage_compliance_from_frame(frame, WEEKS, f"Participant {i}")
+    render_stage_compliance(result)
+    _render_histogram(rng.uniform(0, 24, 500))
+
+
+def test_repeated_renders_keep_no_figures_and_bounded_memory():
+    rng = np.random.default_rng(0)
+    for i in range(WARMUP):
+        _render_once(i, rng)
+    gc.collect()
+    baseline = _rss_mib()
+
+    for i in range(RENDERS):
+        _render_once(i, rng)
+        assert plt.get_fignums() == []
+    gc.collect()
+
+    growth = _rss_mib() - baseline
+    assert growth < RSS_BUDGET_MIB, f"RSS grew {growth:.0f} MiB over {RENDERS} renders"
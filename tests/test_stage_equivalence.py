@@ -0,0 +1,397 @@
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import stage_calculation
+from query_cache import current_policy
+from stage_calculation import EXCEPTION_SURVEYS, WEEKLY_SURVEYS
+
+W1 = datetime(2024, 1, 1)
+# Gestational week 39
+DELIVERY = datetime(2024, 9, 25)
+PRENATAL_STAGES = [(9, 19), (20, 29), (30, 42)]
+
+
+def _study_days(w1):
+    return pd.date_range(w1, w1 + timedelta(days=330), freq="D")
+
+
+def _at(day, rng):
+    """A random time on day; hours before 7 fall on the previous day after the -7h shift."""
+    return day + timedelta(hours=int(rng.integers(0, 24)), minutes=int(rng.integers(0, 60)))
+
+
+def participant_tables(pid, w1, seed):
+    """
+    Random but reproducible MDH rows and Ultrahuman samples for one
+    participant over the whole study, covering every table the stage
+    queries read.
+    """
+    rng = np.random.default_rng(seed)
+    days = _study_days(w1)
+    checkins, answers, results, omron, healthkit, googlefit, oura, uh = [], [], [], [], [], [], [], []
+
+    def submit(name, day, n_answers, spread_days=0):
+        key = f"{pid}-{len(results)}"
+        results.append((key, name))
+        for q in range(n_answers):
+            answered = _at(day + timedelta(days=int(rng.integers(0, spread_days + 1))), rng)
+            answers.append((pid, key, answered, f"q{q}"))
+
+    for day in days:
+        checkins += [(pid, _at(day, rng))] * int(rng.random() < 0.7) * int(rng.integers(1, 3))
+        for name in ("EMA AM", "EMA PM"):
+            if rng.random() < 0.5:
+                submit(name, day, int(rng.integers(3, 9)))
+        if rng.random() < 0.15:
+            when = _at(day, rng)
+            # Some Omron rows only have the UTC datetime
+            omron.append((pid, None if rng.random() < 0.3 else when, when, when))
+        for kind, p in (("Weight", 0.15), ("BloodPressureSystolic", 0.1), ("BloodPressureDiastolic", 0.05)):
+            if rng.random() < p:
+                healthkit.append((pid, _at(day, rng), kind))
+        for kind, p in (("Weight", 0.1), ("blood_pressure_systolic", 0.1)):
+            if rng.random() < p:
+                googlefit.append((pid, _at(day, rng), kind))
+        oura.append((pid, day + timedelta(hours=4), float(rng.integers(0, 40000))))
+        if rng.random() < 0.8:
+            samples = int(rng.integers(150, 289))
+            uh += [(pid, f"{day:%Y-%m-%d}T00:00:00-07:00", t) for t in range(samples)]
+
+    for week_start in days[::7]:
+        for name in WEEKLY_SURVEYS:
+            if rng.random() < 0.5:
+                # Some are finished days later, in another week
+                submit(name, week_start + timedelta(days=int(rng.integers(0, 7))), 3, spread_days=9)
+    for name in EXCEPTION_SURVEYS:
+        for day in rng.choice(days, 6, replace=False):
+            submit(name, pd.Timestamp(day), 2, spread_days=3)
+
+    def frame(rows, columns, times=()):
+        df = pd.DataFrame(rows, columns=columns)
+        for column in times:
+            df[column] = pd.to_datetime(df[column]).astype("datetime64[us]")
+        return df
+
+    return {
+        "projectdevicedata": frame(checkins, ["participantidentifier", "inserteddate"], ["inserteddate"]),
+        "surveyresults": frame(results, ["surveyresultkey", "surveyname"]),
+        "surveyquestionresults": frame(answers, ["participantidentifier", "surveyresultkey", "startdate", "resultidentifier"], ["startdate"]),
+        "omronbloodpressure": frame(omron, ["participantidentifier", "datetimelocal", "datetime", "inserteddate"], ["datetimelocal", "datetime", "inserteddate"]),
+        "healthkitv2samples": frame(healthkit, ["participantidentifier", "startdate", "type"], ["startdate"]),
+        "googlefitsamples": frame(googlefit, ["participantidentifier", "windowstart", "type"], ["windowstart"]),
+        "ouradailyactivity": frame(oura, ["participantidentifier", "timestamp", "nonweartime"], ["timestamp"]),
+    }, {
+        "temp": frame(uh, ["pid", "object_day_start_timestamp_iso8601_tz", "object_values_timestamp"]),
+    }
+
+
+def cohort_tables(*participants):
+    """MDH and AWS tables of several (pid, w1, seed) participants."""
+    mdh, aws = {}, {}
+    for pid, w1, seed in participants:
+        for tables, rows in zip((mdh, aws), participant_tables(pid, w1, seed)):
+            for name, frame in rows.items():
+                tables[name] = pd.concat([tables[name], frame], ignore_index=True) if name in tables else frame
+    return mdh, aws
+
+
+def per_metric_prenatal(pid, first_week, last_week, w1, ring_vendor):
+    """A prenatal stage's rows from the original one-query-per-metric functions."""
+    frame = {
+        "Symptom check-in (daily)": stage_calculation.calculate_daily_symptoms(pid, first_week, last_week, w1),
+        "Daily questions (1-5 Q)": stage_calculation.calculate_daily_questions(pid, first_week, last_week, w1),
+        "Weekly/bimonthly questionnaire": stage_calculation.calculate_weekly_bimontly_surveys(pid, first_week, last_week, w1),
+        "Weight(per week)": stage_calculation.calculate_weight_measurements(pid, first_week, last_week, w1),
+        "BP (per week)": stage_calculation.calculate_bp_measurements(pid, first_week, last_week, w1),
+    }
+    if ring_vendor == 'oura':
+        frame["Oura - Smart ring wear (~19h/day)"] = stage_calculation.calculate_daily_wear_from_oura(pid, first_week, last_week, w1)
+    else:
+        frame["UH - Smart ring wear (~19h/day)"] = stage_calculation.calculate_daily_wear_from_uh(pid, w1, first_week, last_week)
+    return frame
+
+
+def per_metric_postpartum(pid, first_week, last_week, delivery_date, postpartum_days, ring_vendor):
+    """A postpartum stage's rows from the original one-query-per-metric functions."""
+    args = (pid, first_week, last_week, delivery_date, postpartum_days)
+    frame = {
+        "Symptom check-in (daily)": stage_calculation.calculate_daily_symptoms_postpartum(*args),
+        "Daily questions (1-5 Q)": stage_calculation.calculate_daily_questions_postpartum(*args),
+        "Weekly/bimonthly questionnaire": stage_calculation.calculate_weekly_bimontly_surveys_postpartum(*args),
+        "Weight(per week)": stage_calculation.calculate_weight_measurements_postpartum(*args),
+        "BP (per week)": stage_calculation.calculate_bp_measurements_postpartum(*args),
+    }
+    if ring_vendor == 'oura':
+        frame["Oura - Smart ring wear (~19h/day)"] = stage_calculation.calculate_daily_wear_from_oura_postpartum(*args)
+    else:
+        frame["UH - Smart ring wear (~19h/day)"] = stage_calculation.calculate_daily_wear_from_uh_postpartum(*args)
+    return frame
+
+
+@pytest.fixture
+def participant(local_athena, monkeypatch):
+    monkeypatch.delenv("UH_API_CALL", raising=False)
+    local_athena(*cohort_tables(("p1", W1, 1)))
+    return "p1"
+
+
+@pytest.mark.parametrize("first_week, last_week", PRENATAL_STAGES)
+@pytest.mark.parametrize("ring_vendor", ["oura", "uh"])
+def test_fused_stage_query_matches_the_per_metric_queries(participant, first_week, last_week, ring_vendor):
+    expected = per_metric_prenatal(participant, first_week, last_week, W1, ring_vendor)
+    # The fused query has no UH row; that comes from AWS either way
+    expected.pop("UH - Smart ring wear (~19h/day)", None)
+
+    fused = stage_calculation.calculate_stage_metrics(participant, first_week, last_week, include_oura=ring_vendor == 'oura', w1=W1)
+
+    assert fused == expected
+    # Every row has data, so the comparison isn't between all-zero rows
+    assert all(sum(rows) > 0 for rows in fused.values())
+
+
+STAGES = [(*stage, False) for stage in PRENATAL_STAGES] + [(1, 6, True)]
+
+
+@pytest.mark.parametrize("first_week, last_week, is_postpartum", STAGES)
+@pytest.mark.parametrize("ring_vendor", ["oura", "uh"])
+@pytest.mark.parametrize("delivery_date, postpartum_days", [(DELIVERY, 42), (DELIVERY, 20), (None, None)])
+def test_every_stage_path_matches_the_per_metric_queries(
+    participant, monkeypatch, first_week, last_week, is_postpartum, ring_vendor, delivery_date, postpartum_days
+):
+    # Without a delivery date a postpartum stage falls back to gestational weeks
+    if is_postpartum and delivery_date:
+        expected = per_metric_postpartum(participant, first_week, last_week, delivery_date, postpartum_days, ring_vendor)
+    else:
+        expected = per_metric_prenatal(participant, first_week, last_week, W1, ring_vendor)
+    assert any(sum(rows) > 0 for rows in expected.values())
+
+    def counts(fused, timeline=None):
+        monkeypatch.setattr(stage_calculation, "FUSED_STAGE_QUERY", fused)
+        result = stage_calculation.compute_stage_compliance(
+            "p1@example.com", participant, first_week, last_week, "Stage", W1, ring_vendor,
+            is_postpartum, delivery_date, postpartum_days, timeline,
+        )
+        return {label: [int(v) for v in row] for label, row in result.counts.iterrows()}
+
+    timeline = stage_calculation.load_participant_timeline(participant, W1, ring_vendor, delivery_date, postpartum_days)
+
+    assert counts(fused=False) == expected
+    assert counts(fused=True) == expected
+    assert counts(fused=True, timeline=timeline) == expected
+
+
+@pytest.mark.parametrize("first_week, last_week, postpartum_days, cap, expected", [
+    (1, 4, 42, None, [3, 1, 1, 1]),
+    # Day 21 is past a 20-day postpartum period
+    (1, 4, 20, None, [3, 1, 1, 0]),
+    (2, 3, 42, None, [1, 1]),
+    (1, 4, 42, 1, [1, 1, 1, 1]),
+    (1, 2, None, None, [0, 0]),
+])
+def test_postpartum_week_counts_buckets_distinct_days_from_delivery(first_week, last_week, postpartum_days, cap, expected):
+    offsets = [-1, 0, 0, 3, 6, 7, 20, 21, 60]
+    days = [DELIVERY + timedelta(days=d, hours=13) for d in offsets]
+
+    assert stage_calculation.postpartum_week_counts(days, first_week, last_week, DELIVERY, postpartum_days, cap) == expected
+
+
+def _fail(*args, **kwargs):
+    raise RuntimeError("query failed")
+
+
+@pytest.mark.parametrize("max_workers", [1, 3])
+def test_evaluate_metrics_maps_a_failing_job_to_none_and_keeps_the_rest(max_workers):
+    jobs = {
+        "a": lambda: [1],
+        "b": _fail,
+        # Jobs see the caller's query policy, also on the pool
+        "c": lambda: [current_policy().ttl_seconds],
+    }
+
+    with stage_calculation.query_policy(ttl_seconds=123):
+        results = stage_calculation.evaluate_metrics(jobs, max_workers=max_workers)
+
+    assert results == {"a": [1], "b": None, "c": [123]}
+    assert list(results) == ["a", "b", "c"]
+
+
+UH_WEAR = "UH - Smart ring wear (~19h/day)"
+
+
+@pytest.mark.parametrize("fused, failing, lost", [
+    (False, "calculate_weight_measurements", ["Weight(per week)"]),
+    (False, "calculate_daily_wear_from_uh", [UH_WEAR]),
+    # The fused query carries every MDH row, so they fail together
+    (True, "calculate_stage_metrics", list(stage_calculation._STAGE_METRIC_COLUMNS)),
+    (True, "calculate_daily_wear_from_uh", [UH_WEAR]),
+])
+def test_failing_metric_becomes_nan_without_losing_the_others(participant, monkeypatch, fused, failing, lost):
+    expected = per_metric_prenatal(participant, 20, 29, W1, 'uh')
+    monkeypatch.setattr(stage_calculation, "FUSED_STAGE_QUERY", fused)
+    monkeypatch.setattr(stage_calculation, failing, _fail)
+
+    result = stage_calculation.compute_stage_compliance("p1@example.com", participant, 20, 29, "Stage", W1, 'uh')
+
+    assert list(result.counts.index) == list(expected)
+    for label, rows in expected.items():
+        if label in lost:
+            assert result.counts.loc[label].isna().all()
+            assert result.percentages.loc[label].isna().all()
+        else:
+            assert list(result.counts.loc[label]) == rows
+
+
+def baseline_scores(frame):
+    """
+    The pre-NumPy scoring, cell by cell: each row's count as a percentage of
+    its weekly target (capped at 100%), the truncated self-report (first
+    three rows) and biometrics averages over three metrics, and $3/$4 for
+    an average of at least 70%. A week with no value at all has no averages
+    and earns nothing.
+    """
+    labels = list(frame)
+    n_weeks = len(next(iter(frame.values())))
+    percentages = {
+        label: [np.nan if pd.isna(c) else min(c / stage_calculation.METRIC_TARGETS[label], 1) * 100 for c in counts]
+        for label, counts in frame.items()
+    }
+    self_report, biometrics, compensation = [], [], []
+    for week in range(n_weeks):
+        if all(pd.isna(frame[label][week]) for label in labels):
+            self_report.append(np.nan)
+            biometrics.append(np.nan)
+            compensation.append(0)
+            continue
+        sr = int(sum(percentages[label][week] for label in labels[:3] if not pd.isna(percentages[label][week]))) / 3
+        bio = int(sum(percentages[label][week] for label in labels[3:] if not pd.isna(percentages[label][week]))) / 3
+        self_report.append(sr)
+        biometrics.append(bio)
+        compensation.append((sr >= 70) * 3 + (bio >= 70) * 4)
+    return percentages, self_report, biometrics, compensation
+
+
+def _random_frame(rng, n_weeks, ring):
+    labels = [
+        "Symptom check-in (daily)", "Daily questions (1-5 Q)", "Weekly/bimonthly questionnaire",
+        "Weight(per week)", "BP (per week)", ring,
+    ]
+    # Counts up to 9 exceed every target; about one cell in ten is missing
+    counts = rng.integers(0, 10, (len(labels), n_weeks)).astype(float)
+    counts[rng.random(counts.shape) < 0.1] = np.nan
+    # And one week with no value at all
+    counts[:, rng.integers(n_weeks)] = np.nan
+    return dict(zip(labels, counts.tolist()))
+
+
+def _assert_scores_match(matrix, frame, participant=()):
+    """Compare matrix, or participant i of a stacked matrix, with baseline_scores(frame)."""
+    percentages, self_report, biometrics, compensation = baseline_scores(frame)
+    np.testing.assert_allclose(matrix.percentages[participant], np.array(list(percentages.values())))
+    np.testing.assert_allclose(matrix.self_report_average[participant], self_report)
+    np.testing.assert_allclose(matrix.biometrics_average[participant], biometrics)
+    np.testing.assert_array_equal(matrix.weekly_compensation[participant], compensation)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("ring", ["Oura - Smart ring wear (~19h/day)", "UH - Smart ring wear (~19h/day)"])
+def test_compliance_matrix_matches_the_baseline_scoring(seed, ring):
+    rng = np.random.default_rng(seed)
+    frames = [_random_frame(rng, 11, ring) for _ in range(4)]
+    weeks = [f"W{w}" for w in range(9, 20)]
+
+    for frame in frames:
+        matrix = stage_calculation.ComplianceMatrix.from_frame(frame, weeks)
+        _assert_scores_match(matrix, frame)
+        _, self_report, _, compensation = baseline_scores(frame)
+        annotations = matrix.annotations()
+        assert annotations[-3].tolist() == ["" if pd.isna(v) else f"{v:.1f}%" for v in self_report]
+        assert annotations[-1].tolist() == [f"${c}" for c in compensation]
+
+    # A stack of participants scores each one as on its own
+    stacked = stage_calculation.ComplianceMatrix.from_counts(list(frames[0]), weeks, [list(f.values()) for f in frames])
+    for i, frame in enumerate(frames):
+        _assert_scores_match(stacked, frame, i)
+
+
+def test_stage_compliance_from_queries_matches_the_baseline_scoring(participant):
+    frame = per_metric_prenatal(participant, 9, 19, W1, 'oura')
+
+    result = stage_calculation.compute_stage_compliance("p1@example.com", participant, 9, 19, "Stage", W1, 'oura')
+
+    _assert_scores_match(result.matrix, frame)
+    assert result.total_compensation == sum(baseline_scores(frame)[3])
+
+
+# (pid, W1, ring vendor, delivery date, postpartum days); p4 has no EDD
+COHORT = [
+    ("p1", W1, "uh", DELIVERY, 42),
+    ("p2", datetime(2024, 2, 5), "oura", datetime(2024, 10, 20), 20),
+    ("p3", datetime(2024, 3, 4), "uh", None, None),
+    ("p4", None, "uh", None, None),
+]
+COHORT_TODAY = datetime(2024, 12, 15)
+
+
+def _allparticipants(cohort):
+    rows = []
+    for pid, w1, vendor, delivery, pp_days in cohort:
+        fields = {"ring_vendor": vendor}
+        if w1:
+            fields["edd_final"] = f"{w1 + timedelta(days=280):%Y-%m-%d}"
+        if delivery:
+            fields["delivery_date"] = f"{delivery:%Y-%m-%d}"
+            fields["postpartum_days"] = str(pp_days)
+        rows.append((pid, json.dumps(fields)))
+    return pd.DataFrame(rows, columns=["participantidentifier", "customfields"])
+
+
+def per_metric_cohort_counts(pid, w1, vendor, delivery, pp_days, today):
+    """
+    One participant's METRICS x WEEKS counts from the per-metric queries,
+    NaN where a week hasn't started, a prenatal week starts on or after
+    delivery, or a postpartum week starts past the postpartum period.
+    """
+    from cohort_compliance import METRICS, POSTPARTUM_WEEKS, PRENATAL_WEEKS, WEEKS
+
+    counts = np.full((len(METRICS), len(WEEKS)), np.nan)
+    if w1 is None:
+        return counts
+    frames = [per_metric_prenatal(pid, PRENATAL_WEEKS[0], PRENATAL_WEEKS[-1], w1, vendor)]
+    starts = [w1 + timedelta(days=7 * (w - 1)) for w in PRENATAL_WEEKS]
+    valid = [start <= today and (delivery is None or start < delivery) for start in starts]
+    if delivery:
+        frames.append(per_metric_postpartum(pid, POSTPARTUM_WEEKS[0], POSTPARTUM_WEEKS[-1], delivery, pp_days, vendor))
+        starts = [delivery + timedelta(days=7 * (w - 1)) for w in POSTPARTUM_WEEKS]
+        valid += [start <= today and (start - delivery).days <= pp_days for start in starts]
+    else:
+        frames.append({label: [np.nan] * len(POSTPARTUM_WEEKS) for label in frames[0]})
+        valid += [False] * len(POSTPARTUM_WEEKS)
+    for row, rows in enumerate(zip(*(frame.values() for frame in frames))):
+        counts[row] = [v for part in rows for v in part]
+    counts[:, ~np.asarray(valid)] = np.nan
+    return counts
+
+
+def test_cohort_tensor_matches_the_per_metric_queries(local_athena, monkeypatch):
+    import cohort_compliance
+
+    monkeypatch.delenv("UH_API_CALL", raising=False)
+    # Batches of two, so the cohort takes two set-based queries of each kind
+    monkeypatch.setattr(cohort_compliance, "COHORT_QUERY_BATCH", 2)
+    mdh, aws = cohort_tables(*[(pid, w1 or W1, seed) for seed, (pid, w1, *_) in enumerate(COHORT)])
+    local_athena({**mdh, "allparticipants": _allparticipants(COHORT)}, aws)
+
+    cohort = cohort_compliance.build_cohort_compliance([pid for pid, *_ in COHORT], today=COHORT_TODAY)
+
+    assert cohort.participants == ["p1", "p2", "p3", "p4"]
+    for i, (pid, w1, vendor, delivery, pp_days) in enumerate(COHORT):
+        expected = per_metric_cohort_counts(pid, w1, vendor, delivery, pp_days, COHORT_TODAY)
+        np.testing.assert_array_equal(cohort.matrix.counts[i], expected, err_msg=pid)
+        _assert_scores_match(cohort.matrix, dict(zip(cohort_compliance.METRICS, expected.tolist())), i)
+    # Weeks with values: p1 W9-W39 and PP W1-W6; p2 W9-W37 and PP W1-W3
+    # (PP W4 starts past its 20 days); p3 W9-W41 (today); p4 none
+    assert (~np.isnan(cohort.matrix.counts[:, 0])).sum(axis=-1).tolist() == [37, 32, 33, 0]
@@ -0,0 +1,143 @@
+"""UltrahumanClient against a local http.server stand-in (UH_API_ENDPOINT)."""
+
+import json
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import uh_client
+from uh_client import UltrahumanClient
+
+FULL_DAY = {"data": {"metric_data": [{"type": "temp", "object": {"values": [{"value": 36}] * 288}}]}}
+
+
+class StandIn:
+    """
+    Ultrahuman metrics endpoint whose replies are scripted per date.
+
+    script maps "YYYY-MM-DD" to a list of (status, headers, delay) replies,
+    used in order; the last one repeats. Every request's arrival time and
+    every reply's send time are recorded per date.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.requests = {}
+        self.replied = {}
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                day = parse_qs(urlparse(self.path).query)["date"][0]
+                with stand_in.lock:
+                    seen = stand_in.requests.setdefault(day, [])
+                    seen.append(time.monotonic())
+                    replies = stand_in.script.get(day, [(200, {}, 0)])
+                    status, headers, delay = replies[min(len(seen), len(replies)) - 1]
+                time.sleep(delay)
+                body = json.dumps(FULL_DAY if status == 200 else {"error": status}).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                with stand_in.lock:
+                    stand_in.replied.setdefault(day, []).append(time.monotonic())
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}/api/v1/metrics"
+
+    def count(self, day):
+        return len(self.requests.get(day.isoformat(), []))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in_factory():
+    servers = []
+
+    def make(script):
+        servers.append(StandIn(script))
+        return servers[-1]
+
+    yield make
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(uh_client, "BACKOFF_INITIAL_SECONDS", 0.01)
+
+
+def make_client(stand_in, cache_dir, **kwargs):
+    return UltrahumanClient(auth_key="test-key", endpoint=stand_in.endpoint, cache_dir=cache_dir, **kwargs)
+
+
+def test_429_then_5xx_then_200_is_retried_and_honours_retry_after(stand_in_factory, tmp_path):
+    day = date.today() - timedelta(days=3)
+    stand_in = stand_in_factory({day.isoformat(): [(429, {"Retry-After": "0.5"}, 0), (503, {}, 0), (200, {}, 0)]})
+    client = make_client(stand_in, tmp_path, max_retries=5)
+
+    assert client.daily_wear("a@example.org", day) == 100.0
+    assert stand_in.count(day) == 3
+    throttled_at = stand_in.replied[day.isoformat()][0]
+    assert stand_in.requests[day.isoformat()][1] - throttled_at >= 0.45
+
+
+def test_retry_after_pauses_every_worker(stand_in_factory, tmp_path):
+    throttled = date.today() - timedelta(days=5)
+    other = date.today() - timedelta(days=4)
+    stand_in = stand_in_factory({
+        throttled.isoformat(): [(429, {"Retry-After": "0.6"}, 0), (200, {}, 0)],
+        # Replies after the 429 has been seen, then would retry almost at once
+        other.isoformat(): [(503, {}, 0.15), (200, {}, 0)],
+    })
+    client = make_client(stand_in, tmp_path, max_workers=2)
+
+    assert client.daily_wear_range("a@example.org", throttled, other) == {throttled: 100.0, other: 100.0}
+    throttled_at = stand_in.replied[throttled.isoformat()][0]
+    assert stand_in.requests[other.isoformat()][1] - throttled_at >= 0.55
+
+
+def test_gives_up_after_max_retries(stand_in_factory, tmp_path):
+    day = date.today() - timedelta(days=2)
+    stand_in = stand_in_factory({day.isoformat(): [(500, {}, 0)]})
+    client = make_client(stand_in, tmp_path, max_retries=3)
+
+    assert client.daily_wear("a@example.org", day) == 0.0
+    assert stand_in.count(day) == 4
+    # A failed day is not cached: the next read asks again
+    assert client.store.samples(client.endpoint, "a@example.org", day, day) == {}
+
+
+def test_only_past_days_are_cached(stand_in_factory, tmp_path):
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    stand_in = stand_in_factory({})
+    client = make_client(stand_in, tmp_path)
+
+    first = client.daily_wear_range("a@example.org", yesterday, today)
+    assert first == {yesterday: 100.0, today: 100.0}
+    assert client.store.samples(client.endpoint, "a@example.org", yesterday, today) == {yesterday: 288}
+    assert {p.name for p in tmp_path.iterdir()} <= {uh_client.UH_STORE_FILE, uh_client.UH_STORE_FILE + "-wal", uh_client.UH_STORE_FILE + "-shm"}
+
+    assert client.daily_wear_range("a@example.org", yesterday, today) == first
+    assert stand_in.count(yesterday) == 1  # served from the store
+    assert stand_in.count(today) == 2  # today is always fetched live
@@ -0,0 +1,427 @@
+"""
+Ultrahuman partner API client for the UH_API_CALL path.
+
+UltrahumanClient keeps one requests.Session (a pooled keep-alive connection
+to the API host) and fetches a participant's days concurrently on a bounded
+thread pool, so a stage costs a handful of round-trip times instead of ~77
+sequential HTTPS calls.
+
+A 429 response pauses every worker until its Retry-After has passed (or an
+exponential backoff when the header is missing); 5xx and connection errors
+are retried with the same backoff.
+
+For days strictly before today only the derived number of temperature
+samples is kept, in one SQLite table keyed by (endpoint, email, day)
+(.cache/uh_wear.sqlite), so a week is a single range read instead of seven
+JSON parses. Set UH_STORE_RAW=1 to keep the zlib-compressed response too.
+Today and future days are always fetched live. Response files left in
+.cache/ by the previous one-file-per-day cache are imported the first time
+their day is read and then deleted; `python uh_client.py migrate` imports
+them in bulk.
+
+Point UH_API_ENDPOINT at a local HTTP stand-in to exercise the client
+without the real API.
+
+Usage:
+    from uh_client import get_client
+
+    client = get_client()
+    wear = client.daily_wear_range(email, start, end)   # {date: percent of 288 samples}
+    counts = client.weekly_wear_counts(email, [(start, end), ...])
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from query_cache import metrics
+
+logger = logging.getLogger(__name__)
+
+UH_API_ENDPOINT = os.getenv("UH_API_ENDPOINT", "https://partner.ultrahuman.com/api/v1/metrics")
+UH_MAX_CONCURRENCY = int(os.getenv("UH_API_MAX_CONCURRENCY", 8))
+UH_MAX_RETRIES = int(os.getenv("UH_API_MAX_RETRIES", 5))
+UH_REQUEST_TIMEOUT = float(os.getenv("UH_API_TIMEOUT_SECONDS", 30))
+UH_STORE_RAW = os.getenv("UH_STORE_RAW", "").lower() in ("1", "true", "yes")
+UH_STORE_FILE = "uh_wear.sqlite"
+
+# Responses left by the previous one-file-per-day cache: one sha256-named
+# JSON file per (email, day) directly under .cache/
+UH_CACHE_DIR = Path(".cache")
+_UH_CACHE_FILE_RE = re.compile(r"^[0-9a-f]{64}$")
+
+BACKOFF_INITIAL_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+# Five-minute temperature samples in a fully worn day
+EXPECTED_SAMPLES_PER_DAY = 288
+WEAR_DAY_PERCENT = 75
+
+
+def cache_key(params: dict, endpoint: str) -> str:
+    """sha256 of the request URL; the file name of a cached response."""
+    q = urlencode(sorted(params.items()))
+    raw = f"{endpoint}?{q}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _as_date(day) -> date:
+    return day.date() if isinstance(day, datetime) else day
+
+
+def temp_sample_count(data: dict) -> int:
+    """Number of temperature samples in a metrics response (0 without a temp metric)."""
+    by_type = {d["type"]: d for d in data["data"]["metric_data"]}
+    if "temp" not in by_type:
+        return 0
+    return len(by_type["temp"]["object"]["values"])
+
+
+class WearStore:
+    """
+    SQLite (WAL mode) table of per-day temperature sample counts.
+
+    One connection is kept per thread, like query_cache.CacheManifest.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS daily_samples (
+                    endpoint TEXT NOT NULL,
+                    email TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    samples INTEGER NOT NULL,
+                    payload BLOB,
+                    fetched_at REAL NOT NULL,
+                    PRIMARY KEY (endpoint, email, day)
+                ) WITHOUT ROWID
+                """
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def samples(self, endpoint: str, email: str, start: date, end: date) -> Dict[date, int]:
+        """Stored sample counts for days in [start, end], one range read."""
+        rows = self._connect().execute(
+            "SELECT day, samples FROM daily_samples WHERE endpoint = ? AND email = ? AND day BETWEEN ? AND ?",
+            (endpoint, email, start.isoformat(), end.isoformat()),
+        ).fetchall()
+        return {date.fromisoformat(day): samples for day, samples in rows}
+
+    def put_many(self, endpoint: str, email: str, rows: Sequence[Tuple[date, int, Optional[dict]]]):
+        """Insert or replace (day, samples, raw response or None) rows."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO daily_samples (endpoint, email, day, samples, payload, fetched_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        endpoint,
+                        email,
+                        day.isoformat(),
+                        samples,
+                        zlib.compress(json.dumps(raw).encode("utf-8")) if raw is not None else None,
+                        now,
+                    )
+                    for day, samples, raw in rows
+                ],
+            )
+
+    def payload(self, endpoint: str, email: str, day: date) -> Optional[dict]:
+        """The raw response stored with UH_STORE_RAW, if any."""
+        row = self._connect().execute(
+            "SELECT payload FROM daily_samples WHERE endpoint = ? AND email = ? AND day = ?",
+            (endpoint, email, day.isoformat()),
+        ).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row and row[0] is not None else None
+
+
+def prune_uh_cache(max_bytes: int, cache_dir: Optional[Path] = None) -> dict:
+    """
+    Delete the least recently accessed legacy response files until under max_bytes.
+
+    WearStore imports these on first read; this caps the ones never read.
+    """
+    cache_dir = cache_dir or UH_CACHE_DIR
+    files = []
+    for path in cache_dir.iterdir() if cache_dir.is_dir() else []:
+        if path.is_file() and _UH_CACHE_FILE_RE.match(path.name):
+            st = path.stat()
+            files.append((st.st_atime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    evicted = 0
+    reclaimed = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        total -= size
+        evicted += 1
+        reclaimed += size
+    return {"files": len(files) - evicted, "bytes": total, "evicted": evicted, "reclaimed_bytes": reclaimed}
+
+
+class UltrahumanClient:
+    """Pooled, concurrent, rate-limit aware client for the Ultrahuman metrics endpoint."""
+
+    def __init__(
+        self,
+        auth_key: Optional[str] = None,
+        endpoint: str = UH_API_ENDPOINT,
+        max_workers: int = UH_MAX_CONCURRENCY,
+        max_retries: int = UH_MAX_RETRIES,
+        timeout: float = UH_REQUEST_TIMEOUT,
+        cache_dir: Optional[Path] = None,
+        store_raw: bool = UH_STORE_RAW,
+    ):
+        self.auth_key = auth_key if auth_key is not None else os.getenv("UHKEY")
+        self.endpoint = endpoint
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache_dir = cache_dir or UH_CACHE_DIR
+        self.store = WearStore(self.cache_dir / UH_STORE_FILE)
+        self.store_raw = store_raw
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        # Shared by all workers: no request is sent before this monotonic time
+        self._resume_at = 0.0
+        self._resume_lock = threading.Lock()
+
+    def close(self):
+        self._session.close()
+
+    def daily_wear(self, email: str, day) -> Optional[float]:
+        """
+        Percentage of the day's 288 temperature samples present.
+
+        0.0 for future days and failed requests, None without a UHKEY.
+        """
+        return self._daily_wear_many(email, [_as_date(day)])[_as_date(day)]
+
+    def daily_wear_range(self, email: str, start, end) -> Dict[date, Optional[float]]:
+        """daily_wear for every day in [start, end], fetched concurrently."""
+        start, end = _as_date(start), _as_date(end)
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        return self._daily_wear_many(email, days)
+
+    def weekly_wear_counts(self, email: str, week_ranges: Sequence[Tuple[object, object]]) -> List[int]:
+        """
+        Days with at least 75% wear in each (week_start, week_end) range.
+
+        All days of all weeks are read (and, if missing, fetched) as one batch.
+        """
+        days = sorted({
+            _as_date(start) + timedelta(days=i)
+            for start, end in week_ranges
+            for i in range((_as_date(end) - _as_date(start)).days + 1)
+        })
+        wear = self._daily_wear_many(email, days)
+        counts = []
+        for start, end in week_ranges:
+            start, end = _as_date(start), _as_date(end)
+            counts.append(sum(
+                1 for day, percentage in wear.items()
+                if start <= day <= end and percentage is not None and percentage >= WEAR_DAY_PERCENT
+            ))
+        return counts
+
+    def _daily_wear_many(self, email: str, days: List[date]) -> Dict[date, Optional[float]]:
+        today = date.today()
+        wear = {day: 0.0 for day in days if day > today}  # skip requests for future data.
+        days = [day for day in days if day <= today]
+        if not days:
+            return wear
+
+        samples = self.store.samples(self.endpoint, email, min(days), max(days))
+        metrics.inc("uh_api_requests_total", len([day for day in days if day in samples]), outcome="cache_hit")
+        missing = [day for day in days if day not in samples]
+        samples.update(self._import_legacy(email, [day for day in missing if day < today]))
+        missing = [day for day in missing if day not in samples]
+
+        if missing and not self.auth_key:
+            logger.warning("Could not find UH authorization key.")
+            wear.update((day, None) for day in missing)
+            missing = []
+        if missing:
+            fetched = self._fetch_many(email, missing)
+            self.store.put_many(self.endpoint, email, [
+                (day, count, raw if self.store_raw else None)
+                for day, (count, raw) in fetched.items()
+                if count is not None and day < today  # cache only past days.
+            ])
+            samples.update((day, 0 if count is None else count) for day, (count, _) in fetched.items())
+
+        wear.update((day, samples[day] / EXPECTED_SAMPLES_PER_DAY * 100) for day in days if day in samples)
+        return wear
+
+    def _fetch_many(self, email: str, days: List[date]) -> Dict[date, Tuple[Optional[int], Optional[dict]]]:
+        if len(days) <= 1 or self.max_workers == 1:
+            return {day: self._fetch_day(email, day) for day in days}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(days)), thread_name_prefix="uh-api") as pool:
+            return dict(zip(days, pool.map(lambda day: self._fetch_day(email, day), days)))
+
+    def _fetch_day(self, email: str, day: date) -> Tuple[Optional[int], Optional[dict]]:
+        """(sample count, raw response) from the API; (None, None) on error."""
+        data = self._get({"email": email, "date": day.strftime("%Y-%m-%d")})
+        if data is None:
+            return None, None
+        try:
+            return temp_sample_count(data), data
+        except (KeyError, TypeError) as e:
+            logger.warning("Unexpected UH response for %s on %s: %s", email, day, e)
+            return None, None
+
+    def _import_legacy(self, email: str, days: List[date]) -> Dict[date, int]:
+        """Move the old one-file-per-day responses for these days into the store."""
+        imported = []
+        for day in days:
+            path = self.cache_dir / cache_key({"email": email, "date": day.strftime("%Y-%m-%d")}, self.endpoint)
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    data = json.load(file)
+                imported.append((day, temp_sample_count(data), data if self.store_raw else None, path))
+            except FileNotFoundError:
+                continue
+            except (ValueError, KeyError, TypeError):
+                path.unlink(missing_ok=True)  # corrupt cache entry, fetch again.
+        if imported:
+            self.store.put_many(self.endpoint, email, [(day, count, raw) for day, count, raw, _ in imported])
+            for *_, path in imported:
+                path.unlink(missing_ok=True)
+            metrics.inc("uh_legacy_files_imported_total", len(imported))
+        return {day: count for day, count, _, _ in imported}
+
+    def migrate_legacy(self, emails: Sequence[str], start, end) -> int:
+        """
+        Import every legacy response file for these emails and days in [start, end].
+
+        The files are named by a hash of the request, so the emails and the
+        date range to look for have to be given. Returns the number imported.
+        """
+        start, end = _as_date(start), min(_as_date(end), date.today() - timedelta(days=1))
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+        return sum(len(self._import_legacy(email, days)) for email in emails)
+
+    def _get(self, params: dict) -> Optional[dict]:
+        """GET with shared 429 throttling and exponential backoff on transient errors."""
+        headers = {"Authorization": self.auth_key}
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_slot()
+            started = time.perf_counter()
+            try:
+                response = self._session.get(self.endpoint, params=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                metrics.inc("uh_api_requests_total", outcome="connection_error")
+                logger.warning("UH request failed for %s on %s: %s", params["email"], params["date"], e)
+                delay = self._backoff(attempt)
+            else:
+                metrics.observe("uh_api_request_seconds", time.perf_counter() - started, status=str(response.status_code))
+                if response.status_code == 200:
+                    metrics.inc("uh_api_requests_total", outcome="ok")
+                    return response.json()
+                if response.status_code == 429:
+                    metrics.inc("uh_api_requests_total", outcome="throttled")
+                    delay = self._retry_after(response) or self._backoff(attempt)
+                    self._pause(delay)
+                elif response.status_code >= 500:
+                    metrics.inc("uh_api_requests_total", outcome="server_error")
+                    delay = self._backoff(attempt)
+                else:
+                    metrics.inc("uh_api_requests_total", outcome="client_error")
+                    logger.warning("API error: %s for %s on %s", response.status_code, params["email"], params["date"])
+                    return None
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        logger.warning("Giving up on UH request for %s on %s after %d attempts", params["email"], params["date"], self.max_retries + 1)
+        return None
+
+    def _wait_for_slot(self):
+        while True:
+            with self._resume_lock:
+                remaining = self._resume_at - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def _pause(self, seconds: float):
+        with self._resume_lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+        try:
+            return min(float(value), BACKOFF_MAX_SECONDS) if value is not None else None
+        except ValueError:
+            return None  # HTTP-date form; fall back to backoff
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # Full jitter keeps the workers from retrying in lockstep
+        return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_INITIAL_SECONDS * 2 ** attempt))
+
+
+_client: Optional[UltrahumanClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> UltrahumanClient:
+    """Process-wide client, so every caller shares one connection pool and throttle."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = UltrahumanClient()
+        return _client
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Maintain the Ultrahuman wear store.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mig = sub.add_parser("migrate", help="Import legacy per-day response files from .cache/ into the store.")
+    mig.add_argument("--start", type=date.fromisoformat, required=True, help="first day, YYYY-MM-DD")
+    mig.add_argument("--end", type=date.fromisoformat, default=date.today(), help="last day, YYYY-MM-DD")
+    mig.add_argument("emails", nargs="+")
+    args = parser.parse_args(argv)
+
+    imported = get_client().migrate_legacy(args.emails, args.start, args.end)
+    print(json.dumps({"imported": imported}))
+
+
+if __name__ == "__main__":
+    main()